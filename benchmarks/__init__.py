@@ -0,0 +1,5 @@
+# -*- coding: utf-8 -*-
+'''
+Benchmarks for the birdseye server. Run them as modules from the repository
+root, e.g. ``python -m benchmarks.micro --help``.
+'''
@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+'''
+Timing, result files and baseline comparison shared by the benchmarks.
+
+Result files are JSON objects of the form:
+
+.. code:: Javascript
+
+    {
+      "meta": {"python": "3.5.3", "platform": "...", "version": "..."},
+      "results": {
+        "make_poly[1000]": {"rows": 1000, "best": 0.0021, ...}
+      }
+    }
+
+'''
+import json
+import math
+import os.path
+import platform
+import statistics
+import sys
+import time
+
+
+DEFAULT_TOLERANCE = 1.25
+
+
+def percentile(values, pct):
+    '''Nearest-rank percentile of ``values`` (pct in 0..100).'''
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = int(math.ceil(pct / 100.0 * len(ordered))) - 1
+    rank = max(0, min(len(ordered) - 1, rank))
+    return ordered[rank]
+
+
+def measure(fn, repeat=5, warmup=1):
+    '''Calls ``fn`` ``warmup + repeat`` times, returns the timings in seconds
+    of the last ``repeat`` calls.'''
+    for _ in range(warmup):
+        fn()
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def summarize(timings, rows):
+    best = min(timings)
+    return {
+        'rows': rows,
+        'repeat': len(timings),
+        'best': best,
+        'median': statistics.median(timings),
+        'per_row_us': best / rows * 1e6 if rows else None,
+    }
+
+
+def metadata():
+    try:
+        import birdseye
+        version = birdseye.__version__
+    except Exception:  # pragma: no cover
+        version = None
+    return {
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'platform': platform.platform(),
+        'version': version,
+        'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+    }
+
+
+def write_results(path, results):
+    document = {'meta': metadata(), 'results': results}
+    if path == '-':
+        print(json.dumps(document, indent=4, sort_keys=True))
+    else:
+        with open(path, 'w') as f:
+            json.dump(document, f, indent=4, sort_keys=True)
+    return document
+
+
+def read_results(path):
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)['results']
+
+
+def compare(results, baseline, key='per_row_us', tolerance=DEFAULT_TOLERANCE):
+    '''Compares ``results`` against ``baseline`` on ``key``. Returns a list of
+    ``(name, baseline, current, ratio)`` for the cases slower than
+    ``tolerance`` times their baseline. Cases missing from either side are
+    ignored.'''
+    regressions = []
+    for name, current in sorted(results.items()):
+        old = baseline.get(name)
+        if not old or not old.get(key) or current.get(key) is None:
+            continue
+        ratio = current[key] / old[key]
+        if ratio > tolerance:
+            regressions.append((name, old[key], current[key], ratio))
+    return regressions
+
+
+def report_regressions(regressions, key='per_row_us'):
+    for name, old, new, ratio in regressions:
+        print('REGRESSION {}: {} {:.3f} -> {:.3f} ({:+.0%})'.format(
+            name, key, old, new, ratio - 1), file=sys.stderr)
@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+'''
+Bulk export throughput (rows/s) and memory. Exports the observations table
+as NDJSON, CSV (as GET /v1/export/observations.<format> streams them) and
+GeoParquet (as ``birdseye export_observations``), each in a child process
+reporting its peak RSS: with server side cursors it stays flat as the table
+grows.
+
+``--seed N`` first bulk inserts N synthetic observations (needs NumPy).
+Point it at a scratch database:
+
+.. code:: bash
+
+    export SQLALCHEMY_DATABASE_URI=postgresql://localhost/birdseye_export
+    python -m benchmarks.export --seed 1000000 --chunk-size 5000
+
+'''
+import argparse
+import multiprocessing
+import os
+import resource
+import sys
+import tempfile
+import time
+
+from benchmarks import common
+
+
+FORMATS = ['ndjson', 'csv', 'geoparquet']
+
+
+def seed(count, batch_size=10000):
+    import numpy as np
+    from birdseye import app, db
+    import birdseye.bulk as bulk
+
+    rnd = np.random.RandomState(42)
+    with app.app_context():
+        connection = db.engine.connect()
+        for start in range(0, count, batch_size):
+            n = min(batch_size, count - start)
+            rows = bulk.observation_rows(
+                rnd.uniform(20.0, 30.0, n), rnd.uniform(43.0, 48.0, n),
+                0.0001, [{'url': 'seed'}] * n,
+                [{'vision_labels': [[0.9, 'bird'], [0.8, 'heron']]}] * n)
+            bulk.insert_observations(connection, rows)
+        connection.close()
+
+
+def _export(fmt, chunk_size, queue):
+    from birdseye import app
+    import birdseye.export as export
+
+    started = time.perf_counter()
+    with app.app_context():
+        if fmt == 'geoparquet':
+            fd, path = tempfile.mkstemp(suffix='.parquet')
+            os.close(fd)
+            rows = export.write_geoparquet(path, chunk_size)
+            size = os.path.getsize(path)
+            os.remove(path)
+        else:
+            geometry, encode = {
+                'ndjson': ('geojson', export.ndjson_chunks),
+                'csv': ('wkt', export.csv_chunks),
+            }[fmt]
+            rows, size = 0, 0
+
+            def counted(chunks):
+                nonlocal rows
+                for chunk in chunks:
+                    rows += len(chunk)
+                    yield chunk
+
+            chunks = export.iter_chunks(
+                export.export_query(geometry), chunk_size)
+            for data in encode(counted(chunks)):
+                size += len(data)
+    elapsed = time.perf_counter() - started
+    queue.put({
+        'rows': rows,
+        'rows_per_s': rows / elapsed if elapsed else 0.0,
+        'mb': size / 2.0 ** 20,
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    })
+
+
+def run_format(fmt, chunk_size):
+    # a fresh process per format, so that peak RSS is its own
+    queue = multiprocessing.Queue()
+    proc = multiprocessing.Process(
+        target=_export, args=(fmt, chunk_size, queue))
+    proc.start()
+    result = queue.get()
+    proc.join()
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--seed', type=int, default=0,
+                        help='observations to insert first')
+    parser.add_argument('--chunk-size', type=int, default=5000)
+    parser.add_argument('--formats', default=','.join(FORMATS))
+    parser.add_argument('--output', default='-')
+    args = parser.parse_args(argv)
+
+    if args.seed:
+        seed(args.seed)
+    results = {}
+    for fmt in args.formats.split(','):
+        results[fmt] = run_format(fmt, args.chunk_size)
+        print('{:<10} {:>10} rows {:>10.0f} rows/s {:>8.1f} MB  '
+              'peak RSS {} kB'.format(
+                  fmt, results[fmt]['rows'], results[fmt]['rows_per_s'],
+                  results[fmt]['mb'], results[fmt]['peak_rss_kb']),
+              file=sys.stderr)
+    common.write_results(args.output, results)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
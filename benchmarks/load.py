@@ -0,0 +1,309 @@
+# -*- coding: utf-8 -*-
+'''
+End-to-end load generator. Brings up the production stack (gunicorn gevent
+workers on a unix socket, as ``birdseye runproduction`` does, plus an rq
+worker) with stubbed Vision and PubSub, then replays a weighted traffic mix
+at increasing concurrency and reports throughput and p50/p95/p99 latency per
+endpoint.
+
+Point it at a scratch database, the stack writes to it:
+
+.. code:: bash
+
+    export SQLALCHEMY_DATABASE_URI=postgresql://localhost/birdseye_load
+    birdseye reset_tables
+    python -m benchmarks.load --concurrency 1,10,100,500 --duration 20
+
+Use ``--no-stack --socket /tmp/birdseye_gunicorn.sock`` to load an already
+running server instead.
+'''
+import gevent.monkey; gevent.monkey.patch_all()  # noqa
+
+import argparse
+import bisect
+import http.client
+import itertools
+import json
+import os
+import os.path
+import random
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import gevent
+import gevent.pool
+
+from benchmarks import common
+
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+IMAGE = os.path.join(ROOT, 'test-data', 'exif-img-gps.jpg')
+MIX = 'login=2,upload=1,map=5,species=2,observe=2'
+CREDENTIALS = {'email': 'load@example.com'}
+SECRET = 'load-test-secret'
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+
+    def __init__(self, path, timeout=60):
+        super().__init__('localhost', timeout=timeout)
+        self.path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.path)
+
+
+class Client(object):
+    '''One keep-alive connection, as a mobile client would use.'''
+
+    def __init__(self, socket_path):
+        self.socket_path = socket_path
+        self.conn = None
+
+    def request(self, method, url, body=None, headers=None):
+        headers = dict(headers or {})
+        if isinstance(body, dict):
+            body = json.dumps(body)
+            headers['Content-Type'] = 'application/json'
+        for attempt in (0, 1):
+            if self.conn is None:
+                self.conn = UnixHTTPConnection(self.socket_path)
+            try:
+                self.conn.request(method, url, body=body, headers=headers)
+                resp = self.conn.getresponse()
+                data = resp.read()
+                return resp.status, data
+            except (http.client.HTTPException, OSError):
+                self.conn.close()
+                self.conn = None
+                if attempt:
+                    raise
+
+
+class Actions(object):
+    '''The endpoints of the traffic mix, each returns the HTTP status.'''
+
+    def __init__(self, upload_dir):
+        self.upload_dir = upload_dir
+        self.rnd = random.Random()
+
+    def _point(self):
+        lon = self.rnd.uniform(20.0, 30.0)
+        lat = self.rnd.uniform(43.0, 48.0)
+        d = 0.0001
+        return 'POLYGON(({0} {1}, {2} {3}, {4} {1}, {2} {5}, {0} {1}))'.format(
+            lon - d, lat, lon, lat + d, lon + d, lat - d)
+
+    def login(self, client):
+        return client.request('POST', '/v1/sessions', {
+            'credentials': CREDENTIALS, 'secret': SECRET,
+            'tokens': {'fcm_token': 'load'}})[0]
+
+    def upload(self, client):
+        # the server moves X-File into MEDIA_ROOT, so upload a fresh copy
+        fd, path = tempfile.mkstemp(suffix='.jpg', dir=self.upload_dir)
+        os.close(fd)
+        shutil.copyfile(IMAGE, path)
+        return client.request('POST', '/v1/media', headers={'X-File': path})[0]
+
+    def map(self, client):
+        return client.request('GET', '/v1/mapped_observations')[0]
+
+    def species(self, client):
+        return client.request('GET', '/v1/species')[0]
+
+    def observe(self, client):
+        return client.request('POST', '/v1/observations', {
+            'credentials': CREDENTIALS, 'secret': SECRET,
+            'geometry': self._point(), 'media': {},
+            'properties': {'vision_labels': [[0.9, 'bird'], [0.8, 'heron']]},
+        })[0]
+
+
+def parse_mix(mix):
+    weights = {}
+    for item in mix.split(','):
+        name, _, weight = item.partition('=')
+        if not hasattr(Actions, name.strip()):
+            raise ValueError('Unknown action: {}'.format(name))
+        weights[name.strip()] = float(weight or 1)
+    return weights
+
+
+def seed(client):
+    client.request('POST', '/v1/users', {
+        'credentials': CREDENTIALS, 'secret': SECRET})
+    client.request('POST', '/v1/species', {
+        'names': {'common': 'grey heron', 'scientific': 'ardea cinerea'},
+        'labels': ['bird', 'heron']})
+
+
+def run_level(socket_path, actions, weights, concurrency, duration):
+    names = sorted(weights)
+    cum = list(itertools.accumulate(weights[n] for n in names))
+    samples = {name: [] for name in names}
+    errors = {name: 0 for name in names}
+    deadline = time.perf_counter() + duration
+
+    def user():
+        rnd = random.Random()
+        client = Client(socket_path)
+        while time.perf_counter() < deadline:
+            name = names[bisect.bisect(cum, rnd.random() * cum[-1])]
+            start = time.perf_counter()
+            try:
+                status = getattr(actions, name)(client)
+            except Exception:
+                status = None
+            elapsed = time.perf_counter() - start
+            if status is None or status >= 400:
+                errors[name] += 1
+            else:
+                samples[name].append(elapsed)
+
+    pool = gevent.pool.Pool(concurrency)
+    started = time.perf_counter()
+    for _ in range(concurrency):
+        pool.spawn(user)
+    pool.join()
+    wall = time.perf_counter() - started
+
+    results = {}
+    for name in names:
+        lat = samples[name]
+        results[name] = {
+            'requests': len(lat),
+            'errors': errors[name],
+            'throughput': len(lat) / wall,
+            'p50_ms': _ms(common.percentile(lat, 50)),
+            'p95_ms': _ms(common.percentile(lat, 95)),
+            'p99_ms': _ms(common.percentile(lat, 99)),
+        }
+    total = sum(len(v) for v in samples.values())
+    results['total'] = {
+        'requests': total,
+        'errors': sum(errors.values()),
+        'throughput': total / wall,
+    }
+    return results
+
+
+def _ms(seconds):
+    return None if seconds is None else seconds * 1000.0
+
+
+def _wait_for_socket(path, timeout=60):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            s.connect(path)
+            s.close()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError('Server did not come up on {}'.format(path))
+
+
+def start_stack(socket_path, workers, media_root):
+    from birdseye import production
+
+    env = os.environ.copy()
+    env.update({
+        'BIRDSEYE_VISION': 'stub',
+        'BIRDSEYE_PUBSUB': 'stub',
+        'MEDIA_ROOT': media_root,
+        'UPLOAD_ROOT': os.path.join(media_root, 'partial'),
+        # all the clients share an address, measure without the limits
+        'RATE_LIMITS': os.getenv('RATE_LIMITS', '0'),
+        'PYTHONPATH': ROOT + os.pathsep + env.get('PYTHONPATH', ''),
+    })
+    pidfile = os.path.join(media_root, 'gunicorn.pid')
+    gunicorn = production.gunicorn_command(
+        bind='unix:' + socket_path, workers=workers, pidfile=pidfile)
+    manage = [sys.executable, os.path.join(ROOT, 'bin', 'birdseye')]
+    workers = production.worker_commands(
+        [(['www-data-chmod', 'local', 'default'], 1), (['vision'], 2)],
+        manage=manage)
+    procs = [subprocess.Popen(gunicorn, env=env, cwd=ROOT)]
+    procs.extend(subprocess.Popen(worker, env=env, cwd=ROOT)
+                 for worker in workers)
+    _wait_for_socket(socket_path)
+    return procs
+
+
+def stop_stack(procs):
+    for proc in procs:
+        proc.send_signal(signal.SIGTERM)
+    for proc in procs:
+        proc.wait()
+
+
+def print_table(concurrency, results):
+    print('concurrency {}'.format(concurrency), file=sys.stderr)
+    for name, r in sorted(results.items()):
+        if name == 'total':
+            continue
+        print('  {:<8} {:>8.1f} req/s  p50 {:>8} p95 {:>8} p99 {:>8}  '
+              'errors {}'.format(
+                  name, r['throughput'], _fmt(r['p50_ms']),
+                  _fmt(r['p95_ms']), _fmt(r['p99_ms']), r['errors']),
+              file=sys.stderr)
+    print('  {:<8} {:>8.1f} req/s'.format(
+        'total', results['total']['throughput']), file=sys.stderr)
+
+
+def _fmt(ms):
+    return '-' if ms is None else '{:.1f}ms'.format(ms)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--mix', default=MIX,
+                        help='weighted actions, e.g. "{}"'.format(MIX))
+    parser.add_argument('--concurrency', default='1,10,50,100,250,500',
+                        help='comma separated concurrent clients per level')
+    parser.add_argument('--duration', type=float, default=10.0,
+                        help='seconds per concurrency level')
+    parser.add_argument('--workers', type=int, default=2,
+                        help='gunicorn workers (runproduction uses 2)')
+    parser.add_argument('--socket', default='/tmp/birdseye_load.sock')
+    parser.add_argument('--no-stack', action='store_true',
+                        help='do not start gunicorn/rq, use --socket as is')
+    parser.add_argument('--output', default='-',
+                        help='results file, "-" for stdout')
+    args = parser.parse_args(argv)
+
+    weights = parse_mix(args.mix)
+    levels = [int(c) for c in args.concurrency.split(',') if c]
+    media_root = tempfile.mkdtemp(prefix='birdseye-load-')
+    procs = [] if args.no_stack else start_stack(
+        args.socket, args.workers, media_root)
+    try:
+        seed(Client(args.socket))
+        actions = Actions(media_root)
+        results = {}
+        for concurrency in levels:
+            level = run_level(
+                args.socket, actions, weights, concurrency, args.duration)
+            print_table(concurrency, level)
+            for name, r in level.items():
+                results['{}[c={}]'.format(name, concurrency)] = r
+        common.write_results(args.output, results)
+    finally:
+        if procs:
+            stop_stack(procs)
+        shutil.rmtree(media_root, ignore_errors=True)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+'''
+Login throughput of one gevent worker with secret verification run inline
+on the event loop versus in the birdseye.passwords thread pool.
+
+Each of --concurrency greenlets verifies a PASSWORD_ITERATIONS hash in a
+loop, as Sessions.post does. A ticker greenlet measures how late the event
+loop wakes it up: the latency every other request in the worker would see.
+
+.. code:: bash
+
+    python -m benchmarks.login --concurrency 1,10,100 --threads 1,4
+
+'''
+import gevent.monkey; gevent.monkey.patch_all()  # noqa
+
+import argparse
+import sys
+import time
+
+import gevent
+import gevent.pool
+from gevent.threadpool import ThreadPool
+
+from benchmarks import common
+import birdseye.passwords as passwords
+
+
+TICK = 0.01  # seconds
+
+
+def run_mode(stored, threads, concurrency, duration):
+    '''threads=0 verifies inline, blocking the loop.'''
+    pool = ThreadPool(threads) if threads else None
+    logins, lags = [], []
+    deadline = time.perf_counter() + duration
+
+    def login():
+        while time.perf_counter() < deadline:
+            start = time.perf_counter()
+            if pool is None:
+                ok = passwords._verify('12345', stored)
+            else:
+                ok = pool.apply(passwords._verify, ('12345', stored))
+            assert ok
+            logins.append(time.perf_counter() - start)
+
+    def ticker():
+        while time.perf_counter() < deadline:
+            start = time.perf_counter()
+            gevent.sleep(TICK)
+            lags.append(time.perf_counter() - start - TICK)
+
+    group = gevent.pool.Group()
+    started = time.perf_counter()
+    group.spawn(ticker)
+    for _ in range(concurrency):
+        group.spawn(login)
+    group.join()
+    wall = time.perf_counter() - started
+    if pool is not None:
+        pool.kill()
+    return {
+        'logins': len(logins),
+        'throughput': len(logins) / wall,
+        'login_p50_ms': common.percentile(logins, 50) * 1000.0,
+        'login_p99_ms': common.percentile(logins, 99) * 1000.0,
+        'loop_lag_p99_ms': common.percentile(lags, 99) * 1000.0,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--concurrency', default='1,10,100')
+    parser.add_argument('--threads', default='1,2,4',
+                        help='pool sizes to compare with inline hashing')
+    parser.add_argument('--iterations', type=int,
+                        default=passwords.PASSWORD_ITERATIONS)
+    parser.add_argument('--duration', type=float, default=5.0)
+    parser.add_argument('--output', default='-')
+    args = parser.parse_args(argv)
+
+    stored = passwords._hash('12345', args.iterations)
+    modes = [('inline', 0)] + [
+        ('pool{}'.format(n), int(n)) for n in args.threads.split(',')]
+    results = {}
+    for concurrency in [int(c) for c in args.concurrency.split(',')]:
+        for name, threads in modes:
+            key = '{}@{}'.format(name, concurrency)
+            results[key] = run_mode(stored, threads, concurrency,
+                                    args.duration)
+            print('{:<12} {:>8.1f} logins/s  p99 {:.1f}ms  '
+                  'loop lag p99 {:.1f}ms'.format(
+                      key, results[key]['throughput'],
+                      results[key]['login_p99_ms'],
+                      results[key]['loop_lag_p99_ms']),
+                  file=sys.stderr)
+    common.write_results(args.output, results)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+'''
+Micro-benchmarks for the pure-Python hot paths: serialization, geometry
+helpers and the JSON codecs. Synthetic fixtures only, no database needed.
+
+.. code:: bash
+
+    python -m benchmarks.micro --sizes 1000,100000  # compare to baseline
+    python -m benchmarks.micro --save-baseline     # record a new baseline
+
+Exits with status 1 when a case is slower than ``--tolerance`` times its
+baseline (per row timings are compared), or with ``--check`` when there is
+no baseline to compare to.
+'''
+import argparse
+from datetime import datetime, timedelta
+import json
+import os.path
+import random
+import sys
+
+from benchmarks import common
+
+
+SIZES = (1000, 100000, 1000000)
+HERE = os.path.dirname(__file__)
+BASELINE = os.path.join(HERE, 'baseline.json')
+SEED = 1729
+LABELS = ['bird', 'blue', 'feather', 'beak', 'wildlife', 'fauna', 'heron',
+          'butterfly', 'insect', 'moth', 'plant', 'tree']
+
+
+def _dms(rnd, limit):
+    degrees = rnd.uniform(0, limit)
+    minutes = (degrees % 1) * 60
+    seconds = (minutes % 1) * 60
+    return ((int(degrees), 1), (int(minutes), 1), (int(seconds * 4096), 4096))
+
+
+def make_fixtures(rows, seed=SEED):
+    '''Builds ``rows`` transient (never persisted) observations plus the
+    matching raw inputs of the geometry helpers.'''
+    import birdseye.models as bm
+    import birdseye.passwords as passwords
+
+    rnd = random.Random(seed)
+    # secrets are not benchmarked here: one hash for all, not 100 slow ones
+    users = [bm.User({'email': 'user{}@example.com'.format(i)}, None,
+                     social={'nickname': 'user{}'.format(i)})
+             for i in range(100)]
+    secret = passwords.hash_secret('secret', iterations=1)
+    for user in users:
+        user.user_id = bm.new_uuid()
+        user.secrets = secret
+    species = [bm.Species({'common': 'species {}'.format(i),
+                           'scientific': 'species scientifica {}'.format(i)},
+                          rnd.sample(LABELS, 3))
+               for i in range(100)]
+    for sp in species:
+        sp.species_id = bm.new_uuid()
+
+    start = datetime(2017, 4, 1)
+    observations, coords, arcs, docs = [], [], [], []
+    for i in range(rows):
+        lon, lat = rnd.uniform(-180, 180), rnd.uniform(-90, 90)
+        labels = [[round(rnd.uniform(0.55, 1.0), 4), label]
+                  for label in rnd.sample(LABELS, 5)]
+        obs = bm.Observation(
+            rnd.choice(users), 'POINT({} {})'.format(lon, lat),
+            {'url': 'https://birdseye.space/static/{}.jpeg'.format(i)},
+            {'vision_labels': labels}, rnd.choice(species))
+        obs.observation_id = bm.new_uuid()
+        obs.created = start + timedelta(seconds=i)
+        obs.geometry_center = {'type': 'Point', 'coordinates': [lon, lat]}
+        observations.append(obs)
+        coords.append((lon, lat))
+        arcs.append((_dms(rnd, 180), rnd.random() < 0.5))
+        docs.append({'created': obs.created, 'duration': timedelta(i % 30),
+                     'properties': {'vision_labels': labels,
+                                    'nested': {'duration': i % 30}}})
+    return {
+        'observations': observations,
+        'coords': coords,
+        'arcs': arcs,
+        'docs': docs,
+    }
+
+
+def cases(fixtures):
+    '''Returns ``{name: callable}``, each callable processes all rows.'''
+    import birdseye.api as api
+    import birdseye.jobs as jobs
+    import birdseye.models as bm
+
+    observations = fixtures['observations']
+    coords = fixtures['coords']
+    arcs = fixtures['arcs']
+    docs = fixtures['docs']
+    # obj_hook converts the nested documents in place: parse fresh ones on
+    # every run (parsed without the hook, which would convert them twice)
+    encoded = [bm.json_dumps(doc) for doc in docs]
+    decoder = bm.TimedeltaJSONDecoder()
+    mapped = api.MappedObservations()
+
+    def as_public_dict():
+        for obs in observations:
+            obs.as_public_dict()
+
+    def public_repr():
+        for obs in observations:
+            obs.public_repr(obs.created)
+            obs.public_repr(obs.user)
+
+    def json_dumps():
+        for doc in docs:
+            bm.json_dumps(doc)
+
+    def obj_hook():
+        for text in encoded:
+            decoder.obj_hook(json.loads(text))
+
+    def make_poly():
+        for lon, lat in coords:
+            jobs.make_poly(lon, lat, 0.000001)
+
+    def dms_as_float():
+        for arc, negative in arcs:
+            jobs.dms_as_float(arc, negative)
+
+    def remap():
+        for obs in observations:
+            mapped._remap(obs)
+
+    return {
+        'as_public_dict': as_public_dict,
+        'public_repr': public_repr,
+        'json_dumps': json_dumps,
+        'obj_hook': obj_hook,
+        'make_poly': make_poly,
+        'dms_as_float': dms_as_float,
+        'remap': remap,
+    }
+
+
+def run(sizes, repeat, only=None):
+    from birdseye import app
+
+    results = {}
+    with app.app_context():
+        for rows in sizes:
+            fixtures = make_fixtures(rows)
+            for name, fn in sorted(cases(fixtures).items()):
+                if only and name not in only:
+                    continue
+                # large fixtures are slow enough to need fewer repeats
+                reps = max(1, repeat if rows <= 100000 else repeat // 3)
+                timings = common.measure(fn, repeat=reps)
+                key = '{}[{}]'.format(name, rows)
+                results[key] = common.summarize(timings, rows)
+                print('{:<28} {:>12.3f} us/row'.format(
+                    key, results[key]['per_row_us']), file=sys.stderr)
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument(
+        '--sizes', default=','.join(str(s) for s in SIZES),
+        help='comma separated fixture sizes (rows)')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument(
+        '--only', default='', help='comma separated case names to run')
+    parser.add_argument(
+        '--output', default='-', help='results file, "-" for stdout')
+    parser.add_argument('--baseline', default=BASELINE)
+    parser.add_argument(
+        '--save-baseline', action='store_true',
+        help='store the results as the new baseline instead of comparing')
+    parser.add_argument(
+        '--check', action='store_true',
+        help='fail when there is no baseline to compare to')
+    parser.add_argument(
+        '--tolerance', type=float, default=common.DEFAULT_TOLERANCE,
+        help='slowdown ratio reported as a regression')
+    args = parser.parse_args(argv)
+
+    sizes = [int(s) for s in args.sizes.split(',') if s]
+    only = set(s for s in args.only.split(',') if s)
+    results = run(sizes, args.repeat, only)
+
+    if args.save_baseline:
+        common.write_results(args.baseline, results)
+        return 0
+    common.write_results(args.output, results)
+    baseline = common.read_results(args.baseline)
+    if baseline is None:
+        print('No baseline at {}, nothing to compare.'.format(args.baseline),
+              file=sys.stderr)
+        return 1 if args.check else 0
+    regressions = common.compare(results, baseline, tolerance=args.tolerance)
+    common.report_regressions(regressions)
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
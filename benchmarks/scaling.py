@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+'''
+Multi-core scaling of the production server: throughput of a cheap
+endpoint (a cached user lookup) with 1, 2, 4... gunicorn workers, started
+as ``birdseye runproduction`` does. Throughput should grow about linearly
+up to the CPUs given to the server.
+
+The load comes from --clients processes, pinned to other CPUs than the
+server when the host has enough of them (otherwise they compete with it and
+the efficiency figures are pessimistic).
+
+.. code:: bash
+
+    export SQLALCHEMY_DATABASE_URI=postgresql://localhost/birdseye_load
+    birdseye reset_tables
+    python -m benchmarks.scaling --workers 1,2,4,8 --duration 10
+
+'''
+import gevent.monkey; gevent.monkey.patch_all()  # noqa
+
+import argparse
+import json
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+import gevent.pool
+
+from benchmarks import common
+from benchmarks.load import Client, ROOT, _wait_for_socket
+
+
+def run_client(socket_path, path, duration, concurrency):
+    '''Client process: GETs path for duration seconds, prints the counts.'''
+    counts = {'requests': 0, 'errors': 0}
+    deadline = time.perf_counter() + duration
+
+    def user():
+        client = Client(socket_path)
+        while time.perf_counter() < deadline:
+            try:
+                status = client.request('GET', path)[0]
+            except Exception:
+                status = None
+            if status == 200:
+                counts['requests'] += 1
+            else:
+                counts['errors'] += 1
+
+    pool = gevent.pool.Pool(concurrency)
+    for _ in range(concurrency):
+        pool.spawn(user)
+    pool.join()
+    print(json.dumps(counts))
+
+
+def _pinned(cpus):
+    if not cpus or not hasattr(os, 'sched_setaffinity'):
+        return None
+    return lambda: os.sched_setaffinity(0, cpus)
+
+
+def start_server(socket_path, workers, cpus, tmp):
+    from birdseye import production
+
+    env = os.environ.copy()
+    env.update({
+        'RATE_LIMITS': '0',
+        'PYTHONPATH': ROOT + os.pathsep + env.get('PYTHONPATH', ''),
+    })
+    gunicorn = production.gunicorn_command(
+        bind='unix:' + socket_path, workers=workers,
+        pidfile=os.path.join(tmp, 'gunicorn.pid'))
+    proc = subprocess.Popen(gunicorn, env=env, cwd=ROOT,
+                            preexec_fn=_pinned(cpus))
+    _wait_for_socket(socket_path)
+    return proc
+
+
+def seed(socket_path):
+    status, data = Client(socket_path).request('POST', '/v1/users', {
+        'credentials': {'email': 'scaling@example.com'},
+        'secret': 'scaling'})
+    if status != 201:
+        raise RuntimeError('Could not create a user: {}'.format(data))
+    return '/v1/users/{}'.format(json.loads(data.decode('utf8'))['data'][0])
+
+
+def run_level(socket_path, path, clients, concurrency, duration, cpus):
+    command = [sys.executable, '-m', 'benchmarks.scaling', '--client',
+               socket_path, path, str(duration), str(concurrency)]
+    started = time.perf_counter()
+    procs = [subprocess.Popen(command, cwd=ROOT, stdout=subprocess.PIPE,
+                              universal_newlines=True,
+                              preexec_fn=_pinned(cpus))
+             for _ in range(clients)]
+    totals = {'requests': 0, 'errors': 0}
+    for proc in procs:
+        out, _ = proc.communicate()
+        counts = json.loads(out.splitlines()[-1])
+        for key in totals:
+            totals[key] += counts[key]
+    wall = time.perf_counter() - started
+    totals['throughput'] = totals['requests'] / wall
+    return totals
+
+
+def main(argv=None):
+    cpus = sorted(os.sched_getaffinity(0)) if hasattr(
+        os, 'sched_getaffinity') else list(range(os.cpu_count() or 1))
+    default_levels = [n for n in (1, 2, 4, 8, 16, 32, 64)
+                      if n <= max(1, len(cpus) // 2)]
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument(
+        '--workers', default=','.join(str(n) for n in default_levels),
+        help='comma separated gunicorn worker counts')
+    parser.add_argument('--clients', type=int, default=None,
+                        help='load processes (default: the CPUs left over)')
+    parser.add_argument('--concurrency', type=int, default=50,
+                        help='connections per load process')
+    parser.add_argument('--duration', type=float, default=10.0)
+    parser.add_argument('--socket', default='/tmp/birdseye_scaling.sock')
+    parser.add_argument('--client', nargs=4, help=argparse.SUPPRESS)
+    parser.add_argument('--output', default='-',
+                        help='results file, "-" for stdout')
+    args = parser.parse_args(argv)
+
+    if args.client:
+        socket_path, path, duration, concurrency = args.client
+        run_client(socket_path, path, float(duration), int(concurrency))
+        return 0
+
+    levels = [int(n) for n in args.workers.split(',') if n]
+    server_cpus = cpus[:max(levels)]
+    client_cpus = cpus[max(levels):]
+    clients = args.clients or max(1, len(client_cpus))
+    results = {}
+    base = None
+    for workers in levels:
+        tmp = tempfile.mkdtemp(prefix='birdseye-scaling-')
+        server = start_server(args.socket, workers, server_cpus[:workers],
+                              tmp)
+        try:
+            path = seed(args.socket)
+            run_level(args.socket, path, clients, args.concurrency, 1.0,
+                      client_cpus)  # warm up the workers and the cache
+            level = run_level(args.socket, path, clients, args.concurrency,
+                              args.duration, client_cpus)
+        finally:
+            server.send_signal(signal.SIGTERM)
+            server.wait()
+            shutil.rmtree(tmp, ignore_errors=True)
+        base = base or level['throughput'] / workers
+        level['efficiency'] = level['throughput'] / (base * workers)
+        results['workers[{}]'.format(workers)] = level
+        print('{:>3} workers {:>9.1f} req/s  efficiency {:>4.0%}  '
+              'errors {}'.format(workers, level['throughput'],
+                                 level['efficiency'], level['errors']),
+              file=sys.stderr)
+    common.write_results(args.output, results)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
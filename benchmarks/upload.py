@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+'''
+Throughput of concurrent large uploads streamed to the production stack
+(see benchmarks.load): whole bodies to ``POST /v1/media`` and resumable
+uploads to ``/v1/uploads`` in ``--chunk-mb`` PATCH requests. Reports MB/s,
+per upload latency and the peak resident memory of the gunicorn workers,
+which stays flat as bodies are streamed to disk.
+
+.. code:: bash
+
+    python -m benchmarks.upload --size-mb 10 --concurrency 1,10,50
+
+'''
+import gevent.monkey; gevent.monkey.patch_all()  # noqa
+
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import gevent
+import gevent.pool
+
+from benchmarks import common
+from benchmarks.load import Client, start_stack, stop_stack
+
+
+def make_body(size):
+    return b'\xff\xd8\xff\xe0' + os.urandom(size - 4)
+
+
+def upload_whole(client, body):
+    return client.request('POST', '/v1/media', body=body,
+                          headers={'Content-Type': 'image/jpeg'})[0]
+
+
+def upload_resumable(client, body, chunk):
+    status, data = client.request('POST', '/v1/uploads', headers={
+        'Upload-Length': str(len(body)), 'Upload-Type': 'image/jpeg'})
+    if status != 201:
+        return status
+    upload_id = json.loads(data.decode('utf8'))['data'][0]['upload_id']
+    for offset in range(0, len(body), chunk):
+        status, _ = client.request(
+            'PATCH', '/v1/uploads/{}'.format(upload_id),
+            body=body[offset:offset + chunk],
+            headers={'Upload-Offset': str(offset)})
+        if status != 200:
+            return status
+    return status
+
+
+def rss_kb(pids):
+    total = 0
+    for pid in pids:
+        try:
+            with open('/proc/{}/status'.format(pid)) as f:
+                for line in f:
+                    if line.startswith('VmHWM:'):
+                        total = max(total, int(line.split()[1]))
+        except IOError:
+            pass
+    return total
+
+
+def worker_pids(master_pid):
+    try:
+        with open('/proc/{0}/task/{0}/children'.format(master_pid)) as f:
+            return [int(pid) for pid in f.read().split()]
+    except IOError:
+        return []
+
+
+def run_level(socket_path, upload, body, concurrency, uploads):
+    latencies, errors = [], 0
+    pool = gevent.pool.Pool(concurrency)
+
+    def one():
+        nonlocal errors
+        start = time.perf_counter()
+        status = upload(Client(socket_path), body)
+        if status is None or status >= 400:
+            errors += 1
+        else:
+            latencies.append(time.perf_counter() - start)
+
+    started = time.perf_counter()
+    for _ in range(uploads):
+        pool.spawn(one)
+    pool.join()
+    wall = time.perf_counter() - started
+    return {
+        'uploads': len(latencies),
+        'errors': errors,
+        'mb_per_s': len(latencies) * len(body) / wall / 2 ** 20,
+        'p50_ms': (common.percentile(latencies, 50) or 0) * 1000.0,
+        'p99_ms': (common.percentile(latencies, 99) or 0) * 1000.0,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--size-mb', type=float, default=10.0)
+    parser.add_argument('--chunk-mb', type=float, default=1.0)
+    parser.add_argument('--concurrency', default='1,10,50')
+    parser.add_argument('--uploads', type=int, default=100,
+                        help='uploads per concurrency level and mode')
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--socket', default='/tmp/birdseye_upload.sock')
+    parser.add_argument('--output', default='-')
+    args = parser.parse_args(argv)
+
+    body = make_body(int(args.size_mb * 2 ** 20))
+    chunk = int(args.chunk_mb * 2 ** 20)
+    os.environ['UPLOAD_MAX_BYTES'] = str(len(body))
+    media_root = tempfile.mkdtemp(prefix='birdseye-upload-')
+    procs = start_stack(args.socket, args.workers, media_root)
+    modes = {
+        'whole': upload_whole,
+        'resumable': lambda client, body: upload_resumable(
+            client, body, chunk),
+    }
+    try:
+        results = {}
+        for concurrency in [int(c) for c in args.concurrency.split(',')]:
+            for name, upload in sorted(modes.items()):
+                key = '{}[c={}]'.format(name, concurrency)
+                results[key] = run_level(
+                    args.socket, upload, body, concurrency, args.uploads)
+                results[key]['worker_peak_rss_kb'] = rss_kb(
+                    worker_pids(procs[0].pid))
+                print('{:<18} {:>8.1f} MB/s  p50 {:.0f}ms p99 {:.0f}ms  '
+                      'errors {}'.format(
+                          key, results[key]['mb_per_s'],
+                          results[key]['p50_ms'], results[key]['p99_ms'],
+                          results[key]['errors']), file=sys.stderr)
+        common.write_results(args.output, results)
+    finally:
+        stop_stack(procs)
+        shutil.rmtree(media_root, ignore_errors=True)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+'''
+Per-job overhead of the rq workers: the same jobs run by a forking worker
+(``birdseye rq worker``) and by persistent ones (``birdseye rq persistent``,
+see birdseye.workers), in burst mode on a scratch queue, with stubbed Vision
+and PubSub. Throughput is taken from the start and end times the jobs
+record, so that the start-up of the workers is left out; the difference of
+the per job times is the overhead of forking and of setting up the job
+stack for every job. ``pool:<n>`` runs n persistent processes: its time per
+job is the wall time divided by the jobs, not the cost of one job.
+
+``gevent:<n>`` is one persistent process running up to n jobs at once (see
+GeventWorker), for the jobs waiting on the network. The stub Vision API
+sleeps cooperatively; the real client's grpc transport only overlaps once
+birdseye.green.patch_grpc() made it cooperative, which the gevent workers
+do (without grpc installed, its HTTP transport goes through the patched
+sockets).
+
+``noop`` jobs measure the overhead alone, ``observation`` jobs are
+store_observation (a database insert and a publish), ``upload`` jobs are
+image_to_observation, mostly waiting on the stub Vision API
+(``BIRDSEYE_VISION_LATENCY``, not rate limited here).
+
+.. code:: bash
+
+    export SQLALCHEMY_DATABASE_URI=postgresql://localhost/birdseye_load
+    birdseye reset_tables
+    python -m benchmarks.workers --jobs 500 --modes fork,persistent,pool:4
+    python -m benchmarks.workers --jobs 200 --kinds upload \
+        --modes persistent,gevent:10,gevent:50
+
+'''
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+from benchmarks import common
+from benchmarks.load import IMAGE, ROOT
+
+
+QUEUE = 'benchmark-workers'
+MODES = 'fork,persistent,pool:2'
+
+
+def noop():
+    return None
+
+
+def worker_command(mode):
+    '''The command line of mode: fork, persistent or pool:<processes>.'''
+    manage = [sys.executable, os.path.join(ROOT, 'bin', 'birdseye'), 'rq']
+    if mode == 'fork':
+        return manage + ['worker', '--burst', QUEUE]
+    if mode == 'persistent':
+        return manage + ['persistent', '--burst', QUEUE]
+    if mode.startswith('pool:'):
+        return manage + ['persistent', '--burst', '--processes',
+                         mode.split(':', 1)[1], QUEUE]
+    if mode.startswith('gevent:'):
+        return manage + ['persistent', '--burst', '--concurrency',
+                         mode.split(':', 1)[1], QUEUE]
+    raise ValueError('Unknown worker mode {}'.format(mode))
+
+
+def enqueue(queue, kind, count):
+    if kind == 'noop':
+        return [queue.enqueue('benchmarks.workers.noop').id
+                for _ in range(count)]
+    if kind == 'upload':
+        return [queue.enqueue('birdseye.jobs.image_to_observation', IMAGE,
+                              'https://birdseye.space/benchmark.jpg').id
+                for _ in range(count)]
+    return [queue.enqueue('birdseye.jobs.store_observation',
+                          'https://birdseye.space/benchmark.jpg',
+                          (-116.30162, -33.87546)).id
+            for _ in range(count)]
+
+
+def run_mode(queue, mode, kind, count):
+    queue.empty()
+    ids = enqueue(queue, kind, count)
+    env = os.environ.copy()
+    env.update({
+        'BIRDSEYE_VISION': 'stub',
+        'BIRDSEYE_PUBSUB': 'stub',
+        'VISION_RATE': '100000',
+        'VISION_BURST': '100000',
+        'PYTHONPATH': ROOT + os.pathsep + env.get('PYTHONPATH', ''),
+    })
+    started = time.perf_counter()
+    subprocess.check_call(worker_command(mode), env=env, cwd=ROOT,
+                          stdout=subprocess.DEVNULL)
+    wall = time.perf_counter() - started
+    jobs = [queue.fetch_job(job_id) for job_id in ids]
+    finished = [job for job in jobs if job is not None and job.is_finished]
+    if not finished:
+        raise RuntimeError('No {} job finished in {} mode.'.format(
+            kind, mode))
+    first = min(job.started_at for job in finished)
+    last = max(job.ended_at for job in finished)
+    busy = (last - first).total_seconds()
+    return {
+        'jobs': len(finished),
+        'failed': count - len(finished),
+        'wall': wall,
+        'throughput': len(finished) / busy if busy else None,
+        'per_job_ms': busy / len(finished) * 1000,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--jobs', type=int, default=500)
+    parser.add_argument('--kinds', default='noop,observation',
+                        help='comma separated job kinds')
+    parser.add_argument('--modes', default=MODES,
+                        help='comma separated worker modes, e.g. '
+                             '"{}"'.format(MODES))
+    parser.add_argument('--output', default='-',
+                        help='results file, "-" for stdout')
+    args = parser.parse_args(argv)
+
+    from birdseye import rq
+    queue = rq.get_queue(QUEUE)
+    modes = [m for m in args.modes.split(',') if m]
+    results = {}
+    for kind in [k for k in args.kinds.split(',') if k]:
+        for mode in modes:
+            result = run_mode(queue, mode, kind, args.jobs)
+            results['{}[{}]'.format(kind, mode)] = result
+            print('{:<12} {:<12} {:>8.1f} jobs/s {:>8.2f}ms/job  '
+                  'failed {}'.format(kind, mode, result['throughput'] or 0,
+                                     result['per_job_ms'],
+                                     result['failed']),
+                  file=sys.stderr)
+        fork = results.get('{}[fork]'.format(kind))
+        if fork:
+            for mode in modes:
+                if mode == 'fork':
+                    continue
+                result = results['{}[{}]'.format(kind, mode)]
+                result['overhead_removed_ms'] = (
+                    fork['per_job_ms'] - result['per_job_ms'])
+    common.write_results(args.output, results)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
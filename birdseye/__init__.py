@@ -3,19 +3,21 @@
 Project Birdseye server source package. Requires gevent greenlet patch.
 '''
 from flask import Flask
-from flask_sqlalchemy import SQLAlchemy
 from flask_rq2 import RQ
+from werkzeug.middleware.proxy_fix import ProxyFix
+from birdseye.routing import RoutingSQLAlchemy
 import logging.config
 import sys
 
 
 def _get_version():
+    # birdseye/version.py is written by setuptools_scm at build time (and by
+    # `pip install -e .`), importing the package never shells out to git
     try:
         import birdseye.version  # pragma: no cover
         return birdseye.version.ver  # pragma: no cover
-    except:
-        import setuptools_scm
-        return setuptools_scm.get_version(root='..', relative_to=__file__)
+    except ImportError:
+        return '0.0.0.dev0+unknown'
 
 
 __version__ = _get_version()
@@ -28,6 +30,8 @@ def get_semver():
 
 app = Flask(__name__)
 app.config.from_object('birdseye.default_settings')
+if app.config['PROXY_FIX_HOPS']:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=app.config['PROXY_FIX_HOPS'])
 
 if 'LOGGER' in app.config:
     logging.config.dictConfig(app.config['LOGGER'])
@@ -36,8 +40,15 @@ else:
     app.logger.addHandler(handler)
     app.logger.setLevel('INFO')
 
-db = SQLAlchemy(app)
+db = RoutingSQLAlchemy(app)
 rq = RQ(app)
 
+if app.config['SLOW_QUERY_MS']:
+    import birdseye.slowlog
+    birdseye.slowlog.install(
+        lambda: rq.connection, app.config['SLOW_QUERY_MS'] / 1000.0,
+        size=app.config['SLOW_QUERY_BUFFER'],
+        explain_interval=app.config['SLOW_QUERY_EXPLAIN_INTERVAL'])
+
 import birdseye.api  # noqa
 birdseye.api.noqa()
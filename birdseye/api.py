@@ -26,16 +26,38 @@ Conventions
     }
 
 '''
-from flask import request
+from datetime import datetime, timezone
+from flask import g, request, Response, send_file, stream_with_context
 from flask_restful import Resource, Api, representations
+from flask_restful.representations.json import output_json
+from rq.exceptions import NoSuchJobError
+from rq.job import Job
+import dateutil.parser
+import functools
+import hashlib
+import itertools
+import json
+import math
 import os
+import sqlalchemy
 import types
+import uuid
 
 import birdseye
 from birdseye import app, db, rq
 import birdseye_jobs.chmod
-from birdseye.jobs import image_to_observation
+from birdseye.jobs import locate_image_job, delete_rows
+import birdseye.cache
+import birdseye.export
+import birdseye.metrics
 import birdseye.models as bm
+import birdseye.profiler
+import birdseye.ratelimit
+import birdseye.routing
+import birdseye.search
+import birdseye.slowlog
+import birdseye.tiles
+import birdseye.uploads
 
 api = Api(app)
 representations.json.settings = {'indent': 4}
@@ -51,6 +73,46 @@ def api_route(self, *args, **kwargs):
 api.route = types.MethodType(api_route, api)
 
 
+@app.before_request
+def _read_from_replica():
+    # GET handlers only read, they can use a replica (see birdseye.routing)
+    if request.method in ('GET', 'HEAD'):
+        db.session().info[birdseye.routing.READ_REPLICA] = True
+
+
+@app.before_request
+def _start_profile():
+    if birdseye.profiler.should_profile(
+            request.headers.get(birdseye.profiler.PROFILE_HEADER),
+            app.config['PROFILE_REQUEST_FRACTION']):
+        profile = birdseye.profiler.Profile(
+            'request', '{}-{}'.format(request.method, request.endpoint))
+        if profile.start():
+            g.profile = profile
+
+
+def _save_profile():
+    profile = g.pop('profile', None)
+    if profile is not None and profile.stop():
+        profile.save()
+    return profile
+
+
+@app.after_request
+def _stop_profile(response):
+    profile = _save_profile()
+    if profile is not None:
+        response.headers[birdseye.profiler.PROFILE_HEADER + '-Id'] = \
+            profile.filename
+    return response
+
+
+@app.teardown_request
+def _stop_failed_profile(exc):
+    # after_request is skipped by unhandled exceptions
+    _save_profile()
+
+
 def _success(status_code=200, **message):
     return dict(status='success', **message), status_code
 
@@ -71,6 +133,186 @@ def _not_found():
     return _error('Found no matches', 404)
 
 
+def _job_status(job, status_code=200):
+    return _success_item({
+        'job_id': job.id,
+        'status': job.get_status(),
+        'progress': job.meta.get('progress'),
+        'result': job.result,
+    }, status_code=status_code)
+
+
+def _queue_delete(model):
+    '''Queues the deletion of all the rows of model (?soft=1: marks them
+    deleted), answers 202 with the job to follow at /v1/admin/jobs/<id>.'''
+    soft = request.args.get('soft') in ('1', 'true')
+    return _job_status(delete_rows.queue(model, soft), status_code=202)
+
+
+_limiters = {}
+rate_limit_rejections = birdseye.metrics.Counters(
+    'rate_limit_rejections', lambda: rq.connection)
+
+
+def _limiter(route_class):
+    limiter = _limiters.get(route_class)
+    if limiter is None:
+        rate, burst = app.config['RATE_LIMITS'][route_class]
+        limiter = birdseye.ratelimit.Limiter(
+            route_class, lambda: rq.connection, rate, burst,
+            lease=app.config['RATE_LIMIT_LEASE'])
+        _limiters[route_class] = limiter
+    return limiter
+
+
+def _rate_limit_clients():
+    # the address of the client as seen by the PROXY_FIX_HOPS trusted
+    # proxies, X-Forwarded-For entries added by the client are ignored
+    clients = ['ip:{}'.format(request.remote_addr)]
+    data = request.get_json(silent=True)
+    if isinstance(data, dict) and data.get('credentials'):
+        credentials = json.dumps(data['credentials'], sort_keys=True)
+        clients.append('user:{}'.format(
+            hashlib.sha1(credentials.encode('utf8')).hexdigest()))
+    return clients
+
+
+def rate_limited(route_class):
+    '''Answers 429 to clients over the RATE_LIMITS of route_class.'''
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(*args, **kwargs):
+            if app.config['RATE_LIMITS_ENABLED']:
+                limiter = _limiter(route_class)
+                allowed = []
+                for client in _rate_limit_clients():
+                    wait = limiter.check(client)
+                    if wait is not None:
+                        # rejected by one limit: the others' tokens are kept
+                        for other in allowed:
+                            limiter.refund(other)
+                        rate_limit_rejections.incr(route_class)
+                        message, status_code = _error(
+                            'Too many requests.', 429)
+                        return message, status_code, {
+                            'Retry-After': str(int(math.ceil(wait)))}
+                    allowed.append(client)
+            return method(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+flights = birdseye.cache.SingleFlight(stale=app.config['SINGLE_FLIGHT_STALE'])
+
+# single-flight namespaces whose responses depend on the models
+_FLIGHT_NAMESPACES = {
+    bm.Observation: ('observations',),
+    bm.User: ('observations',),
+    bm.Species: ('species', 'observations'),
+}
+_WRITTEN = 'birdseye.api.written'
+
+
+def _single_flight(namespace, compute):
+    '''The JSON response of compute() -> (message, status_code), encoded once
+    for the identical (path and query string) concurrent requests of this
+    worker, and reused for SINGLE_FLIGHT_STALE seconds.'''
+    def encode():
+        message, status_code = compute()
+        return output_json(message, status_code).get_data(), status_code
+    body, status_code = flights.do((namespace, request.full_path), encode)
+    return Response(body, status=status_code, mimetype='application/json')
+
+
+@sqlalchemy.event.listens_for(sqlalchemy.orm.Session, 'before_flush')
+def _flights_written(session, flush_context, instances):
+    written = itertools.chain(session.new, session.dirty, session.deleted)
+    namespaces = session.info.setdefault(_WRITTEN, set())
+    for obj in written:
+        namespaces.update(_FLIGHT_NAMESPACES.get(type(obj), ()))
+
+
+@sqlalchemy.event.listens_for(sqlalchemy.orm.Session, 'after_bulk_delete')
+@sqlalchemy.event.listens_for(sqlalchemy.orm.Session, 'after_bulk_update')
+def _flights_bulk_written(context):
+    context.session.info.setdefault(_WRITTEN, set()).update(
+        _FLIGHT_NAMESPACES.get(context.mapper.class_, ()))
+
+
+@sqlalchemy.event.listens_for(sqlalchemy.orm.Session, 'after_commit')
+def _forget_flights(session):
+    for namespace in session.info.pop(_WRITTEN, ()):
+        flights.forget(namespace)
+
+
+@sqlalchemy.event.listens_for(sqlalchemy.orm.Session, 'after_rollback')
+def _forget_flights_written(session):
+    session.info.pop(_WRITTEN, None)
+
+
+class InvalidFilter(ValueError):
+    pass
+
+
+def _observation_filters(args, page=False):
+    '''Filters of the observation listings from the query string: label
+    (repeat it to require several labels), species_id, user_id and the
+    since/until ISO 8601 creation time range. With page, the limit (up to
+    OBSERVATION_PAGE_MAX) and the after key of the listings too: the
+    "next" of the previous page, <created>,<observation_id>.'''
+    filters = {'labels': args.getlist('label')}
+    for key in ('species_id', 'user_id'):
+        if key in args:
+            try:
+                filters[key] = uuid.UUID(args[key])
+            except ValueError:
+                raise InvalidFilter('Invalid {}.'.format(key))
+    for key in ('since', 'until'):
+        if key in args:
+            try:
+                when = dateutil.parser.parse(args[key])
+            except (ValueError, OverflowError):
+                raise InvalidFilter('Invalid {}.'.format(key))
+            if when.tzinfo is not None:
+                when = when.astimezone(timezone.utc).replace(tzinfo=None)
+            filters[key] = when
+    if page:
+        filters['limit'] = _page_limit(args)
+        if 'after' in args:
+            filters['after'] = _page_key(args['after'])
+    return filters
+
+
+def _page_limit(args):
+    try:
+        limit = int(args.get('limit', app.config['OBSERVATION_PAGE_SIZE']))
+    except ValueError:
+        raise InvalidFilter('Invalid limit.')
+    if not 0 < limit <= app.config['OBSERVATION_PAGE_MAX']:
+        raise InvalidFilter('Invalid limit, at most {}.'.format(
+            app.config['OBSERVATION_PAGE_MAX']))
+    return limit
+
+
+def _page_key(after):
+    created, _, observation_id = after.rpartition(',')
+    try:
+        return (datetime.strptime(created, '%Y-%m-%dT%H:%M:%S.%f'),
+                uuid.UUID(observation_id))
+    except ValueError:
+        raise InvalidFilter('Invalid after.')
+
+
+def _next_page(observations, limit):
+    '''The after key of the page following observations, None for the
+    last page.'''
+    if len(observations) < limit:
+        return None
+    last = observations[-1]
+    return '{:%Y-%m-%dT%H:%M:%S.%f},{}'.format(
+        last.created, last.observation_id)
+
+
 @api.route('/v1')
 class Root(Resource):
 
@@ -83,11 +325,9 @@ class Users(Resource):
 
     def post(self):
         data = request.get_json()
-        user = bm.User(data['credentials'], data['secret'])
-        db.session.add(user)
+        user_id = bm.User(data['credentials'], data['secret']).insert()
         db.session.commit()
-        db.session.refresh(user)
-        return _success_item(user.user_id, status_code=201)
+        return _success_item(user_id, status_code=201)
 
     def get(self):
         # TODO: check admin
@@ -97,9 +337,7 @@ class Users(Resource):
 
     def delete(self):
         # TODO: check admin
-        count = bm.User.delete_all()
-        db.session.commit()
-        return _success_item(count)
+        return _queue_delete('User')
 
 
 @api.route('/v1/users/<uuid:user_id>')
@@ -114,23 +352,23 @@ class User(Resource):
 @api.route('/v1/sessions')
 class Sessions(Resource):
 
+    @rate_limited('sessions')
     def post(self):
         data = request.get_json()
         user = bm.User.find_by_credentials(
             data['credentials'], data['secret'])
         if user is None:
             return _error(message='No user.', status_code=403)
-        ses = bm.Session(user, data.get('tokens'))
-        db.session.add(ses)
+        stored = user.secrets  # expired by the commit
+        session_id = bm.Session(user, data.get('tokens')).insert()
         db.session.commit()
-        db.session.refresh(ses)
-        return _success_item(ses.session_id)
+        if user.upgrade_secret(data['secret'], stored):
+            db.session.commit()
+        return _success_item(session_id)
 
     def delete(self):
         # TODO: Admin
-        count = bm.Session.delete_all()
-        db.session.commit()
-        return _success_item(count)
+        return _queue_delete('Session')
 
 
 @api.route('/v1/sessions/<uuid:session_id>')
@@ -153,35 +391,42 @@ class Observations(Resource):
 
     def get(self):
         # TODO: check admin
-        observations = bm.Observation.find_all()
-        return _success_data(count=len(observations), data=[
-            o.as_public_dict() for o in observations])
+        try:
+            filters = _observation_filters(request.args, page=True)
+        except InvalidFilter as e:
+            return _error(str(e), 400)
+        observations = bm.Observation.find_filtered(**filters)
+        return _success(
+            count=str(len(observations)),
+            data=[o.as_public_dict() for o in observations],
+            next=_next_page(observations, filters['limit']))
 
+    @rate_limited('observations')
     def post(self):
         data = request.get_json()
         user = bm.User.find_by_credentials(
             data.get('credentials'), data.get('secret'))
         if user is None:
             return _error('No user.', 403)
+        stored = user.secrets  # expired by the commit
         obs = bm.Observation(user, data.get('geometry'), data.get('media'),
                              data.get('properties'), data.get('species'))
-        db.session.add(obs)
+        observation_id = obs.insert()
         db.session.commit()
-        db.session.refresh(obs)
-        return _success_item(obs.observation_id, status_code=201)
+        if user.upgrade_secret(data.get('secret'), stored):
+            db.session.commit()
+        return _success_item(observation_id, status_code=201)
 
     def delete(self):
         # TODO: Admin
-        count = bm.Observation.delete_all()
-        db.session.commit()
-        return _success_item(count)
+        return _queue_delete('Observation')
 
 
 @api.route('/v1/mapped_observations')
 class MappedObservations(Resource):
 
     def _remap(self, obs):
-        result = obs.as_public_dict()
+        result = obs.as_public_dict(exclude=('geometry',))
         title = ', '.join([
             label for _, label in obs.properties['vision_labels'][:3]])
         if obs.user and obs.user.social and 'nickname' in obs.user.social:
@@ -201,10 +446,46 @@ class MappedObservations(Resource):
         return result
 
     def get(self):
-        mapped = [self._remap(obs) for obs in bm.Observation.find_all()]
+        return _single_flight('observations', self._mapped)
+
+    def _mapped(self):
+        try:
+            filters = _observation_filters(request.args, page=True)
+        except InvalidFilter as e:
+            return _error(str(e), 400)
+        observations = bm.Observation.find_all_mapped(**filters)
+        mapped = [self._remap(obs) for obs in observations]
         return _success(
             200, count=str(len(mapped)), data=mapped,
-            type='FeatureCollection', features=mapped)
+            type='FeatureCollection', features=mapped,
+            next=_next_page(observations, filters['limit']))
+
+
+@api.route('/v1/export/observations.<any(ndjson, csv):fmt>')
+class ObservationsExport(Resource):
+
+    FORMATS = {
+        'ndjson': ('geojson', birdseye.export.ndjson_chunks,
+                   'application/x-ndjson'),
+        'csv': ('wkt', birdseye.export.csv_chunks, 'text/csv'),
+    }
+
+    def get(self, fmt):
+        '''All the observations (or those matching the filters of
+        /v1/observations), streamed as they are read.'''
+        # TODO: check admin
+        try:
+            filters = _observation_filters(request.args)
+        except InvalidFilter as e:
+            return _error(str(e), 400)
+        geometry, encode, mimetype = self.FORMATS[fmt]
+        query = birdseye.export.export_query(geometry, **filters)
+        chunks = birdseye.export.iter_chunks(
+            query, app.config['EXPORT_CHUNK_SIZE'])
+        return Response(
+            stream_with_context(encode(chunks)), mimetype=mimetype,
+            headers={'Content-Disposition':
+                     'attachment; filename=observations.{}'.format(fmt)})
 
 
 @api.route('/v1/observations/<uuid:observation_id>')
@@ -222,30 +503,126 @@ class Observation(Resource):
         return
 
 
+def _process_media(basename):
+    '''Queues the jobs making an observation of the uploaded
+    MEDIA_ROOT/basename, returns its URL.'''
+    path = os.path.join(app.config['MEDIA_ROOT'], basename)
+    url = app.config['MEDIA_URL'] + basename
+    locate_image_job.queue(path, url)
+    return url
+
+
 @api.route('/v1/media')
 class Media(Resource):
 
+    @rate_limited('media')
     def post(self):
+        '''The image in the request body (Content-Type image/jpeg), or in
+        the X-File nginx saved it to.'''
         path = request.headers.get('X-File')
-        url_base = 'https://birdseye.space/static/'
-        url = url_base + 'not-found.jpg'
-        if path is not None:
-            ext = 'jpeg'
-            basename = '{}.{}'.format(bm.new_uuid(), ext)
-            new_path = '/var/www/html/static/{}'.format(basename)
-            os.rename(path, new_path)
-            url = url_base + basename
-
-            chmod_job = rq.get_queue('www-data-chmod').enqueue(
-                birdseye_jobs.chmod.chmod_file, new_path)
-            image_to_observation.queue(new_path, url, depends_on=chmod_job)
+        if path is None:
+            try:
+                basename = birdseye.uploads.store_stream(
+                    request.stream, request.content_type,
+                    request.content_length)
+            except birdseye.uploads.UploadError as e:
+                return _error(str(e), e.status_code)
+            return _success_item(_process_media(basename))
+        url_base = app.config['MEDIA_URL']
+        ext = 'jpeg'
+        basename = '{}.{}'.format(bm.new_uuid(), ext)
+        new_path = os.path.join(app.config['MEDIA_ROOT'], basename)
+        os.rename(path, new_path)
+        url = url_base + basename
+
+        chmod_job = rq.get_queue('www-data-chmod').enqueue(
+            birdseye_jobs.chmod.chmod_file, new_path)
+        locate_image_job.queue(new_path, url, depends_on=chmod_job)
         return _success_item(url)
 
 
+def _upload_status(upload, offset, status_code=200, **extra):
+    message, status_code = _success_item(dict(
+        upload_id=upload.upload_id, offset=offset, length=upload.length,
+        **extra), status_code)
+    return message, status_code, {'Upload-Offset': str(offset)}
+
+
+@api.route('/v1/uploads')
+class Uploads(Resource):
+
+    @rate_limited('media')
+    def post(self):
+        '''Starts a resumable upload of an Upload-Length bytes image of
+        Upload-Type (e.g. image/jpeg), appended to with PATCH requests.'''
+        try:
+            length = int(request.headers['Upload-Length'])
+        except (KeyError, ValueError):
+            return _error('Invalid Upload-Length.', 400)
+        try:
+            upload = birdseye.uploads.Upload.create(
+                request.headers.get('Upload-Type'), length)
+        except birdseye.uploads.UploadError as e:
+            return _error(str(e), e.status_code)
+        return _upload_status(upload, 0, 201)
+
+
+@api.route('/v1/uploads/<uuid:upload_id>')
+class Upload(Resource):
+
+    def get(self, upload_id):
+        '''The offset to resume the upload from (also in Upload-Offset).'''
+        upload = birdseye.uploads.Upload.load(upload_id)
+        if upload is None:
+            return _not_found()
+        return _upload_status(upload, upload.offset)
+
+    def patch(self, upload_id):
+        '''Appends the request body at Upload-Offset. The upload is
+        processed once complete, its media URL is returned.'''
+        upload = birdseye.uploads.Upload.load(upload_id)
+        if upload is None:
+            return _not_found()
+        try:
+            offset = int(request.headers['Upload-Offset'])
+        except (KeyError, ValueError):
+            return _error('Invalid Upload-Offset.', 400)
+        try:
+            offset = upload.append(request.stream, offset)
+        except birdseye.uploads.UploadError as e:
+            return _error(str(e), e.status_code)
+        if offset < upload.length:
+            return _upload_status(upload, offset)
+        try:
+            basename = upload.finish()
+        except birdseye.uploads.UploadError as e:
+            upload.cancel()
+            return _error(str(e), e.status_code)
+        return _upload_status(upload, offset, url=_process_media(basename))
+
+    def delete(self, upload_id):
+        upload = birdseye.uploads.Upload.load(upload_id)
+        if upload is None:
+            return _not_found()
+        upload.cancel()
+        return _success_item(upload.upload_id)
+
+
 @api.route('/v1/species')
 class Species(Resource):
 
     def get(self):
+        q = request.args.get('q')
+        if q is not None:
+            try:
+                limit = min(int(request.args.get('limit', 20)), 100)
+            except ValueError:
+                return _error('Invalid limit.', 400)
+            found = birdseye.search.search_species(q, max(limit, 1))
+            return _success_data(count=len(found), data=found)
+        return _single_flight('species', self._all)
+
+    def _all(self):
         species = bm.Species.find_all()
         return _success_data(count=len(species), data=[
             s.as_public_dict() for s in species])
@@ -253,15 +630,86 @@ class Species(Resource):
     def post(self):
         data = request.get_json()
         species = bm.Species(data.get('names'), data.get('labels'))
-        db.session.add(species)
+        species_id = species.insert()
         db.session.commit()
-        db.session.refresh(species)
-        return _success_item(species.species_id, status_code=201)
+        return _success_item(species_id, status_code=201)
 
     def delete(self):
-        count = bm.Species.delete_all()
-        db.session.commit()
-        return _success_item(count)
+        return _queue_delete('Species')
+
+
+@api.route('/v1/admin/metrics')
+class Metrics(Resource):
+
+    def get(self):
+        # TODO: check admin
+        return _success(rate_limit_rejections=rate_limit_rejections.totals())
+
+
+@api.route('/v1/admin/jobs/<job_id>')
+class AdminJob(Resource):
+
+    def get(self, job_id):
+        # TODO: check admin
+        try:
+            job = Job.fetch(job_id, connection=rq.connection)
+        except NoSuchJobError:
+            return _not_found()
+        return _job_status(job)
+
+
+@api.route('/v1/admin/slow_queries')
+class SlowQueries(Resource):
+
+    def get(self):
+        '''The slowest statements of all workers and jobs, newest first,
+        ?limit=<n>.'''
+        # TODO: check admin
+        slow_queries = birdseye.slowlog.slow_queries
+        if slow_queries is None:
+            return _error('The slow query log is off.', 404)
+        try:
+            limit = int(request.args.get('limit', 0)) or None
+        except ValueError:
+            return _error('Invalid limit.', 400)
+        records = slow_queries.records(limit)
+        return _success_data(count=len(records), data=records)
+
+
+@api.route('/v1/admin/profiles')
+class Profiles(Resource):
+
+    def get(self):
+        # TODO: check admin
+        profiles = birdseye.profiler.list_profiles()
+        return _success_data(count=len(profiles), data=profiles)
+
+
+@api.route('/v1/admin/profiles/<name>')
+class Profile(Resource):
+
+    def get(self, name):
+        '''The collapsed stacks, e.g. for flamegraph.pl.'''
+        # TODO: check admin
+        path = birdseye.profiler.profile_path(name)
+        if path is None:
+            return _not_found()
+        return send_file(path, mimetype='text/plain')
+
+
+@api.route('/v1/tiles/<int:z>/<int:x>/<int:y>.mvt')
+class Tile(Resource):
+
+    def get(self, z, x, y):
+        '''Observations in the z/x/y (XYZ scheme) Mapbox Vector Tile, one
+        point feature per observation in layer "observations" with the
+        attributes id, species_id, species (common name) and label (the top
+        vision label).'''
+        if not birdseye.tiles.valid_tile(z, x, y):
+            return _not_found()
+        tile = birdseye.tiles.cache.get(z, x, y)
+        return Response(
+            tile, mimetype='application/vnd.mapbox-vector-tile')
 
 
 def noqa():
@@ -1,8 +1,15 @@
 # -*- coding: utf-8 -*-
 import nose.tools as nt
 import json
+import uuid
+
+import sqlalchemy
+from sqlalchemy.engine import Engine
 
 from birdseye import app
+import birdseye.api
+import birdseye.models as bm
+import birdseye.passwords as passwords
 
 nt.assert_equal.__self__.__class__.maxDiff = None
 
@@ -61,6 +68,28 @@ def assert_ok(code, response):
     return jr
 
 
+class StatementCounter(object):
+    '''Collects the SQL statements run while in the with block.'''
+
+    def __enter__(self):
+        self.statements = []
+        sqlalchemy.event.listen(Engine, 'before_cursor_execute', self._add)
+        return self
+
+    def __exit__(self, *exc_info):
+        sqlalchemy.event.remove(Engine, 'before_cursor_execute', self._add)
+
+    def _add(self, conn, cursor, statement, parameters, context, many):
+        self.statements.append(statement)
+
+
+def assert_statements(counter, *kinds):
+    '''Asserts the statements started with kinds, e.g. 'SELECT', 'INSERT'.'''
+    nt.assert_equal(
+        [statement.split(None, 1)[0] for statement in counter.statements],
+        list(kinds), counter.statements)
+
+
 class UserTest(object):
     def setup(self):
         self.client = BirdsEyeClient(app.test_client())
@@ -81,6 +110,15 @@ class UserTest(object):
         nt.assert_equal(len(resp['data']), 1)
         nt.assert_is_not_none(resp['data'][0])
 
+    @nt.with_setup(setup, teardown)
+    def test_create_user_single_statement(self):
+        with StatementCounter() as counter:
+            assert_ok(201, self.client.post('/v1/users', {
+                'credentials': {'email': 'joe@example.com'},
+                'secret': '12345',
+            }))
+        assert_statements(counter, 'INSERT')
+
     @nt.with_setup(setup, teardown)
     def test_delete_all_users(self):
         self.client.delete('/v1/users')
@@ -96,6 +134,37 @@ class UserTest(object):
 
         self.client.delete('/v1/users')
 
+    @nt.with_setup(setup, teardown)
+    def test_get_user_cached(self):
+        resp = assert_ok(201, self.client.post('/v1/users', {
+            'credentials': {'email': 'joe@example.com'},
+            'secret': '12345',
+        }))
+        url = '/v1/users/{}'.format(resp['data'][0])
+        first = assert_ok(200, self.client.get(url))
+        with StatementCounter() as counter:
+            second = assert_ok(200, self.client.get(url))
+        assert_statements(counter)
+        nt.assert_equal(second['data'], first['data'])
+
+    @nt.with_setup(setup, teardown)
+    def test_soft_delete_users(self):
+        assert_ok(201, self.client.post('/v1/users', {
+            'credentials': {'email': 'joe@example.com'},
+            'secret': '12345',
+        }))
+        # jobs run synchronously in the tests (DEBUG=1)
+        resp = assert_ok(202, self.client.delete('/v1/users?soft=1'))
+        job = resp['data'][0]
+        nt.assert_equal(job['status'], 'finished')
+        nt.assert_equal(job['progress'], {'deleted': 1, 'total': 1})
+        resp = assert_ok(200, self.client.get('/v1/users'))
+        nt.assert_equal(resp['count'], '0')
+        resp = assert_ok(200, self.client.get(
+            '/v1/admin/jobs/{}'.format(job['job_id'])))
+        nt.assert_equal(resp['data'][0]['progress'], job['progress'])
+        assert_error(404, self.client.get('/v1/admin/jobs/unknown'))
+
 
 class SessionTest(object):
 
@@ -128,6 +197,70 @@ class SessionTest(object):
         nt.assert_equal(len(resp['data']), 1)
         nt.assert_is_not_none(resp['data'][0])
 
+    @nt.with_setup(setup, teardown)
+    def test_rate_limit_sessions(self):
+        # a new client (address and user): buckets outlive the test run
+        login = {'credentials': {'email': '{}@example.com'.format(
+            uuid.uuid4().hex)}, 'secret': '12345'}
+        assert_ok(201, self.client.post('/v1/users', login))
+        # as appended by the proxy in front (PROXY_FIX_HOPS)
+        address = '10.{}.{}.{}'.format(*uuid.uuid4().bytes[:3])
+        self.client.headers['X-Forwarded-For'] = address
+        enabled, limits = (app.config['RATE_LIMITS_ENABLED'],
+                           app.config['RATE_LIMITS'])
+        app.config['RATE_LIMITS_ENABLED'] = True
+        app.config['RATE_LIMITS'] = dict(limits, sessions=(0.01, 2))
+        birdseye.api._limiters.clear()
+        try:
+            assert_ok(200, self.client.post('/v1/sessions', login))
+            assert_ok(200, self.client.post('/v1/sessions', login))
+            response = self.client.post('/v1/sessions', login)
+            assert_error(429, response)
+            nt.assert_true(int(response.headers['Retry-After']) > 0)
+            # another user from the same address, which the entries the
+            # client adds itself do not change
+            self.client.headers['X-Forwarded-For'] = '10.0.0.2, ' + address
+            other = {'credentials': {'email': 'other@example.com'},
+                     'secret': '12345'}
+            assert_error(429, self.client.post('/v1/sessions', other))
+            resp = assert_ok(200, self.client.get('/v1/admin/metrics'))
+            nt.assert_true(resp['rate_limit_rejections']['sessions'] >= 1)
+        finally:
+            app.config['RATE_LIMITS_ENABLED'] = enabled
+            app.config['RATE_LIMITS'] = limits
+            birdseye.api._limiters.clear()
+
+    @nt.with_setup(setup, teardown)
+    def test_create_session_single_statement(self):
+        with StatementCounter() as counter:
+            assert_ok(200, self.client.post('/v1/sessions', {
+                'credentials': {'email': 'joe@example.com'},
+                'secret': '12345',
+            }))
+        # the user lookup, then the session
+        assert_statements(counter, 'SELECT', 'INSERT')
+        assert_error(403, self.client.post('/v1/sessions', {
+            'credentials': {'email': 'joe@example.com'},
+            'secret': 'wrong',
+        }))
+
+    @nt.with_setup(setup, teardown)
+    def test_create_session_upgrades_secret(self):
+        with app.app_context():
+            bm.User.query.update(
+                {'secrets': passwords.hash_secret('12345', iterations=1)})
+            birdseye.db.session.commit()
+        with StatementCounter() as counter:
+            assert_ok(200, self.client.post('/v1/sessions', {
+                'credentials': {'email': 'joe@example.com'},
+                'secret': '12345',
+            }))
+        # no refresh of the user expired by the commit, only the rehash
+        assert_statements(counter, 'SELECT', 'INSERT', 'UPDATE')
+        with app.app_context():
+            [user] = bm.User.query.all()
+            nt.assert_false(passwords.needs_rehash(user.secrets))
+
 
 class SpeciesTest(object):
 
@@ -150,6 +283,33 @@ class SpeciesTest(object):
         resp = assert_ok(200, self.client.get('/v1/species'))
         nt.assert_equal(resp['count'], '1')
 
+    @nt.with_setup(setup, teardown)
+    def test_create_species_single_statement(self):
+        with StatementCounter() as counter:
+            assert_ok(201, self.client.post('/v1/species', {
+                'names': {'common': 'grey heron'},
+                'labels': ['bird', 'heron'],
+            }))
+        assert_statements(counter, 'INSERT')
+
+    @nt.with_setup(setup, teardown)
+    def test_search_species(self):
+        assert_ok(201, self.client.post('/v1/species', {
+            'names': {'common': 'grey heron', 'scientific': 'ardea cinerea'},
+            'labels': ['bird', 'heron'],
+        }))
+        resp = assert_ok(200, self.client.get('/v1/species?q=her'))
+        nt.assert_equal(resp['count'], '1')
+        nt.assert_equal(resp['data'][0]['names']['common'], 'grey heron')
+        # prefix matches: both are birds, the shorter catalog term first
+        resp = assert_ok(200, self.client.get('/v1/species?q=bir'))
+        nt.assert_equal(resp['count'], '2')
+        # fuzzy match
+        resp = assert_ok(200, self.client.get('/v1/species?q=pidgon'))
+        nt.assert_equal(resp['count'], '1')
+        nt.assert_equal(resp['data'][0]['names']['common'], 'pidgeon')
+        assert_error(400, self.client.get('/v1/species?q=x&limit=many'))
+
 
 class ObservationTest:
 
@@ -177,6 +337,22 @@ class ObservationTest:
     def teardown(self):
         pass
 
+    @nt.with_setup(setup, teardown)
+    def test_create_observation_single_statement(self):
+        observation = {
+            'credentials': {'email': 'joe@example.com'},
+            'secret': '12345',
+            'geometry': 'POLYGON((26 44, 26.1 44.1, 26.2 44, 26 44))',
+            'media': {},
+        }
+        with StatementCounter() as counter:
+            assert_ok(201, self.client.post('/v1/observations', observation))
+        assert_statements(counter, 'SELECT', 'INSERT')
+        observation['secret'] = 'wrong'
+        assert_error(403, self.client.post('/v1/observations', observation))
+        resp = assert_ok(200, self.client.get('/v1/observations'))
+        nt.assert_equal(resp['count'], '2')
+
     @nt.with_setup(setup, teardown)
     def test_get_observations(self):
         resp = assert_ok(200, self.client.get('/v1/mapped_observations'))
@@ -211,3 +387,70 @@ class ObservationTest:
         resp = assert_ok(200, self.client.get('/v1/observations/{}'.format(
             self.obs_id)))
         nt.assert_equal(resp['count'], '1')
+
+    @nt.with_setup(setup, teardown)
+    def test_export_observations(self):
+        resp = self.client.get('/v1/export/observations.ndjson?label=bird')
+        nt.assert_equal(resp.status_code, 200)
+        nt.assert_equal(resp.content_type, 'application/x-ndjson')
+        lines = resp.get_data(as_text=True).splitlines()
+        nt.assert_equal(len(lines), 1)
+        row = json.loads(lines[0])
+        nt.assert_equal(row['observation_id'], self.obs_id)
+        nt.assert_equal(row['labels'], ['bird', 'blue'])
+        nt.assert_equal(row['geometry']['type'], 'Polygon')
+        resp = self.client.get('/v1/export/observations.csv')
+        nt.assert_equal(resp.status_code, 200)
+        lines = resp.get_data(as_text=True).splitlines()
+        nt.assert_equal(len(lines), 2)
+        nt.assert_true(lines[0].startswith('observation_id,'))
+        nt.assert_true(lines[1].startswith(self.obs_id))
+        assert_error(400, self.client.get(
+            '/v1/export/observations.csv?since=yesterday'))
+
+    @nt.with_setup(setup, teardown)
+    def test_filter_observations(self):
+        resp = assert_ok(200, self.client.get('/v1/observations?label=Bird'))
+        nt.assert_equal(resp['count'], '1')
+        resp = assert_ok(200, self.client.get(
+            '/v1/mapped_observations?label=bird&label=blue'))
+        nt.assert_equal(resp['count'], '1')
+        resp = assert_ok(200, self.client.get(
+            '/v1/mapped_observations?label=heron'))
+        nt.assert_equal(resp['count'], '0')
+        resp = assert_ok(200, self.client.get(
+            '/v1/observations?since=2000-01-01T00:00:00Z&until=2000-01-02'))
+        nt.assert_equal(resp['count'], '0')
+        resp = assert_ok(200, self.client.get(
+            '/v1/observations?species_id={}'.format(uuid.UUID(int=0))))
+        nt.assert_equal(resp['count'], '0')
+        assert_error(400, self.client.get('/v1/observations?user_id=joe'))
+        assert_error(400, self.client.get('/v1/observations?since=yesterday'))
+
+    @nt.with_setup(setup, teardown)
+    def test_page_observations(self):
+        for lon in (26, 27):
+            assert_ok(201, self.client.post('/v1/observations', {
+                'credentials': {'email': 'joe@example.com'},
+                'secret': '12345',
+                'geometry': 'POLYGON(({0} 44, {0} 44.1, 26.2 44, {0} 44))'
+                            .format(lon),
+                'media': {},
+            }))
+        first = assert_ok(200, self.client.get('/v1/observations?limit=2'))
+        nt.assert_equal(first['count'], '2')
+        nt.assert_is_not_none(first['next'])
+        last = assert_ok(200, self.client.get(
+            '/v1/observations?limit=2&after={}'.format(first['next'])))
+        nt.assert_equal(last['count'], '1')
+        nt.assert_is_none(last['next'])
+        ids = [o['observation_id'] for o in first['data'] + last['data']]
+        nt.assert_equal(len(set(ids)), 3)
+        mapped = assert_ok(200, self.client.get(
+            '/v1/mapped_observations?limit=1&after={}'.format(
+                first['next'])))
+        nt.assert_equal(mapped['data'][0]['id'], ids[2])
+        for query in ('limit=0', 'limit=many', 'limit=1000000',
+                      'after=2017-04-01', 'after=2017-04-01T00:00:00.0,joe'):
+            assert_error(400, self.client.get(
+                '/v1/observations?{}'.format(query)))
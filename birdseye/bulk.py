@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+'''
+Bulk ingest
+-----------
+
+Array versions of the geometry helpers in birdseye.jobs, for backfills and
+imports. Geometries of a whole batch are packed as (E)WKB by NumPy, there is
+no per point string formatting and PostGIS does not parse WKT.
+
+Requires the ``bulk`` extra (NumPy).
+'''
+import numpy as np
+from sqlalchemy import bindparam, func, LargeBinary
+
+import birdseye.models as bm
+from birdseye.jobs import IFD
+
+
+# (E)WKB geometry type codes, little endian byte order
+WKB_NDR = 1
+WKB_POINT = 1
+WKB_POLYGON = 3
+EWKB_SRID_FLAG = 0x20000000
+
+# vertices of the diamond built by birdseye.jobs.make_poly
+POLY = np.array(
+    [(-1.0, 0.0), (0.0, 1.0), (1.0, 0.0), (0.0, -1.0), (-1.0, 0.0)])
+
+DMS = np.array([1.0, 60.0, 3600.0])
+
+
+def dms_as_float(arcs, negative):
+    '''arcs: (N, 3, 2) degrees, minutes, seconds as EXIF rationals
+    negative: (N,) bools (south or west)
+    Returns (N,) floats, as birdseye.jobs.dms_as_float.'''
+    arcs = np.asarray(arcs, dtype=np.float64)
+    sign = np.where(np.asarray(negative, dtype=bool), -1.0, 1.0)
+    return sign * (arcs[..., 0] / arcs[..., 1] / DMS).sum(axis=-1)
+
+
+def _header(srid):
+    fields = [('order', 'u1'), ('type', '<u4')]
+    if srid is not None:
+        fields.append(('srid', '<u4'))
+    return fields
+
+
+def _pack(records, srid, type_code):
+    records['order'] = WKB_NDR
+    if srid is None:
+        records['type'] = type_code
+    else:
+        records['type'] = type_code | EWKB_SRID_FLAG
+        records['srid'] = srid
+    buf = records.tobytes()
+    size = records.dtype.itemsize
+    return [buf[i:i + size] for i in range(0, len(buf), size)]
+
+
+def points_ewkb(lon, lat, srid=None):
+    '''One POINT (E)WKB per lon, lat pair. Plain WKB when srid is None.'''
+    lon, lat = np.broadcast_arrays(
+        np.asarray(lon, dtype=np.float64), np.asarray(lat, dtype=np.float64))
+    records = np.empty(lon.shape[0], dtype=_header(srid) + [
+        ('x', '<f8'), ('y', '<f8')])
+    records['x'] = lon
+    records['y'] = lat
+    return _pack(records, srid, WKB_POINT)
+
+
+def polys_ewkb(lon, lat, radius, srid=None):
+    '''One diamond POLYGON (E)WKB per lon, lat pair, the same vertices as
+    birdseye.jobs.make_poly. radius may be a scalar or an array.'''
+    lon, lat, radius = np.broadcast_arrays(
+        np.asarray(lon, dtype=np.float64), np.asarray(lat, dtype=np.float64),
+        np.asarray(radius, dtype=np.float64))
+    records = np.empty(lon.shape[0], dtype=_header(srid) + [
+        ('rings', '<u4'), ('points', '<u4'), ('xy', '<f8', POLY.shape)])
+    records['rings'] = 1
+    records['points'] = len(POLY)
+    records['xy'][..., 0] = lon[:, None] + POLY[:, 0] * radius[:, None]
+    records['xy'][..., 1] = lat[:, None] + POLY[:, 1] * radius[:, None]
+    return _pack(records, srid, WKB_POLYGON)
+
+
+def read_exif_gps(file_paths):
+    '''(lon, lat, found) arrays for the EXIF GPS tags of file_paths, found is
+    False (and lon, lat NaN) for images without GPS data.'''
+    import piexif
+
+    n = len(file_paths)
+    arcs = np.ones((2, n, 3, 2))
+    negative = np.zeros((2, n), dtype=bool)
+    found = np.zeros(n, dtype=bool)
+    for i, path in enumerate(file_paths):
+        gps = piexif.load(path).get(IFD, {})
+        gps = {piexif.TAGS[IFD][tag]['name']: val for tag, val in gps.items()}
+        try:
+            arcs[0, i] = gps['GPSLongitude']
+            arcs[1, i] = gps['GPSLatitude']
+            negative[0, i] = gps['GPSLongitudeRef'] != 'E'
+            negative[1, i] = gps['GPSLatitudeRef'] != 'N'
+        except (KeyError, ValueError):
+            continue
+        found[i] = True
+    lon = np.where(found, dms_as_float(arcs[0], negative[0]), np.nan)
+    lat = np.where(found, dms_as_float(arcs[1], negative[1]), np.nan)
+    return lon, lat, found
+
+
+def observation_rows(lon, lat, radius, media, properties, user_id=None,
+                     species_id=None):
+    '''Insert parameters for insert_observations, one dict per observation.
+    media and properties are sequences of dicts (one per observation).'''
+    lon = np.asarray(lon, dtype=np.float64)
+    lat = np.asarray(lat, dtype=np.float64)
+    radius = np.broadcast_to(np.asarray(radius, dtype=np.float64), lon.shape)
+    geometries = polys_ewkb(lon, lat, radius)
+    locations = points_ewkb(lon, lat)
+    return [{
+        'observation_id': bm.new_uuid(),
+        'user_id': user_id,
+        'species_id': species_id,
+        'geometry_ewkb': geometries[i],
+        'location_ewkb': locations[i],
+        'accuracy': float(radius[i]),
+        'geometry_center': {
+            'type': 'Point', 'coordinates': [float(lon[i]), float(lat[i])]},
+        'media': media[i],
+        'properties': properties[i],
+        'labels': bm.label_names(properties[i]),
+    } for i in range(len(lon))]
+
+
+def insert_observations(connection, rows, batch_size=1000):
+    '''Inserts observation_rows with one executemany per batch_size rows.
+    Returns the number of rows inserted. Cached vector tiles are not
+    invalidated, bulk loads are expected to run before serving.'''
+    table = bm.Observation.__table__
+    statement = table.insert().values(
+        geometry=func.ST_GeomFromEWKB(
+            bindparam('geometry_ewkb', type_=LargeBinary)),
+        location=func.ST_GeomFromEWKB(
+            bindparam('location_ewkb', type_=LargeBinary)))
+    for start in range(0, len(rows), batch_size):
+        connection.execute(statement, rows[start:start + batch_size])
+    return len(rows)
@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+
+import re
+import struct
+
+import numpy as np
+import nose.tools as nt
+
+import birdseye.bulk as bulk
+import birdseye.jobs as jobs
+
+
+def _wkt_coords(wkt):
+    return [float(n) for n in re.findall(r'-?\d+(?:\.\d+)?(?:e-?\d+)?', wkt)]
+
+
+class BulkGeometryTest(object):
+
+    def setup(self):
+        rnd = np.random.RandomState(1729)
+        self.lon = rnd.uniform(-180, 180, 50)
+        self.lat = rnd.uniform(-90, 90, 50)
+
+    @nt.with_setup(setup)
+    def test_dms_as_float(self):
+        arcs = [((33, 1), (52, 1), (129675, 4096)),
+                ((116, 1), (18, 1), (24, 2)),
+                ((0, 1), (0, 1), (1, 100))]
+        negative = [False, True, True]
+        batch = bulk.dms_as_float(arcs, negative)
+        for i, arc in enumerate(arcs):
+            nt.assert_almost_equal(
+                batch[i], jobs.dms_as_float(arc, negative[i]), places=12)
+
+    @nt.with_setup(setup)
+    def test_points_match_scalar(self):
+        for i, wkb in enumerate(bulk.points_ewkb(self.lon, self.lat)):
+            order, kind, x, y = struct.unpack('<BIdd', wkb)
+            nt.assert_equal((order, kind), (1, 1))
+            nt.assert_equal(
+                [x, y], _wkt_coords(jobs.make_point(self.lon[i], self.lat[i])))
+
+    @nt.with_setup(setup)
+    def test_points_srid(self):
+        wkb = bulk.points_ewkb([1.5], [2.0], srid=4326)[0]
+        nt.assert_equal(struct.unpack('<BIIdd', wkb),
+                        (1, 0x20000001, 4326, 1.5, 2.0))
+
+    @nt.with_setup(setup)
+    def test_polys_match_scalar(self):
+        radius = 0.00001
+        for i, wkb in enumerate(bulk.polys_ewkb(self.lon, self.lat, radius)):
+            header = struct.unpack('<BIII', wkb[:13])
+            nt.assert_equal(header, (1, 3, 1, 5))
+            coords = list(struct.unpack('<10d', wkb[13:]))
+            nt.assert_equal(coords, _wkt_coords(
+                jobs.make_poly(self.lon[i], self.lat[i], radius)))
@@ -0,0 +1,283 @@
+# -*- coding: utf-8 -*-
+'''
+Caching building blocks
+-----------------------
+
+* LRUCache - a bounded, process local mapping.
+* Generations - version counters shared by all workers through Redis. A
+  process local cache entry stores the generation it was computed at and is
+  stale once the shared counter moved on. Without Redis the counters read as
+  0 and invalidation only reaches the local process.
+* SingleFlight - concurrent identical computations in the greenlets of a
+  gevent worker share one run and its result (not thread safe).
+* ReadThrough - looks keys up in a list of stores, fastest first (e.g. a
+  LocalStore then a RedisStore shared by all workers), and loads and stores
+  the missing ones.
+
+'''
+from collections import OrderedDict
+import logging
+import threading
+import time
+
+from gevent.event import AsyncResult
+from redis.exceptions import RedisError
+
+
+log = logging.getLogger('cache')
+
+_MISSING = object()
+# the value of a deleted key in Redis, for TOMBSTONE_TTL seconds: longer
+# than a load takes, so that a load started before the delete is not stored
+TOMBSTONE = b'\x00'
+TOMBSTONE_TTL = 10
+
+
+class LRUCache(object):
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            value = self._data.get(key, _MISSING)
+            if value is _MISSING:
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            return self._data.pop(key, default)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def keys(self):
+        with self._lock:
+            return list(self._data)
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+
+class Generations(object):
+    '''Named counters in Redis under ``birdseye:gen:<namespace>:``.
+
+    connection: a redis client or a callable returning one (resolved lazily,
+    so that forked workers do not share sockets).'''
+
+    def __init__(self, namespace, connection):
+        self.prefix = 'birdseye:gen:{}:'.format(namespace)
+        self._connection = connection
+
+    @property
+    def connection(self):
+        conn = self._connection
+        return conn() if callable(conn) else conn
+
+    def get(self, *names):
+        '''The current generations of ``names``, as a list of ints.'''
+        try:
+            values = self.connection.mget(
+                [self.prefix + str(n) for n in names])
+        except RedisError as e:
+            log.warning('Generations unavailable: %s', e)
+            return [0] * len(names)
+        return [int(v or 0) for v in values]
+
+    def bump(self, *names):
+        '''Moves ``names`` to a new generation, staling every cached copy.'''
+        if not names:
+            return
+        try:
+            pipe = self.connection.pipeline(transaction=False)
+            for name in names:
+                pipe.incr(self.prefix + str(name))
+            pipe.execute()
+        except RedisError as e:
+            log.warning('Generations not bumped: %s', e)
+
+
+class SingleFlight(object):
+    '''Calls of do() with the same key while one is in flight wait for it
+    and get its result (or exception) instead of computing their own. A
+    result is reused for ``stale`` seconds after it was computed, unless
+    the key's namespace is forgotten.
+
+    Keys are (namespace, ...) tuples. For the greenlets of one process:
+    waiting on another thread's computation is not supported.'''
+
+    def __init__(self, stale=0.0, maxsize=256):
+        self.stale = stale
+        self._flights = {}
+        self._recent = LRUCache(maxsize)
+        # namespace: times forgotten, a computation started before the last
+        # forget() may have read what was written since
+        self._generations = {}
+        self.computed = 0
+        self.shared = 0
+
+    def do(self, key, compute):
+        recent = self._recent.get(key)
+        if recent is not None and recent[0] > time.monotonic():
+            self.shared += 1
+            return recent[1]
+        generation = self._generations.get(key[0], 0)
+        flight = self._flights.get(key)
+        if flight is not None and flight[0] == generation:
+            self.shared += 1
+            return flight[1].get()
+        result = AsyncResult()
+        flight = self._flights[key] = (generation, result)
+        self.computed += 1
+        try:
+            value = compute()
+        except BaseException as e:
+            # waiters must not hang on a killed or timed out computation
+            result.set_exception(e)
+            raise
+        finally:
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+        if self.stale > 0 and \
+                self._generations.get(key[0], 0) == generation:
+            self._recent.set(key, (time.monotonic() + self.stale, value))
+        result.set(value)
+        return value
+
+    def forget(self, namespace):
+        '''Drops the reusable results of namespace (e.g. after a write).
+        Computations in flight finish for their waiters but are neither
+        joined nor reused afterwards.'''
+        self._generations[namespace] = self._generations.get(namespace, 0) + 1
+        for key in self._recent.keys():
+            if key[0] == namespace:
+                self._recent.pop(key)
+
+
+class LocalStore(object):
+    '''A process local store whose entries expire after ttl seconds: other
+    workers' writes are seen within ttl. delete() leaves a tombstone for
+    tombstone_ttl seconds: a value loaded before the delete, set after it,
+    is not stored.'''
+
+    def __init__(self, maxsize, ttl, tombstone_ttl=TOMBSTONE_TTL):
+        self.ttl = ttl
+        self.tombstone_ttl = tombstone_ttl
+        self.lru = LRUCache(maxsize)
+
+    def get(self, key):
+        entry = self.lru.get(key)
+        if entry is None or entry[0] <= time.monotonic() or \
+                entry[1] is _MISSING:
+            return None
+        return entry[1]
+
+    def set(self, key, value):
+        entry = self.lru.get(key)
+        if entry is not None and entry[1] is _MISSING and \
+                entry[0] > time.monotonic():
+            return
+        self.lru.set(key, (time.monotonic() + self.ttl, value))
+
+    def delete(self, *keys):
+        expires = time.monotonic() + self.tombstone_ttl
+        for key in keys:
+            self.lru.set(key, (expires, _MISSING))
+
+
+class RedisStore(object):
+    '''Bytes values in Redis under ``birdseye:<namespace>:<key>``, shared by
+    all workers, expiring after ttl seconds. Redis errors read as misses.
+    delete() leaves a tombstone for tombstone_ttl seconds, which set() does
+    not overwrite (SET NX).
+
+    connection: a redis client or a callable returning one.'''
+
+    def __init__(self, namespace, connection, ttl,
+                 tombstone_ttl=TOMBSTONE_TTL):
+        self.prefix = 'birdseye:{}:'.format(namespace)
+        self._connection = connection
+        self.ttl = ttl
+        self.tombstone_ttl = tombstone_ttl
+
+    @property
+    def connection(self):
+        conn = self._connection
+        return conn() if callable(conn) else conn
+
+    def get(self, key):
+        try:
+            value = self.connection.get(self.prefix + key)
+        except RedisError as e:
+            log.warning('Cache unavailable: %s', e)
+            return None
+        return None if value == TOMBSTONE else value
+
+    def set(self, key, value):
+        try:
+            self.connection.set(self.prefix + key, value, ex=self.ttl,
+                                nx=True)
+        except RedisError as e:
+            log.warning('Cache not written: %s', e)
+
+    def delete(self, *keys):
+        if not keys:
+            return
+        try:
+            pipe = self.connection.pipeline(transaction=False)
+            for key in keys:
+                pipe.set(self.prefix + key, TOMBSTONE,
+                         ex=self.tombstone_ttl)
+            pipe.execute()
+        except RedisError as e:
+            log.warning('Cache not invalidated: %s', e)
+
+
+class ReadThrough(object):
+    '''get() answers from the first store having the key, filling the
+    faster stores that missed it, or calls load() and fills all of them.
+    None values are not cached. invalidate() leaves tombstones: a load
+    racing with it does not store what it read before the write.'''
+
+    def __init__(self, stores):
+        self.stores = stores
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, load):
+        for i, store in enumerate(self.stores):
+            value = store.get(key)
+            if value is not None:
+                self.hits += 1
+                for faster in self.stores[:i]:
+                    faster.set(key, value)
+                return value
+        self.misses += 1
+        value = load()
+        if value is not None:
+            for store in self.stores:
+                store.set(key, value)
+        return value
+
+    def invalidate(self, *keys):
+        for store in self.stores:
+            store.delete(*keys)
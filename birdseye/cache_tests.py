@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+from unittest.mock import MagicMock
+
+import gevent
+import nose.tools as nt
+
+from birdseye.cache import (
+    LRUCache, SingleFlight, LocalStore, RedisStore, ReadThrough, TOMBSTONE)
+
+
+def test_lru_evicts_least_recently_used():
+    cache = LRUCache(2)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    nt.assert_equal(cache.get('a'), 1)
+    cache.set('c', 3)
+    nt.assert_equal(cache.keys(), ['a', 'c'])
+
+
+def test_single_flight_shares_concurrent_calls():
+    flights = SingleFlight()
+    calls = []
+
+    def compute():
+        calls.append(1)
+        gevent.sleep(0.01)
+        return 'result'
+
+    greenlets = [gevent.spawn(flights.do, ('ns', 1), compute)
+                 for _ in range(10)]
+    gevent.joinall(greenlets)
+    nt.assert_equal([g.value for g in greenlets], ['result'] * 10)
+    nt.assert_equal(len(calls), 1)
+    # nothing in flight and no staleness: computed again
+    flights.do(('ns', 1), compute)
+    nt.assert_equal(len(calls), 2)
+
+
+def test_single_flight_shares_exceptions():
+    flights = SingleFlight()
+
+    def compute():
+        gevent.sleep(0.01)
+        raise ValueError('boom')
+
+    greenlets = [gevent.spawn(flights.do, ('ns', 1), compute)
+                 for _ in range(3)]
+    gevent.joinall(greenlets)
+    for g in greenlets:
+        nt.assert_is_instance(g.exception, ValueError)
+
+
+def test_single_flight_stale_and_forget():
+    flights = SingleFlight(stale=60)
+    calls = []
+
+    def compute():
+        calls.append(1)
+        return len(calls)
+
+    nt.assert_equal(flights.do(('ns', 1), compute), 1)
+    nt.assert_equal(flights.do(('ns', 1), compute), 1)
+    nt.assert_equal(flights.do(('ns', 2), compute), 2)
+    flights.forget('other')
+    nt.assert_equal(flights.do(('ns', 1), compute), 1)
+    flights.forget('ns')
+    nt.assert_equal(flights.do(('ns', 1), compute), 3)
+
+
+def test_single_flight_forget_in_flight():
+    flights = SingleFlight(stale=60)
+    calls = []
+
+    def compute():
+        calls.append(1)
+        count = len(calls)
+        gevent.sleep(0.01)
+        return count
+
+    first = gevent.spawn(flights.do, ('ns', 1), compute)
+    gevent.sleep(0)
+    flights.forget('ns')  # a write while the first computation runs
+    second = gevent.spawn(flights.do, ('ns', 1), compute)
+    gevent.joinall([first, second])
+    nt.assert_equal((first.value, second.value), (1, 2))
+    # only the computation started after the write is reused
+    nt.assert_equal(flights.do(('ns', 1), compute), 2)
+
+
+def test_read_through_fills_faster_stores():
+    local, shared = LocalStore(10, 60), LocalStore(10, 60)
+    cache = ReadThrough([local, shared])
+    loads = []
+
+    def load():
+        loads.append(1)
+        return b'value'
+
+    nt.assert_equal(cache.get('k', load), b'value')
+    nt.assert_equal(cache.get('k', load), b'value')
+    nt.assert_equal(len(loads), 1)
+    local.lru.pop('k')  # e.g. expired in this worker
+    nt.assert_equal(cache.get('k', load), b'value')
+    nt.assert_equal(local.get('k'), b'value')
+    nt.assert_equal((cache.hits, cache.misses, len(loads)), (2, 1, 1))
+    cache.invalidate('k')
+    nt.assert_equal(cache.get('k', load), b'value')
+    nt.assert_equal(len(loads), 2)
+    nt.assert_is_none(cache.get('missing', lambda: None))
+    nt.assert_is_none(shared.get('missing'))
+
+
+def test_local_store_expires():
+    store = LocalStore(10, 0)
+    store.set('k', b'value')
+    nt.assert_is_none(store.get('k'))
+
+
+def test_read_through_drops_loads_racing_invalidate():
+    local, shared = LocalStore(10, 60), LocalStore(10, 60)
+    cache = ReadThrough([local, shared])
+
+    def load():
+        # the row changes and its commit invalidates while this load runs
+        cache.invalidate('k')
+        return b'old'
+
+    nt.assert_equal(cache.get('k', load), b'old')
+    nt.assert_is_none(local.get('k'))
+    nt.assert_is_none(shared.get('k'))
+    nt.assert_equal(cache.get('k', lambda: b'new'), b'new')
+
+
+def test_local_store_tombstone_expires():
+    store = LocalStore(10, 60, tombstone_ttl=0)
+    store.delete('k')
+    store.set('k', b'value')
+    nt.assert_equal(store.get('k'), b'value')
+
+
+def test_redis_store_tombstones():
+    connection = MagicMock()
+    store = RedisStore('entities', lambda: connection, 300, tombstone_ttl=10)
+    connection.get.return_value = TOMBSTONE
+    nt.assert_is_none(store.get('users:1'))
+    store.set('users:1', b'{}')
+    connection.set.assert_called_once_with(
+        'birdseye:entities:users:1', b'{}', ex=300, nx=True)
+    store.delete('users:1')
+    pipe = connection.pipeline.return_value
+    pipe.set.assert_called_once_with(
+        'birdseye:entities:users:1', TOMBSTONE, ex=10)
+    pipe.execute.assert_called_once_with()
@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+'''
+Bulk export
+-----------
+
+Observations are read through a server side cursor, EXPORT_CHUNK_SIZE rows
+at a time, and written out chunk by chunk: memory stays constant whatever
+the size of the table.
+
+* NDJSON and CSV are streamed by ``GET /v1/export/observations.<format>``.
+* GeoParquet (geometry as WKB, one row group per chunk) is written by
+  ``birdseye export_observations``, for large offline jobs. Requires the
+  ``export`` extra (pyarrow).
+'''
+import csv
+import io
+import json
+
+import sqlalchemy
+from sqlalchemy import func
+from sqlalchemy.dialects.postgresql import JSONB
+
+from birdseye import db
+import birdseye.models as bm
+
+
+COLUMNS = ['observation_id', 'user_id', 'species_id', 'created', 'lon',
+           'lat', 'accuracy', 'labels', 'media', 'properties', 'geometry']
+
+GEOMETRY = {
+    'geojson': lambda g: sqlalchemy.cast(func.ST_AsGeoJSON(g), JSONB),
+    'wkt': func.ST_AsText,
+    'wkb': func.ST_AsBinary,
+}
+
+
+def export_query(geometry='geojson', **filters):
+    '''The COLUMNS of the observations matching filters (see
+    Observation.query_filtered), with geometry encoded as GEOMETRY.'''
+    o = bm.Observation
+    query = o.query_filtered(**filters).with_entities(
+        o.observation_id, o.user_id, o.species_id, o.created,
+        func.ST_X(o.location), func.ST_Y(o.location), o.accuracy,
+        o.labels, o.media, o.properties,
+        GEOMETRY[geometry](o.geometry))
+    return query.order_by(o.created)
+
+
+def iter_chunks(query, chunk_size, session=None):
+    '''Lists of at most chunk_size rows of query, from a server side
+    cursor of session (by default the request's).'''
+    session = session or db.session
+    # mapper and clause: routed to a replica when reading from one
+    connection = session.connection(
+        mapper=bm.Observation, clause=query.statement,
+        execution_options={'stream_results': True})
+    result = connection.execute(query.statement)
+    try:
+        while True:
+            rows = result.fetchmany(chunk_size)
+            if not rows:
+                return
+            yield rows
+    finally:
+        result.close()
+
+
+def _values(row):
+    values = list(row)
+    values[3] = values[3].isoformat()  # created
+    return values
+
+
+def ndjson_chunks(chunks):
+    '''One JSON object per line, encoded a chunk at a time.'''
+    for rows in chunks:
+        yield ''.join(
+            json.dumps(dict(zip(COLUMNS, _values(row))),
+                       ensure_ascii=False) + '\n'
+            for row in rows).encode('utf8')
+
+
+def csv_chunks(chunks):
+    '''A header line then the rows, encoded a chunk at a time: labels
+    separated by ";", media and properties as JSON, geometry as WKT.'''
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    writer.writerow(COLUMNS)
+    for rows in chunks:
+        for row in rows:
+            values = _values(row)
+            values[7] = ';'.join(values[7] or ())
+            values[8] = json.dumps(values[8], ensure_ascii=False)
+            values[9] = json.dumps(values[9], ensure_ascii=False)
+            writer.writerow(values)
+        yield buf.getvalue().encode('utf8')
+        buf.seek(0)
+        buf.truncate()
+    if buf.tell():
+        yield buf.getvalue().encode('utf8')
+
+
+def write_geoparquet(path, chunk_size, session=None, **filters):
+    '''Writes the observations matching filters to a GeoParquet file, read
+    in session (by default the request's), returns the number of rows.'''
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    geo = {
+        'version': '1.0.0',
+        'primary_column': 'geometry',
+        'columns': {'geometry': {
+            'encoding': 'WKB', 'geometry_types': ['Polygon']}},
+    }
+    schema = pa.schema([
+        ('observation_id', pa.string()),
+        ('user_id', pa.string()),
+        ('species_id', pa.string()),
+        ('created', pa.timestamp('us')),
+        ('lon', pa.float64()),
+        ('lat', pa.float64()),
+        ('accuracy', pa.float64()),
+        ('labels', pa.list_(pa.string())),
+        ('media', pa.string()),
+        ('properties', pa.string()),
+        ('geometry', pa.binary()),
+    ], metadata={'geo': json.dumps(geo)})
+    count = 0
+    with pq.ParquetWriter(path, schema, compression='zstd') as writer:
+        for rows in iter_chunks(export_query('wkb', **filters), chunk_size,
+                                session):
+            columns = [list(column) for column in zip(*rows)]
+            for i in (8, 9):  # media, properties
+                columns[i] = [json.dumps(v) for v in columns[i]]
+            columns[10] = [bytes(g) for g in columns[10]]
+            writer.write_table(
+                pa.Table.from_arrays(columns, schema=schema))
+            count += len(rows)
+    return count
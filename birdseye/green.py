@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+'''
+Cooperative psycopg2 and grpc
+-----------------------------
+
+psycopg2 is a C extension: without a wait callback every query blocks the
+whole process, i.e. all the greenlets of a gevent worker. With the callback
+installed libpq runs in non-blocking mode and waits on the connection
+socket through the gevent hub, so other greenlets run meanwhile.
+
+Only the gevent processes enable it, unless SQLALCHEMY_COOPERATIVE=0: the
+gunicorn workers (birdseye.wsgi) and the gevent rq workers (birdseye.workers).
+The CLI, the tests and the forking workers keep blocking psycopg2. COPY is
+not supported in this mode.
+
+grpc, the transport of the Vision API client, is a C core too: its calls
+block the process unless patch_grpc() ran before its first channel. The
+gevent rq workers patch it.
+'''
+import psycopg2
+from psycopg2 import extensions
+
+from gevent.socket import wait_read, wait_write
+
+
+def gevent_wait_callback(conn, timeout=None):
+    while True:
+        state = conn.poll()
+        if state == extensions.POLL_OK:
+            break
+        elif state == extensions.POLL_READ:
+            wait_read(conn.fileno(), timeout=timeout)
+        elif state == extensions.POLL_WRITE:
+            wait_write(conn.fileno(), timeout=timeout)
+        else:
+            raise psycopg2.OperationalError(
+                'Bad result from poll: {!r}'.format(state))
+
+
+def patch_psycopg():
+    '''Makes every psycopg2 connection opened from now on cooperative.'''
+    extensions.set_wait_callback(gevent_wait_callback)
+
+
+def unpatch_psycopg():
+    extensions.set_wait_callback(None)
+
+
+def is_patched():
+    return extensions.get_wait_callback() is gevent_wait_callback
+
+
+def patch_grpc():
+    '''Makes the grpc calls of this process cooperative. False when grpc
+    is not installed (the Vision client then uses HTTP, cooperative through
+    the monkey patched sockets).'''
+    try:
+        from grpc.experimental import gevent as grpc_gevent
+    except ImportError:
+        return False
+    grpc_gevent.init_gevent()
+    return True
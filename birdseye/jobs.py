@@ -3,24 +3,86 @@
 Jobs of all sizes
 -----------------
 
+The Vision client, piexif and PubNub are imported by the jobs that need
+them: web workers import this module (to enqueue jobs) but never run them.
+
+Uploads go through three jobs: EXIF parsing and database writes run on the
+'local' queue, calls to the Vision API on the rate limited 'vision' queue,
+so that local work never waits behind external calls.
 '''
+from contextlib import contextmanager
+from datetime import datetime
+import functools
+import time
+
+from rq import get_current_job
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
-from google.cloud import vision
-from google.cloud.vision.feature import Feature
-from google.cloud.vision.feature import FeatureTypes
-import piexif
 
 from birdseye import rq
 import birdseye.models as bm
-from birdseye.default_settings import SQLALCHEMY_DATABASE_URI
-import birdseye.pubsub as ps
+from birdseye.default_settings import (
+    SQLALCHEMY_DATABASE_URI, SQLALCHEMY_REPLICA_URIS,
+    SQLALCHEMY_REPLICA_MAX_LAG, SQLALCHEMY_REPLICA_CHECK_INTERVAL,
+    SQLALCHEMY_POOL_SIZE, SQLALCHEMY_MAX_OVERFLOW, SQLALCHEMY_POOL_TIMEOUT,
+    VISION_BACKEND, VISION_RATE, VISION_BURST, VISION_MAX_WAIT, VISION_RETRIES,
+    VISION_BACKOFF, OBSERVATION_PARTITIONS_AHEAD,
+    OBSERVATION_PARTITIONS_RETAIN, DELETE_BATCH_SIZE, DELETE_BATCH_PAUSE,
+    DELETE_JOB_TIMEOUT, EXPORT_CHUNK_SIZE, EXPORT_JOB_TIMEOUT)
+import birdseye.partitions as partitions
+from birdseye.ratelimit import TokenBucket
+from birdseye.routing import ReplicaSet
+
+
+LOCAL_QUEUE = 'local'
+VISION_QUEUE = 'vision'
+
+
+# database uri: its engine, kept for the life of the process (the jobs of
+# a persistent worker share its pool)
+_engines = {}
+_sessionmaker = sessionmaker()
+# the ReplicaSet of the job engines, created on first use
+_replicas = []
+
+
+def _engine(uri):
+    engine = _engines.get(uri)
+    if engine is None:
+        engine = _engines[uri] = create_engine(
+            uri, convert_unicode=True, pool_size=SQLALCHEMY_POOL_SIZE,
+            max_overflow=SQLALCHEMY_MAX_OVERFLOW,
+            pool_timeout=SQLALCHEMY_POOL_TIMEOUT)
+    return engine
 
 
-def db_session():
-    engine = create_engine(SQLALCHEMY_DATABASE_URI, convert_unicode=True)
-    Session = sessionmaker(bind=engine)
-    return Session()
+def replicas():
+    '''The replicas of read_only jobs, lag checked like those of the
+    requests (see birdseye.routing).'''
+    if not _replicas:
+        _replicas.append(ReplicaSet(
+            [functools.partial(_engine, uri)
+             for uri in SQLALCHEMY_REPLICA_URIS],
+            SQLALCHEMY_REPLICA_MAX_LAG, SQLALCHEMY_REPLICA_CHECK_INTERVAL))
+    return _replicas[0]
+
+
+def db_session(read_only=False):
+    '''A new session on the primary or, for read_only jobs, on a replica
+    lagging less than SQLALCHEMY_REPLICA_MAX_LAG (the primary when none
+    is).'''
+    engine = None
+    if read_only and SQLALCHEMY_REPLICA_URIS:
+        engine = replicas().pick()
+    return _sessionmaker(
+        bind=engine or _engine(SQLALCHEMY_DATABASE_URI))
+
+
+def dispose_engines():
+    '''Closes the pooled connections of the job engines, e.g. those a
+    forked process inherited.'''
+    for engine in _engines.values():
+        engine.dispose()
 
 
 def _is_url(filename_or_url):
@@ -29,6 +91,7 @@ def _is_url(filename_or_url):
 
 
 def gcv_params(filename_or_url):
+    from google.cloud.vision.feature import Feature, FeatureTypes
     detect_args = dict(features=[
         Feature(FeatureTypes.LABEL_DETECTION, 15),
         # Feature(FeatureTypes.SAFE_SEARCH_DETECTION, 2),
@@ -44,10 +107,47 @@ class NoLabelsDetected(ValueError):
         super().__init__('Failed to detect labels.')
 
 
+class VisionQuotaExceeded(RuntimeError):
+    def __init__(self):
+        super().__init__('Vision API quota exceeded.')
+
+
+def _is_quota_error(error):
+    # google.cloud.exceptions.TooManyRequests, grpc RESOURCE_EXHAUSTED
+    return getattr(error, 'code', None) == 429 or type(error).__name__ in (
+        'TooManyRequests', 'ResourceExhausted')
+
+
+# idle Vision API clients, kept for the next jobs
+_vision_clients = []
+
+
+@contextmanager
+def vision_client():
+    '''A Vision API client no other job uses meanwhile (the jobs of a gevent
+    worker run concurrently, a client's HTTP connection is not shared).'''
+    client = _vision_clients.pop() if _vision_clients else None
+    if client is None:
+        from google.cloud import vision
+        client = vision.Client()
+    try:
+        yield client
+    finally:
+        _vision_clients.append(client)
+
+
 def detect_labels(filename_or_url):
-    gcv = vision.Client()
-    img_args, detect_args = gcv_params(filename_or_url)
-    g = gcv.image(**img_args).detect(**detect_args)
+    try:
+        if VISION_BACKEND == 'stub':
+            import birdseye.stubs
+            return birdseye.stubs.detect_labels(filename_or_url)
+        img_args, detect_args = gcv_params(filename_or_url)
+        with vision_client() as gcv:
+            g = gcv.image(**img_args).detect(**detect_args)
+    except Exception as e:
+        if _is_quota_error(e):
+            raise VisionQuotaExceeded() from e
+        raise
     # TODO Raise exception on NSFW/unsafe media
     return [(vl.score, vl.description) for go in g for vl in go.labels]
 
@@ -71,6 +171,7 @@ class NoGPSData(ValueError):
 
 
 def detect_exif_gps(file_path):
+    import piexif
     exif_dict = piexif.load(file_path)
     if IFD not in exif_dict.keys():
         raise NoGPSData()
@@ -94,28 +195,174 @@ def make_poly(lon, lat, radius):
     return 'POLYGON(({}))'.format(poly_geo)
 
 
-def make_point(lat, lon):
-    return 'POINT({lat} {long})'.format(lat=lat, lon=lon)
+def make_point(lon, lat):
+    return 'POINT({lon} {lat})'.format(lon=lon, lat=lat)
+
+
+def locate_image(file_path):
+    try:
+        return detect_exif_gps(file_path)
+    except Exception as e:
+        print(e)
+        return None
+
+
+_vision_bucket = None
+
 
+def vision_bucket():
+    global _vision_bucket
+    if _vision_bucket is None:
+        _vision_bucket = TokenBucket(
+            lambda: rq.connection, 'vision', VISION_RATE, VISION_BURST)
+    return _vision_bucket
 
-@rq.job
+
+def label_image(image_url):
+    '''The vision labels of image_url scoring over 0.55. Calls are limited
+    to VISION_RATE per second across all workers, quota errors are retried
+    with exponential backoff.'''
+    for attempt in range(VISION_RETRIES + 1):
+        vision_bucket().acquire(timeout=VISION_MAX_WAIT)
+        try:
+            return [[s, l] for s, l in detect_labels(image_url) if s > 0.55]
+        except VisionQuotaExceeded:
+            if attempt == VISION_RETRIES:
+                raise
+            time.sleep(VISION_BACKOFF * 2 ** attempt)
+
+
+@rq.job(LOCAL_QUEUE)
 def image_to_observation(file_path, image_url):
+    '''The whole upload pipeline in one job. Uploads are processed in
+    stages instead: locate_image_job, label_image_job, store_observation.'''
+    location = locate_image(file_path)
+    labels = None
+    if location is not None:
+        try:
+            labels = label_image(image_url)
+        except Exception as e:
+            print(e)
+    store_observation(image_url, location, labels)
+
+
+@rq.job(LOCAL_QUEUE)
+def locate_image_job(file_path, image_url):
+    '''Upload stage 1 (local): reads the EXIF location, queues labeling.'''
+    location = locate_image(file_path)
+    if location is None:
+        return
+    label_image_job.queue(image_url, location)
+
+
+@rq.job(VISION_QUEUE)
+def label_image_job(image_url, location):
+    '''Upload stage 2 (vision): rate limited label detection.'''
+    labels = None
+    try:
+        labels = label_image(image_url)
+    except Exception as e:
+        print(e)
+    store_observation.queue(image_url, location, labels)
+
+
+@rq.job(LOCAL_QUEUE)
+def store_observation(image_url, location, labels=None):
+    '''Upload stage 3 (local): stores and publishes the observation.'''
     geom = None
+    radius = 0.000001
     media = {'url': image_url}
     properties = {}
-    try:
-        lon, lat = detect_exif_gps(file_path)
-        geom = make_poly(lon, lat, 0.000001)
-        labels = [[s, l] for s, l in detect_labels(image_url) if s > 0.55]
+    if location is not None:
+        geom = make_poly(location[0], location[1], radius)
+    if labels is not None:
         properties = {'vision_labels': labels}
-    except Exception as e:
-        print(e)
     # add observation to database
     session = db_session()
-    obs = bm.Observation(None, geom, media, properties)
-    session.add(obs)
-    session.commit()
-    session.refresh(obs)
+    try:
+        obs = bm.Observation(None, geom, media, properties,
+                             location=location, accuracy=radius)
+        session.add(obs)
+        session.commit()
+        session.refresh(obs)
+        public = obs.as_public_dict()
+    finally:
+        session.close()
     # publish observation to pub-sub channels
-    pubsub = ps.PubSub()
-    pubsub.publish(obs.as_public_dict())
+    import birdseye.pubsub as ps
+    pubsub = ps.get_pubsub()
+    pubsub.publish(public)
+
+
+@rq.job(LOCAL_QUEUE)
+def maintain_partitions(drop=False, move_default=False):
+    '''Creates the observation partitions of the next
+    OBSERVATION_PARTITIONS_AHEAD months (only move_default moves rows out
+    of the default partition) and, when OBSERVATION_PARTITIONS_RETAIN is
+    set, detaches (or drops) those of older months. Runs daily once
+    scheduled by `birdseye maintain_partitions --schedule`.'''
+    session = db_session()
+    connection = session.connection()
+    created = partitions.create_partitions(
+        connection, OBSERVATION_PARTITIONS_AHEAD, move_default=move_default)
+    detached = []
+    if OBSERVATION_PARTITIONS_RETAIN:
+        this_month = partitions.month_start(datetime.utcnow())
+        detached = partitions.detach_partitions(
+            connection,
+            partitions.add_months(
+                this_month, 1 - OBSERVATION_PARTITIONS_RETAIN),
+            drop=drop)
+    session.commit()
+    session.close()
+    return {'created': created, 'detached': detached}
+
+
+@rq.job(LOCAL_QUEUE, timeout=EXPORT_JOB_TIMEOUT)
+def export_observations(path, **filters):
+    '''Writes the observations matching filters (see
+    Observation.query_filtered) to a GeoParquet file at path, reading from a
+    replica when there is one. Returns the number of rows.'''
+    import birdseye.export as export
+    session = db_session(read_only=True)
+    try:
+        return export.write_geoparquet(
+            path, EXPORT_CHUNK_SIZE, session=session, **filters)
+    finally:
+        session.close()
+
+
+# the models the delete_rows job may empty
+DELETABLE = ('User', 'Session', 'Observation', 'Species')
+
+
+@rq.job(LOCAL_QUEUE, timeout=DELETE_JOB_TIMEOUT)
+def delete_rows(model, soft=False):
+    '''Deletes (soft: marks as deleted) all the rows of model, one of
+    DELETABLE, DELETE_BATCH_SIZE rows per transaction. The progress is kept
+    in the job's meta: {'deleted': rows so far, 'total': rows at start}.'''
+    if model not in DELETABLE:
+        raise ValueError('Not deletable: {}'.format(model))
+    # their session events drop the species index and the tiles of the web
+    # workers
+    import birdseye.search  # noqa: F401
+    import birdseye.tiles  # noqa: F401
+    cls = getattr(bm, model)
+    session = db_session()
+    job = get_current_job()
+    progress = {'deleted': 0, 'total': cls.deletable(session, soft).count()}
+
+    def report():
+        if job is not None:
+            job.meta['progress'] = progress
+            job.save_meta()
+
+    report()
+    try:
+        for count in cls.delete_batches(session, soft, DELETE_BATCH_SIZE):
+            progress['deleted'] += count
+            report()
+            time.sleep(DELETE_BATCH_PAUSE)
+    finally:
+        session.close()
+    return progress['deleted']
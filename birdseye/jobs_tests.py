@@ -1,6 +1,6 @@
 # -*- coding: utf-8 -*-
 
-from unittest.mock import patch
+from unittest.mock import call, patch
 
 import nose.tools as nt
 
@@ -73,3 +73,41 @@ class ImageToObservationTest(object):
         # as long as we return the repr of geometry, we cannot do this assert:
         # mock_ps().publish.assert_called_once_with(obs[0].as_public_dict())
         nt.assert_equals(mock_ps().publish.call_count, 1)
+
+
+@patch('birdseye.stubs.STUB_VISION_LATENCY', 0)
+@patch('birdseye.jobs.VISION_BACKEND', 'stub')
+@patch('birdseye.jobs.vision_bucket')
+@patch('birdseye.jobs.time')  # the backoff, not the stub's latency
+class LabelImageTest(object):
+    '''Quota errors of the (stub) Vision API, retried with backoff.'''
+
+    url = 'https://birdseye.space/birdseye.png'
+
+    @patch('birdseye.stubs.random.random', side_effect=[0.1, 0.1, 0.9])
+    @patch('birdseye.stubs.STUB_VISION_QUOTA_ERRORS', 0.5)
+    def test_retries_quota_errors(self, random, time, bucket):
+        labels = jobs.label_image(self.url)
+        nt.assert_in([0.97, 'bird'], labels)
+        nt.assert_equal(bucket().acquire.call_count, 3)
+        nt.assert_equal(time.sleep.call_args_list, [
+            call(jobs.VISION_BACKOFF), call(jobs.VISION_BACKOFF * 2)])
+
+    @patch('birdseye.stubs.STUB_VISION_QUOTA_ERRORS', 1)
+    def test_quota_exceeded(self, time, bucket):
+        with nt.assert_raises(jobs.VisionQuotaExceeded):
+            jobs.label_image(self.url)
+        nt.assert_equal(bucket().acquire.call_count, jobs.VISION_RETRIES + 1)
+        nt.assert_equal(time.sleep.call_count, jobs.VISION_RETRIES)
+
+
+@patch('birdseye.jobs.SQLALCHEMY_REPLICA_URIS', ['postgresql://replica/db'])
+@patch('birdseye.jobs.replicas')
+def test_read_only_session_falls_back_to_primary(replicas):
+    replicas.return_value.pick.return_value = None  # none healthy
+    nt.assert_is(jobs.db_session(read_only=True).bind,
+                 jobs._engine(jobs.SQLALCHEMY_DATABASE_URI))
+    replica = jobs._engine('postgresql://replica/db')
+    replicas.return_value.pick.return_value = replica
+    nt.assert_is(jobs.db_session(read_only=True).bind, replica)
+    nt.assert_is_not(jobs.db_session().bind, replica)
@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+'''
+Metrics
+-------
+
+Counters are incremented in process and added to a Redis hash shared by all
+workers at most every ``flush_interval`` seconds, so that hot paths (e.g.
+rejecting a flood of requests) do not go to Redis every time. When Redis is
+unavailable the counts are kept until a later flush.
+'''
+from collections import Counter
+import logging
+import threading
+import time
+
+from redis.exceptions import RedisError
+
+
+log = logging.getLogger('metrics')
+
+
+class Counters(object):
+
+    def __init__(self, name, connection, flush_interval=10.0):
+        '''connection: a redis client or a callable returning one.'''
+        self.key = 'birdseye:metrics:{}'.format(name)
+        self.flush_interval = flush_interval
+        self._connection = connection
+        self._pending = Counter()
+        self._lock = threading.Lock()
+        self._flushed = time.monotonic()
+
+    @property
+    def connection(self):
+        conn = self._connection
+        return conn() if callable(conn) else conn
+
+    def incr(self, name, amount=1):
+        with self._lock:
+            self._pending[name] += amount
+        if time.monotonic() - self._flushed >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, Counter()
+            self._flushed = time.monotonic()
+        if not pending:
+            return
+        try:
+            pipe = self.connection.pipeline(transaction=False)
+            for name, amount in pending.items():
+                pipe.hincrby(self.key, name, amount)
+            pipe.execute()
+        except RedisError as e:
+            log.warning('Metrics %s not flushed: %s', self.key, e)
+            with self._lock:
+                self._pending.update(pending)
+
+    def totals(self):
+        '''The counts of all workers, this one up to date.'''
+        self.flush()
+        try:
+            shared = self.connection.hgetall(self.key)
+        except RedisError as e:
+            log.warning('Metrics %s unavailable: %s', self.key, e)
+            shared = {}
+        totals = Counter({k.decode('utf8') if isinstance(k, bytes) else k:
+                          int(v) for k, v in shared.items()})
+        with self._lock:
+            totals.update(self._pending)
+        return dict(totals)
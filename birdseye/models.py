@@ -1,5 +1,8 @@
 # -*- coding: utf-8 -*-
 from datetime import datetime, timedelta
+import itertools
+import json
+import time
 import uuid
 
 from geoalchemy2 import Geometry
@@ -11,13 +14,22 @@ from psycopg2.extensions import AsIs
 from psycopg2.extras import Json
 
 import sqlalchemy
-from sqlalchemy import Text, text, ForeignKey, Table, Column
-from sqlalchemy.dialects.postgresql import UUID, JSONB
+from sqlalchemy import (
+    Text, text, func, tuple_, ForeignKey, Index, Table, Column)
+from sqlalchemy.dialects.postgresql import ARRAY, UUID, JSONB
 from sqlalchemy.ext.declarative import declared_attr
 from sqlalchemy.inspection import inspect
-from sqlalchemy.orm import relationship, column_property
+from sqlalchemy.orm import (
+    relationship, defer, joinedload, foreign, make_transient_to_detached)
 
-from birdseye import db
+from birdseye import db, rq
+from birdseye.cache import ReadThrough, LocalStore, RedisStore
+from birdseye.default_settings import (
+    OBSERVATION_PARTITIONS_AHEAD, DELETE_BATCH_SIZE, DELETE_BATCH_PAUSE,
+    ENTITY_CACHE_ENABLED,
+    ENTITY_CACHE_SIZE, ENTITY_CACHE_LOCAL_TTL, ENTITY_CACHE_TTL)
+import birdseye.partitions as partitions
+import birdseye.passwords as passwords
 
 
 def set_path_and_utc(db_conn, conn_proxy):
@@ -82,6 +94,21 @@ def new_uuid():
     return str(uuid.uuid4())
 
 
+def _cached_value(value):
+    # the columns of the entity cache are JSON but for their timestamps
+    return value.isoformat() if isinstance(value, datetime) else value
+
+
+def _cached_datetime(text):
+    return datetime.strptime(
+        text, '%Y-%m-%dT%H:%M:%S.%f' if '.' in text else '%Y-%m-%dT%H:%M:%S')
+
+
+def label_names(properties):
+    '''The lower cased names of properties['vision_labels'] (score, name).'''
+    return [name.lower() for _, name in properties.get('vision_labels', ())]
+
+
 def public(*public_col_names):
     ''' Class decorator setting the PUBLIC attribute from:
     - the decorated class attributes whos names are specified as args
@@ -95,11 +122,30 @@ def public(*public_col_names):
     return wrap
 
 
+# the condition of the partial indexes: rows not soft deleted
+LIVE = text('deleted IS NULL')
+
+# find_by_id of the CACHED models: the column values of the rows, per worker
+# and in Redis, dropped when a session commits changes to them
+entity_cache = ReadThrough([
+    LocalStore(ENTITY_CACHE_SIZE, ENTITY_CACHE_LOCAL_TTL),
+    RedisStore('entities', lambda: rq.connection, ENTITY_CACHE_TTL),
+])
+_STALE = 'birdseye.models.stale'
+
+
 class CommonModel(object):
     '''Created, Modified, Deleted, Replication.'''
     # http://docs.sqlalchemy.org/en/latest/orm/extensions/declarative/mixins.html
 
     PUBLIC = ()
+    # find_by_id reads through entity_cache, minus the UNCACHED columns
+    CACHED = False
+    UNCACHED = ()
+
+    # INSERT/UPDATE ... RETURNING the server generated and SQL expression
+    # columns, instead of SELECTing them afterwards
+    __mapper_args__ = {'eager_defaults': True}
 
     @declared_attr
     def created(cls):
@@ -126,17 +172,127 @@ class CommonModel(object):
         )
 
     @classmethod
-    def delete_all(cls):
-        result = cls.query.delete()
-        return result
+    def live(cls):
+        '''The query of the rows not soft deleted. Indexes read by it are
+        partial, WHERE deleted IS NULL.'''
+        return cls.query.filter(cls.deleted.is_(None))
+
+    @classmethod
+    def deletable(cls, session, soft=False):
+        '''The primary keys of the rows left to delete.'''
+        pk = inspect(cls).primary_key[0]
+        query = session.query(pk)
+        if soft:
+            query = query.filter(cls.deleted.is_(None))
+        return query
+
+    @classmethod
+    def delete_batch(cls, session, batch_size, soft=False):
+        '''Deletes, or soft deletes (sets deleted), up to batch_size rows.
+        Rows locked by other transactions are skipped, not waited for.
+        Returns the number of rows, to be committed by the caller.'''
+        pk = inspect(cls).primary_key[0]
+        batch = cls.deletable(session, soft).limit(batch_size).with_for_update(
+            skip_locked=True)
+        ids = [id_ for (id_,) in batch]
+        if not ids:
+            return 0
+        if cls.CACHED:
+            session.info.setdefault(_STALE, set()).update(
+                cls.cache_key(id_) for id_ in ids)
+        query = session.query(cls).filter(pk.in_(ids))
+        if soft:
+            return query.update(
+                {cls.deleted: text("(now() at time zone 'utc')")},
+                synchronize_session=False)
+        return query.delete(synchronize_session=False)
+
+    @classmethod
+    def delete_batches(cls, session, soft=False, batch_size=DELETE_BATCH_SIZE,
+                       pause=DELETE_BATCH_PAUSE):
+        '''Deletes all the rows batch by batch, committing each one: short
+        transactions, locks and WAL bounded by batch_size. Rows locked by
+        other transactions are retried every pause seconds until none is
+        left. Yields the number of rows of each batch.'''
+        while True:
+            count = cls.delete_batch(session, batch_size, soft)
+            session.commit()
+            if count:
+                yield count
+                continue
+            left = session.query(
+                cls.deletable(session, soft).exists()).scalar()
+            session.commit()
+            if not left:
+                return
+            time.sleep(pause)  # the rows left are all locked
+
+    @classmethod
+    def delete_all(cls, soft=False):
+        return sum(cls.delete_batches(db.session, soft))
 
     @classmethod
     def find_all(cls):
-        return cls.query.order_by(cls.created).all()
+        return cls.live().order_by(cls.created).all()
 
     @classmethod
     def find_by_id(cls, id_):
-        return cls.query.get(str(id_))
+        if cls.CACHED and ENTITY_CACHE_ENABLED:
+            obj = cls._find_cached(str(id_))
+        else:
+            obj = cls.query.get(str(id_))
+        if obj is not None and obj.deleted is not None:
+            return None
+        return obj
+
+    @classmethod
+    def cache_key(cls, id_):
+        return '{}:{}'.format(cls.__tablename__, id_)
+
+    @classmethod
+    def _find_cached(cls, id_):
+        '''The row with primary key id_ from the session, else from
+        entity_cache (attached to the session without a query), else
+        loaded and cached.'''
+        mapper = inspect(cls)
+        obj = db.session.identity_map.get(
+            mapper.identity_key_from_primary_key([id_]))
+        if obj is not None:
+            return obj
+        loaded = []
+
+        def load():
+            obj = cls.query.get(id_)
+            if obj is None:
+                return None
+            loaded.append(obj)
+            return json.dumps(
+                {attr.key: _cached_value(getattr(obj, attr.key))
+                 for attr in mapper.column_attrs
+                 if attr.key not in cls.UNCACHED}).encode('utf8')
+
+        values = entity_cache.get(cls.cache_key(id_), load)
+        if loaded:
+            return loaded[0]
+        if values is None:
+            return None
+        obj = mapper.class_manager.new_instance()
+        for key, value in json.loads(values.decode('utf8')).items():
+            if value is not None and \
+                    isinstance(mapper.columns[key].type, db.DateTime):
+                value = _cached_datetime(value)
+            setattr(obj, key, value)
+        # persistent and clean, the UNCACHED columns load on first access
+        make_transient_to_detached(obj)
+        return db.session.merge(obj, load=False)
+
+    def insert(self):
+        '''Adds this new row and flushes it: a single INSERT ... RETURNING.
+        Returns the primary key (generated client side), read before the
+        commit expires it. Does not commit.'''
+        db.session.add(self)
+        db.session.flush()
+        return inspect(self).identity[0]
 
     def public_repr(self, item):
         if isinstance(item, datetime):
@@ -153,9 +309,9 @@ class CommonModel(object):
         else:
             return item
 
-    def as_public_dict(self):
+    def as_public_dict(self, exclude=()):
         return {c.key: self.public_repr(getattr(self, c.key))
-                for c in self.PUBLIC}
+                for c in self.PUBLIC if c.key not in exclude}
 
     def __repr__(self):
         return '<{} {!r}>'.format(
@@ -164,41 +320,77 @@ class CommonModel(object):
 
 class DeletableMixin(object):
 
-    def delete(self):
-        return self.query.delete()
+    @classmethod
+    def delete(cls, id_):
+        '''Deletes the row with primary key id_, returns the number of rows
+        deleted. Does not commit.'''
+        pk = inspect(cls).primary_key[0]
+        # fetch: the deleted keys reach _bulk_written
+        return cls.query.filter(pk == str(id_)).delete(
+            synchronize_session='fetch')
 
 
 class User(CommonModel, db.Model):
     '''Users, many are present in the database.'''
     __tablename__ = 'users'
+    CACHED = True
+    UNCACHED = ('secrets',)  # no password hashes in Redis
     user_id = db.Column(UUID, primary_key=True, default=new_uuid)
     # email, telephone, whatever
     credentials = db.Column(JSONB, nullable=False)
-    secrets = db.Column(Text)  # pw hash
+    secrets = db.Column(Text)  # pw hash, see birdseye.passwords
     # app personal settings
     settings = db.Column(JSONB, nullable=False)
     # public stuff: nickname, social links, etc.
     social = db.Column(JSONB)
+
+    __table_args__ = (
+        Index('ix_users_credentials', credentials, postgresql_where=LIVE),
+    )
+
     PUBLIC = (user_id, credentials, settings, social)
 
     def __init__(self, credentials, secrets, settings=None, social=None):
+        '''secrets: the plain text secret, stored hashed.'''
         self.credentials = credentials
-        self.secrets = secrets
+        self.secrets = (passwords.hash_secret(secrets)
+                        if secrets is not None else None)
         self.settings = settings or {}
         self.social = social or {}
 
     @classmethod
     def find_by_credentials(cls, credentials, secrets):
-        query = cls.query.filter(
-            text('credentials = :credentials and secrets = :secrets'))
-        query = query.params(
-            credentials=PGJson(credentials), secrets=secrets)
-        return query.order_by(cls.created).first()
+        '''The first user with credentials whose stored secret hash
+        matches secrets. Hashes are verified off the event loop (see
+        birdseye.passwords).'''
+        query = cls.live().filter(text('credentials = :credentials'))
+        query = query.params(credentials=PGJson(credentials))
+        for user in query.order_by(cls.created):
+            if passwords.verify_secret(secrets, user.secrets):
+                return user
+        return None
+
+    def upgrade_secret(self, secrets, stored):
+        '''Rehashes secrets, verified by find_by_credentials, when stored
+        (its hash, read before the request's commit expired this user) has
+        fewer iterations than configured: an UPDATE, no query otherwise.
+        Returns whether the hash was upgraded, to be committed by the
+        caller.'''
+        if not passwords.needs_rehash(stored):
+            return False
+        cls = type(self)
+        count = cls.query.filter(
+            cls.user_id == inspect(self).identity[0],
+            cls.secrets == stored,  # unless changed meanwhile
+        ).update({'secrets': passwords.hash_secret(secrets)},
+                 synchronize_session=False)
+        return count > 0
 
 
 class Session(CommonModel, db.Model, DeletableMixin):
     '''User sessions'''
     __tablename__ = 'sessions'
+    CACHED = True
     session_id = db.Column(UUID, primary_key=True, default=new_uuid)
     expires = db.Column(
         db.DateTime(),
@@ -212,32 +404,111 @@ class Session(CommonModel, db.Model, DeletableMixin):
     user = relationship('User')
 
     def __init__(self, user, tokens=None):
-        self.user_id = user.user_id
-        self.user = user
+        if user is not None:
+            self.user_id = user.user_id
+            self.user = user
         self.tokens = tokens or {}
 
 
 class Species(CommonModel, db.Model):
     '''Species table (maps species to labels)'''
     __tablename__ = 'species'
+    CACHED = True
     species_id = db.Column(UUID, primary_key=True, default=new_uuid)
     # scientific, common, etc
     names = db.Column(JSONB, nullable=False)
     # label bingo: vision, user, etc
     labels = db.Column(JSONB, nullable=False)
+    # lower cased names and labels, trigram indexed for fuzzy search
+    search_text = db.Column(Text, nullable=False, server_default='')
+
+    __table_args__ = (
+        Index('ix_species_search_trgm', search_text, postgresql_using='gin',
+              postgresql_ops={'search_text': 'gin_trgm_ops'},
+              postgresql_where=LIVE),
+    )
 
     PUBLIC = (species_id, names, labels)
 
     def __init__(self, names, labels):
         self.names = names
         self.labels = labels
+        self.search_text = species_search_text(names, labels)
+
+    @classmethod
+    def search_fuzzy(cls, q, limit, exclude=()):
+        '''Species whose names or labels contain words similar to q (pg_trgm
+        word similarity), best matches first.'''
+        q = q.lower()
+        query = cls.live().filter(cls.search_text.op('%>')(q))
+        if exclude:
+            query = query.filter(~cls.species_id.in_(list(exclude)))
+        return query.order_by(
+            func.word_similarity(q, cls.search_text).desc(),
+            cls.created).limit(limit).all()
+
+
+def species_search_text(names, labels):
+    names = names or {}
+    words = [names.get('common') or '', names.get('scientific') or '']
+    return ' '.join(words + list(labels or ())).lower()
+
+
+@sqlalchemy.event.listens_for(sqlalchemy.orm.Session, 'before_flush')
+def _entities_written(session, flush_context, instances):
+    stale = session.info.setdefault(_STALE, set())
+    for obj in itertools.chain(session.dirty, session.deleted):
+        if getattr(obj, 'CACHED', False):
+            stale.add(obj.cache_key(inspect(obj).identity[0]))
+
+
+@sqlalchemy.event.listens_for(sqlalchemy.orm.Session, 'after_bulk_update')
+@sqlalchemy.event.listens_for(sqlalchemy.orm.Session, 'after_bulk_delete')
+def _bulk_written(update_context):
+    '''Marks the rows of a bulk UPDATE or DELETE stale: all of them with
+    synchronize_session='fetch', those in the session with 'evaluate'.
+    Callers passing False record their keys themselves (see delete_batch).
+    '''
+    cls = update_context.mapper.class_
+    if not getattr(cls, 'CACHED', False):
+        return
+    ids = [pk[0] for pk in getattr(update_context, 'matched_rows', ())]
+    ids.extend(inspect(obj).identity[0]
+               for obj in getattr(update_context, 'matched_objects', ()))
+    update_context.session.info.setdefault(_STALE, set()).update(
+        cls.cache_key(id_) for id_ in ids)
+
+
+@sqlalchemy.event.listens_for(sqlalchemy.orm.Session, 'after_commit')
+def _invalidate_committed(session):
+    entity_cache.invalidate(*session.info.pop(_STALE, ()))
+
+
+@sqlalchemy.event.listens_for(sqlalchemy.orm.Session, 'after_rollback')
+def _forget_rolled_back(session):
+    session.info.pop(_STALE, None)
+
+
+@sqlalchemy.event.listens_for(db.Model.metadata, 'before_create')
+def _create_extensions(target, connection, **kw):
+    connection.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
 
 
 @public('created')
 class Observation(CommonModel, db.Model):
-    '''An observation by a user. Timestamped, geostamped, public.'''
+    '''An observation by a user. Timestamped, geostamped, public.
+
+    Partitioned by month on created (see birdseye.partitions): created is
+    part of the table's primary key, observation_id alone identifies an
+    observation for the ORM.'''
     __tablename__ = 'observations'
     observation_id = db.Column(UUID, primary_key=True, default=new_uuid)
+    created = db.Column(
+        db.DateTime(),
+        primary_key=True,
+        nullable=False,
+        server_default=text("(now() at time zone 'utc')"),
+    )
     user_id = db.Column(UUID, ForeignKey('users.user_id'))
     geometry = db.Column(Geometry('POLYGON'), nullable=False)
     # photography information: url, license, etc
@@ -246,26 +517,132 @@ class Observation(CommonModel, db.Model):
     properties = db.Column(JSONB, nullable=False)
     species_id = db.Column(UUID, ForeignKey('species.species_id'))
 
+    # centroid of geometry, its radius and GeoJSON, computed once when the
+    # observation is stored (see _locate_observation) instead of per read
+    location = db.Column(Geometry('POINT'))
+    accuracy = db.Column(db.Float)
+    geometry_center = db.Column(JSONB)
+    # lower cased properties['vision_labels'] names, for indexed filtering
+    labels = db.Column(ARRAY(Text), nullable=False, server_default='{}')
+
     user = relationship('User')
     species = relationship('Species')
-    geometry_center = column_property(
-        geometry.ST_Centroid().ST_AsGeoJSON().cast(JSONB))
+
+    __table_args__ = (
+        Index('ix_observations_labels', labels, postgresql_using='gin',
+              postgresql_where=LIVE),
+        Index('ix_observations_user_id', user_id, postgresql_where=LIVE),
+        Index('ix_observations_species_id', species_id,
+              postgresql_where=LIVE),
+        Index('ix_observations_created', 'created', 'observation_id',
+              postgresql_where=LIVE),
+        {'postgresql_partition_by': 'RANGE (created)'},
+    )
+    __mapper_args__ = dict(CommonModel.__mapper_args__,
+                           primary_key=[observation_id])
 
     PUBLIC = (observation_id, geometry, media, properties, species, user)
 
-    def __init__(self, user, geometry, media, properties=None, species=None):
-        self.user_id = user.user_id if user is not None else None
-        self.user = user
+    def __init__(self, user, geometry, media, properties=None, species=None,
+                 location=None, accuracy=None):
+        '''location: (lon, lat) of the observation when known up front,
+        otherwise it is the centroid of geometry.'''
+        if user is not None:
+            self.user_id = user.user_id
+            self.user = user
         self.geometry = geometry
         self.media = media
         self.properties = properties or {}
+        self.labels = label_names(self.properties)
         self.species_id = species.species_id if species else None
         self.species = species
+        if location is not None:
+            lon, lat = location
+            self.location = 'POINT({} {})'.format(lon, lat)
+            self.geometry_center = {'type': 'Point', 'coordinates': [lon, lat]}
+        self.accuracy = accuracy
 
+    @classmethod
+    def query_filtered(cls, labels=(), species_id=None, user_id=None,
+                       since=None, until=None):
+        '''Observations having all of labels, created in [since, until).'''
+        query = cls.live()
+        if labels:
+            query = query.filter(
+                cls.labels.contains([label.lower() for label in labels]))
+        if species_id is not None:
+            query = query.filter(cls.species_id == str(species_id))
+        if user_id is not None:
+            query = query.filter(cls.user_id == str(user_id))
+        if since is not None:
+            query = query.filter(cls.created >= since)
+        if until is not None:
+            query = query.filter(cls.created < until)
+        # plain comparisons on created: only the partitions of [since,
+        # until) are scanned
+        return query
+
+    @classmethod
+    def page(cls, query, limit, after=None):
+        '''The first limit observations of query in (created,
+        observation_id) order, those after the key after when given: a
+        range scan of ix_observations_created however deep the page.'''
+        if after is not None:
+            created, observation_id = after
+            query = query.filter(
+                cls.created >= created,  # prunes the partitions before
+                tuple_(cls.created, cls.observation_id) >
+                tuple_(created, str(observation_id)))
+        return query.order_by(cls.created, cls.observation_id).limit(limit)
 
+    @classmethod
+    def find_filtered(cls, limit, after=None, **filters):
+        return cls.page(cls.query_filtered(**filters), limit, after).all()
+
+    @classmethod
+    def find_all_mapped(cls, limit, after=None, **filters):
+        '''Observations for the map: the precomputed center is read, the
+        full geometry is not loaded.'''
+        return cls.page(cls.query_filtered(**filters).options(
+            defer(cls.geometry), defer(cls.location),
+            joinedload(cls.user), joinedload(cls.species),
+        ), limit, after).all()
+
+
+@sqlalchemy.event.listens_for(Observation, 'before_insert')
+@sqlalchemy.event.listens_for(Observation, 'before_update')
+def _locate_observation(mapper, connection, target):
+    '''Fills the missing location, accuracy and geometry_center from
+    geometry, as SQL expressions evaluated by the INSERT/UPDATE itself.'''
+    state = inspect(target)
+    if state.persistent and \
+            not state.attrs.geometry.history.has_changes():
+        return
+    if target.geometry is None:
+        return
+    geometry = target.geometry
+    if isinstance(geometry, str):
+        geometry = WKTElement(geometry)
+    center = func.ST_Centroid(geometry)
+    if state.persistent or target.location is None:
+        target.location = center
+        target.geometry_center = sqlalchemy.cast(
+            func.ST_AsGeoJSON(center), JSONB)
+    if state.persistent or target.accuracy is None:
+        target.accuracy = func.ST_MaxDistance(center, geometry)
+
+
+@sqlalchemy.event.listens_for(Observation.__table__, 'after_create')
+def _create_partitions(target, connection, **kw):
+    partitions.create_default(connection)
+    partitions.create_partitions(connection, OBSERVATION_PARTITIONS_AHEAD)
+
+
+# no foreign key to observations: observation_id alone is not unique in the
+# partitioned table
 observation_summary = Table(
     'observation_summary', db.Model.metadata,
-    Column('observation_id', UUID, ForeignKey('observations.observation_id')),
+    Column('observation_id', UUID),
     Column('summary_id', UUID, ForeignKey('summaries.summary_id'))
 )
 
@@ -279,7 +656,10 @@ class Summary(CommonModel, db.Model):
     properties = db.Column(JSONB, nullable=False)
     geometry = db.Column(Geometry('POLYGON'), nullable=False)
 
-    observations = relationship('Observation', secondary=observation_summary)
+    observations = relationship(
+        'Observation', secondary=observation_summary,
+        secondaryjoin=(foreign(observation_summary.c.observation_id) ==
+                       Observation.observation_id))
 
     PUBLIC = (summary_id, properties, geometry)
 
@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+'''
+Observation partitions
+----------------------
+
+``observations`` is partitioned by month on ``created``: one
+``observations_yYYYYmMM`` partition per month plus ``observations_default``
+for rows outside of them. Queries bounded on ``created`` (the since/until
+filters) only read the partitions of their range.
+
+Partitions are created ahead of time by the maintain_partitions job; old
+ones can be detached, leaving a standalone table to archive or drop,
+without touching the rest of the table. A month that already has rows in
+the default partition is skipped by the job: moving them means detaching
+and attaching the default partition again, which validates all of it
+under an exclusive lock (``birdseye maintain_partitions --move_default``,
+off-peak).
+'''
+from datetime import datetime
+import logging
+import re
+
+import sqlalchemy
+
+
+log = logging.getLogger('partitions')
+
+TABLE = 'observations'
+DEFAULT = 'observations_default'
+NAME = re.compile(r'^observations_y(\d{4})m(\d{2})$')
+
+PARTITIONS_SQL = sqlalchemy.text('''
+    SELECT c.relname FROM pg_inherits i
+    JOIN pg_class c ON c.oid = i.inhrelid
+    JOIN pg_class p ON p.oid = i.inhparent
+    WHERE p.relname = :table
+''')
+
+
+def month_start(when):
+    return datetime(when.year, when.month, 1)
+
+
+def add_months(month, months):
+    index = month.year * 12 + month.month - 1 + months
+    return datetime(index // 12, index % 12 + 1, 1)
+
+
+def partition_name(month):
+    return '{}_y{:04d}m{:02d}'.format(TABLE, month.year, month.month)
+
+
+def monthly_partitions(connection):
+    '''{month: partition name} of the attached monthly partitions.'''
+    partitions = {}
+    for (name,) in connection.execute(PARTITIONS_SQL, table=TABLE):
+        match = NAME.match(name)
+        if match:
+            partitions[datetime(int(match.group(1)),
+                                int(match.group(2)), 1)] = name
+    return partitions
+
+
+def create_default(connection):
+    connection.execute(
+        'CREATE TABLE IF NOT EXISTS {} PARTITION OF {} DEFAULT'.format(
+            DEFAULT, TABLE))
+
+
+def in_default(connection, month):
+    '''Whether the default partition has rows of month.'''
+    return bool(connection.execute(sqlalchemy.text(
+        'SELECT 1 FROM {} WHERE created >= :start AND created < :end '
+        'LIMIT 1'.format(DEFAULT)),
+        start=month, end=add_months(month, 1)).scalar())
+
+
+def create_partition(connection, month):
+    '''Creates the partition of month. Rows of that month already in the
+    default partition are moved to it, with the default partition detached
+    meanwhile (see the module docstring).'''
+    name = partition_name(month)
+    bounds = {'start': month, 'end': add_months(month, 1)}
+    moving = in_default(connection, month)
+    if moving:
+        log.warning('Moving the rows of %s out of %s.', name, DEFAULT)
+        # a partition can not be attached over rows of the default one
+        connection.execute('ALTER TABLE {} DETACH PARTITION {}'.format(
+            TABLE, DEFAULT))
+    connection.execute(sqlalchemy.text(
+        "CREATE TABLE {} PARTITION OF {} FOR VALUES "
+        "FROM ('{:%Y-%m-%d}') TO ('{:%Y-%m-%d}')".format(
+            name, TABLE, bounds['start'], bounds['end'])))
+    if moving:
+        moved = ('WITH moved AS (DELETE FROM {} WHERE created >= :start '
+                 'AND created < :end RETURNING *) '
+                 'INSERT INTO {} SELECT * FROM moved'.format(DEFAULT, name))
+        connection.execute(sqlalchemy.text(moved), **bounds)
+        connection.execute('ALTER TABLE {} ATTACH PARTITION {} DEFAULT'.format(
+            TABLE, DEFAULT))
+    return name
+
+
+def create_partitions(connection, ahead, now=None, move_default=False):
+    '''Creates the missing partitions from this month to ahead months from
+    now, returns their names. Months with rows in the default partition
+    are skipped (and logged) unless move_default.'''
+    existing = monthly_partitions(connection)
+    this_month = month_start(now or datetime.utcnow())
+    created = []
+    for months in range(ahead + 1):
+        month = add_months(this_month, months)
+        if month in existing:
+            continue
+        if not move_default and in_default(connection, month):
+            log.error('Not creating %s: %s has rows of that month, move '
+                      'them with `birdseye maintain_partitions '
+                      '--move_default`.', partition_name(month), DEFAULT)
+            continue
+        created.append(create_partition(connection, month))
+    return created
+
+
+def detach_partitions(connection, before, drop=False):
+    '''Detaches (or drops) the monthly partitions of the months before
+    ``before``, returns their names. A detached partition is a standalone
+    table, to be archived (e.g. pg_dump -t) and dropped.'''
+    names = [name for month, name
+             in sorted(monthly_partitions(connection).items())
+             if month < month_start(before)]
+    for name in names:
+        connection.execute('ALTER TABLE {} DETACH PARTITION {}'.format(
+            TABLE, name))
+        if drop:
+            connection.execute('DROP TABLE {}'.format(name))
+    return names
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+from datetime import datetime
+from unittest.mock import patch, MagicMock
+
+import nose.tools as nt
+
+import birdseye.partitions as partitions
+
+
+def test_months():
+    nt.assert_equal(partitions.month_start(datetime(2017, 3, 31, 23, 59)),
+                    datetime(2017, 3, 1))
+    nt.assert_equal(partitions.add_months(datetime(2017, 11, 1), 2),
+                    datetime(2018, 1, 1))
+    nt.assert_equal(partitions.add_months(datetime(2017, 1, 1), -1),
+                    datetime(2016, 12, 1))
+    nt.assert_equal(partitions.partition_name(datetime(2017, 3, 1)),
+                    'observations_y2017m03')
+
+
+def test_monthly_partitions():
+    connection = MagicMock()
+    connection.execute.return_value = [
+        ('observations_y2017m03',), ('observations_default',)]
+    nt.assert_equal(partitions.monthly_partitions(connection),
+                    {datetime(2017, 3, 1): 'observations_y2017m03'})
+
+
+@patch('birdseye.partitions.in_default', return_value=False)
+@patch('birdseye.partitions.create_partition',
+       side_effect=lambda connection, month: partitions.partition_name(month))
+@patch('birdseye.partitions.monthly_partitions',
+       return_value={datetime(2017, 12, 1): 'observations_y2017m12'})
+def test_create_partitions_missing_only(monthly_partitions, create_partition,
+                                        in_default):
+    created = partitions.create_partitions(
+        MagicMock(), 2, now=datetime(2017, 11, 15))
+    nt.assert_equal(created,
+                    ['observations_y2017m11', 'observations_y2018m01'])
+
+
+@patch('birdseye.partitions.in_default',
+       side_effect=lambda connection, month: month.month == 11)
+@patch('birdseye.partitions.create_partition',
+       side_effect=lambda connection, month: partitions.partition_name(month))
+@patch('birdseye.partitions.monthly_partitions', return_value={})
+def test_create_partitions_skips_default_rows(monthly_partitions,
+                                              create_partition, in_default):
+    connection = MagicMock()
+    created = partitions.create_partitions(
+        connection, 1, now=datetime(2017, 11, 15))
+    nt.assert_equal(created, ['observations_y2017m12'])
+    created = partitions.create_partitions(
+        connection, 1, now=datetime(2017, 11, 15), move_default=True)
+    nt.assert_equal(created,
+                    ['observations_y2017m11', 'observations_y2017m12'])
+
+
+@patch('birdseye.partitions.monthly_partitions', return_value={
+    datetime(2017, 1, 1): 'observations_y2017m01',
+    datetime(2017, 2, 1): 'observations_y2017m02',
+    datetime(2017, 3, 1): 'observations_y2017m03',
+})
+def test_detach_partitions(monthly_partitions):
+    connection = MagicMock()
+    detached = partitions.detach_partitions(
+        connection, datetime(2017, 3, 10), drop=True)
+    nt.assert_equal(detached,
+                    ['observations_y2017m01', 'observations_y2017m02'])
+    nt.assert_equal(
+        [c[0][0] for c in connection.execute.call_args_list], [
+            'ALTER TABLE observations DETACH PARTITION observations_y2017m01',
+            'DROP TABLE observations_y2017m01',
+            'ALTER TABLE observations DETACH PARTITION observations_y2017m02',
+            'DROP TABLE observations_y2017m02',
+        ])
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+'''
+Password hashing
+----------------
+
+User secrets are stored as salted PBKDF2-SHA256 hashes::
+
+    pbkdf2_sha256$<iterations>$<salt>$<hash>
+
+Hashing is deliberately slow (PASSWORD_ITERATIONS, about 100ms), far too
+slow to run on the gevent loop: hash_secret and verify_secret run it in a
+bounded pool of PASSWORD_HASH_THREADS threads (hashlib releases the GIL),
+while the calling greenlet waits and the others keep serving requests.
+
+Hashes with fewer iterations than configured still verify; needs_rehash
+tells which to upgrade. Secrets stored in plain text before hashing were
+hashed by a migration and no longer verify.
+'''
+import base64
+import hashlib
+import hmac
+import os
+
+from gevent.threadpool import ThreadPool
+
+from birdseye.default_settings import (
+    PASSWORD_ITERATIONS, PASSWORD_HASH_THREADS)
+
+
+ALGORITHM = 'pbkdf2_sha256'
+SALT_BYTES = 16
+
+_pool = None
+
+
+def pool():
+    '''The hashing thread pool, created lazily in every (forked) worker.'''
+    global _pool
+    if _pool is None:
+        _pool = ThreadPool(PASSWORD_HASH_THREADS)
+    return _pool
+
+
+def _b64(data):
+    return base64.b64encode(data).decode('ascii')
+
+
+def _pbkdf2(secret, salt, iterations):
+    return hashlib.pbkdf2_hmac(
+        'sha256', secret.encode('utf8'), salt, iterations)
+
+
+def _hash(secret, iterations):
+    salt = os.urandom(SALT_BYTES)
+    return '{}${}${}${}'.format(
+        ALGORITHM, iterations, _b64(salt),
+        _b64(_pbkdf2(secret, salt, iterations)))
+
+
+def _verify(secret, stored):
+    if not stored.startswith(ALGORITHM + '$'):
+        return False
+    _, iterations, salt, expected = stored.split('$')
+    computed = _pbkdf2(secret, base64.b64decode(salt), int(iterations))
+    return hmac.compare_digest(computed, base64.b64decode(expected))
+
+
+def hash_secret(secret, iterations=None):
+    '''The hash to store for secret, computed in the pool.'''
+    return pool().apply(_hash, (secret, iterations or PASSWORD_ITERATIONS))
+
+
+def verify_secret(secret, stored):
+    '''Whether secret matches the stored hash, checked in the pool.'''
+    if secret is None or stored is None:
+        return False
+    return pool().apply(_verify, (secret, stored))
+
+
+def needs_rehash(stored, iterations=None):
+    '''Whether stored is hashed with fewer iterations than configured.'''
+    if not stored.startswith(ALGORITHM + '$'):
+        return False  # never verifies
+    return int(stored.split('$')[1]) < (iterations or PASSWORD_ITERATIONS)
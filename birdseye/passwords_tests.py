@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+import nose.tools as nt
+
+import birdseye.passwords as passwords
+
+
+def test_hash_and_verify():
+    stored = passwords.hash_secret('12345', iterations=1000)
+    nt.assert_true(stored.startswith('pbkdf2_sha256$1000$'))
+    nt.assert_true(passwords.verify_secret('12345', stored))
+    nt.assert_false(passwords.verify_secret('12346', stored))
+    nt.assert_false(passwords.verify_secret(None, stored))
+
+
+def test_salted():
+    nt.assert_not_equal(passwords.hash_secret('12345', iterations=1000),
+                        passwords.hash_secret('12345', iterations=1000))
+
+
+def test_plain_text_secrets():
+    nt.assert_false(passwords.verify_secret('12345', '12345'))
+    nt.assert_false(passwords.needs_rehash('12345'))
+
+
+def test_needs_rehash():
+    stored = passwords.hash_secret('12345', iterations=1000)
+    nt.assert_true(passwords.needs_rehash(stored, iterations=2000))
+    nt.assert_false(passwords.needs_rehash(stored, iterations=1000))
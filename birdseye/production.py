@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+'''
+Production server command lines (gunicorn with gevent workers, rq workers).
+
+``birdseye runproduction`` sizes the gunicorn workers from the CPUs and the
+memory available to the process (cgroup limits included): one gevent worker
+per CPU, as many as fit in memory. ``birdseye reload`` replaces a running
+server without dropping connections (see rolling_reload).
+'''
+import os
+import platform
+import signal
+import sys
+import time
+
+
+SOCKET = 'unix:/tmp/birdseye_gunicorn.sock'
+PIDFILE = '{}.pid'.format(platform.node())
+
+
+def gunicorn_command(bind=SOCKET, workers=2, app_module='birdseye.wsgi:app',
+                     pidfile=None, reuse_port=False):
+    '''The gunicorn command line used by ``birdseye runproduction``.'''
+    command = [
+        'gunicorn',
+        '-w', str(workers),
+        '-k', 'gevent',
+        '--worker-connections', '1000',  # This is the default
+        '--preload',
+        '--timeout', '0',  # we are using async workers
+        # for which timeout does not make sense
+        '--keep-alive', '5',  # default is 2
+        '--bind', bind,
+        '-p', pidfile or PIDFILE]
+    if reuse_port:
+        # SO_REUSEPORT: the new master of a reload binds the same TCP port
+        # while the old one still listens
+        command.append('--reuse-port')
+    return command + [app_module]
+
+
+def worker_commands(pools, manage=None, mode='fork', concurrency=1):
+    '''The rq worker command lines used by ``birdseye workers``: pools is a
+    list of (queues, count), see RQ_WORKER_POOLS. In 'persistent' and
+    'gevent' modes a command per pool runs its count of processes, each
+    running up to concurrency jobs at once in 'gevent' mode (see
+    RQ_WORKER_MODE).'''
+    manage = manage or [sys.executable, sys.argv[0]]
+    if mode in ('persistent', 'gevent'):
+        options = []
+        if mode == 'gevent':
+            options = ['--concurrency', str(concurrency)]
+        return [manage + ['rq', 'persistent', '--processes', str(count)] +
+                options + list(queues) for queues, count in pools if count]
+    return [manage + ['rq', 'worker'] + list(queues)
+            for queues, count in pools for _ in range(count)]
+
+
+def _read(path):
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except (IOError, OSError):
+        return None
+
+
+def cpu_count():
+    '''The CPUs this process may use: its affinity, capped by a cgroup v2
+    (cpu.max) or v1 (cfs quota) limit.'''
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:  # not on Linux
+        cpus = os.cpu_count() or 1
+    quota = period = None
+    cpu_max = _read('/sys/fs/cgroup/cpu.max')
+    if cpu_max:
+        quota, period = cpu_max.split()[:2]
+    else:
+        quota = _read('/sys/fs/cgroup/cpu/cpu.cfs_quota_us')
+        period = _read('/sys/fs/cgroup/cpu/cpu.cfs_period_us')
+    try:
+        if int(quota) > 0:
+            cpus = min(cpus, max(1, int(int(quota) / int(period) + 0.5)))
+    except (TypeError, ValueError):  # 'max', -1 or unknown: no limit
+        pass
+    return cpus
+
+
+def available_memory():
+    '''Bytes of memory available to this process: MemAvailable, capped by
+    the room left under a cgroup v2 or v1 memory limit. None when unknown.'''
+    available = None
+    meminfo = _read('/proc/meminfo') or ''
+    for line in meminfo.splitlines():
+        if line.startswith('MemAvailable:'):
+            available = int(line.split()[1]) * 1024
+    for limit_path, usage_path in [
+            ('/sys/fs/cgroup/memory.max', '/sys/fs/cgroup/memory.current'),
+            ('/sys/fs/cgroup/memory/memory.limit_in_bytes',
+             '/sys/fs/cgroup/memory/memory.usage_in_bytes')]:
+        try:
+            limit = int(_read(limit_path))
+            usage = int(_read(usage_path) or 0)
+        except (TypeError, ValueError):  # 'max' or no such cgroup
+            continue
+        if available is None or limit - usage < available:
+            available = limit - usage
+        break
+    return available
+
+
+def worker_count(cpus=None, memory=None, worker_memory=256 * 1024 * 1024,
+                 workers_per_cpu=1):
+    '''Gunicorn workers for the host: workers_per_cpu per CPU (gevent
+    workers keep a CPU busy on their own), no more than fit in memory at
+    worker_memory bytes each, at least one.'''
+    cpus = cpus or cpu_count()
+    workers = cpus * workers_per_cpu
+    if memory is None:
+        memory = available_memory()
+    if memory is not None and worker_memory:
+        workers = min(workers, memory // worker_memory)
+    return max(1, int(workers))
+
+
+def read_pid(pidfile):
+    try:
+        return int(_read(pidfile))
+    except (TypeError, ValueError):
+        return None
+
+
+def is_running(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def children(pid):
+    '''The pids of the child processes of pid (Linux /proc).'''
+    found = []
+    for name in os.listdir('/proc'):
+        if not name.isdigit():
+            continue
+        stat = _read('/proc/{}/stat'.format(name))
+        # pid (comm) state ppid ..., comm may contain spaces
+        if stat and int(stat.rsplit(')', 1)[1].split()[1]) == pid:
+            found.append(int(name))
+    return found
+
+
+def _wait(condition, timeout, message, poll=0.2):
+    deadline = time.time() + timeout
+    while not condition():
+        if time.time() > deadline:
+            raise RuntimeError(message)
+        time.sleep(poll)
+
+
+def rolling_reload(pidfile=PIDFILE, timeout=60.0, log=print):
+    '''Replaces the gunicorn master of pidfile and its workers by new ones
+    running the code on disk, without refusing connections:
+
+    1. USR2: the master re-executes itself; the new master preloads the
+       app once and forks its workers (sharing its memory), listening on
+       the inherited sockets. gunicorn moves the old pidfile to .oldbin.
+    2. Once the new master has as many workers as the old one, TERM to the
+       old master: its workers stop accepting, finish their requests and
+       exit (WINCH only applies to daemonized masters).
+
+    HUP is not enough with --preload: its workers would be forked from the
+    old master, with the old code.'''
+    old = read_pid(pidfile)
+    if old is None or not is_running(old):
+        raise RuntimeError('No gunicorn master in {}.'.format(pidfile))
+    workers = len(children(old))
+    log('Reloading master {} ({} workers).'.format(old, workers))
+    os.kill(old, signal.SIGUSR2)
+
+    def new_master():
+        pid = read_pid(pidfile)
+        return pid if pid not in (None, old) else None
+
+    _wait(new_master, timeout, 'The new master did not start.')
+    new = new_master()
+    _wait(lambda: len(children(new)) >= workers or not is_running(new),
+          timeout, 'The workers of master {} did not start.'.format(new))
+    if not is_running(new):
+        raise RuntimeError(
+            'The new master {} exited, {} still serves.'.format(new, old))
+    log('Master {} is up with {} workers, stopping {}.'.format(
+        new, len(children(new)), old))
+    os.kill(old, signal.SIGTERM)
+    _wait(lambda: not is_running(old), timeout,
+          'Master {} did not stop.'.format(old))
+    return new
@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+import os
+import subprocess
+import sys
+
+import nose.tools as nt
+
+from birdseye import production
+
+
+MB = 1024 * 1024
+
+
+def test_worker_count():
+    nt.assert_equal(production.worker_count(cpus=8, memory=64 * 1024 * MB), 8)
+    # memory bound
+    nt.assert_equal(production.worker_count(
+        cpus=8, memory=1024 * MB, worker_memory=256 * MB), 4)
+    nt.assert_equal(production.worker_count(
+        cpus=8, memory=100 * MB, worker_memory=256 * MB), 1)
+    nt.assert_equal(production.worker_count(
+        cpus=2, memory=None, worker_memory=256 * MB, workers_per_cpu=2), 4)
+
+
+def test_cpu_count_within_affinity():
+    cpus = production.cpu_count()
+    nt.assert_greater_equal(cpus, 1)
+    nt.assert_less_equal(cpus, os.cpu_count())
+
+
+def test_gunicorn_command():
+    command = production.gunicorn_command(
+        bind='0.0.0.0:8000', workers=4, pidfile='test.pid', reuse_port=True)
+    nt.assert_equal(command[:3], ['gunicorn', '-w', '4'])
+    nt.assert_in('--preload', command)
+    nt.assert_in('--reuse-port', command)
+    nt.assert_equal(command[-1], 'birdseye.wsgi:app')
+    nt.assert_not_in('--reuse-port', production.gunicorn_command())
+
+
+def test_children():
+    proc = subprocess.Popen([sys.executable, '-c', 'input()'],
+                            stdin=subprocess.PIPE)
+    try:
+        nt.assert_in(proc.pid, production.children(os.getpid()))
+    finally:
+        proc.communicate(b'\n')
+    nt.assert_not_in(proc.pid, production.children(os.getpid()))
+
+
+def test_worker_commands():
+    pools = [(['local', 'default'], 2), (['vision'], 0)]
+    manage = ['birdseye']
+    nt.assert_equal(production.worker_commands(pools, manage), [
+        ['birdseye', 'rq', 'worker', 'local', 'default'],
+        ['birdseye', 'rq', 'worker', 'local', 'default']])
+    nt.assert_equal(
+        production.worker_commands(pools, manage, mode='persistent'),
+        [['birdseye', 'rq', 'persistent', '--processes', '2', 'local',
+          'default']])
+    nt.assert_equal(
+        production.worker_commands(pools, manage, mode='gevent',
+                                   concurrency=20),
+        [['birdseye', 'rq', 'persistent', '--processes', '2',
+          '--concurrency', '20', 'local', 'default']])
@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+'''
+Sampling profiler
+-----------------
+
+Opt-in, per request or per rq job: a SIGPROF timer fires every
+PROFILE_INTERVAL seconds of CPU time and the handler records the stack of
+the greenlet being profiled, if it is the one running. Samples are written
+as collapsed stacks (``frame;frame;frame count`` lines, the input of
+flamegraph.pl and speedscope) to PROFILE_DIR, which keeps the
+PROFILE_MAX_FILES newest profiles.
+
+A request is profiled when it has a valid PROFILE_HEADER (see sign; `birdseye
+profile_token` prints one) or, at random, for a PROFILE_REQUEST_FRACTION of
+requests. Jobs are profiled for a PROFILE_JOB_FRACTION of them (see
+ProfiledJob). When nothing is profiled no timer runs: the cost is a header
+lookup per request.
+'''
+from collections import Counter
+from datetime import datetime
+import hashlib
+import hmac
+import logging
+import os
+import random
+import re
+import signal
+import time
+import uuid
+
+from flask_rq2.job import FlaskJob
+from greenlet import getcurrent
+
+from birdseye.default_settings import (
+    PROFILE_DIR, PROFILE_MAX_FILES, PROFILE_INTERVAL, PROFILE_SECRET,
+    PROFILE_JOB_FRACTION)
+
+
+log = logging.getLogger('profiler')
+
+PROFILE_HEADER = 'X-Birdseye-Profile'
+SUFFIX = '.collapsed'
+
+# greenlet: its running Profile
+_active = {}
+_handler_installed = False
+
+
+def sign(expires, secret=None):
+    '''The PROFILE_HEADER value profiling requests until expires (epoch
+    seconds).'''
+    secret = secret or PROFILE_SECRET
+    digest = hmac.new(secret.encode('utf8'), str(int(expires)).encode(),
+                      hashlib.sha256).hexdigest()
+    return '{}:{}'.format(int(expires), digest)
+
+
+def valid_token(value, secret=None, now=None):
+    secret = secret or PROFILE_SECRET
+    if not value or not secret:
+        return False
+    expires, _, _ = value.partition(':')
+    try:
+        if int(expires) < (now or time.time()):
+            return False
+    except ValueError:
+        return False
+    return hmac.compare_digest(value, sign(expires, secret))
+
+
+def should_profile(header_value, fraction):
+    return (valid_token(header_value) or
+            (fraction > 0 and random.random() < fraction))
+
+
+def _frame_name(code):
+    return '{}:{}:{}'.format(
+        os.path.basename(code.co_filename), code.co_name, code.co_firstlineno)
+
+
+def _stack(frame):
+    names = []
+    while frame is not None:
+        names.append(_frame_name(frame.f_code))
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+def _sample(signum, frame):
+    profile = _active.get(getcurrent())
+    if profile is not None and frame is not None:
+        profile.samples[_stack(frame)] += 1
+
+
+def _update_timer():
+    if _active:
+        if signal.getitimer(signal.ITIMER_PROF)[1] == 0:
+            signal.setitimer(
+                signal.ITIMER_PROF, PROFILE_INTERVAL, PROFILE_INTERVAL)
+    else:
+        signal.setitimer(signal.ITIMER_PROF, 0)
+
+
+class Profile(object):
+    '''The samples of one request or job, taken while its greenlet runs.'''
+
+    def __init__(self, kind, name):
+        self.kind = kind
+        self.name = re.sub(r'[^\w.-]+', '_', name or 'unknown')[:80]
+        self.filename = '{:%Y%m%dT%H%M%S}-{}-{}-{}{}'.format(
+            datetime.utcnow(), kind, self.name, uuid.uuid4().hex[:8],
+            SUFFIX)
+        self.samples = Counter()
+        self.greenlet = None
+
+    def start(self):
+        '''Starts sampling the current greenlet. Returns False when signals
+        can not be handled here (not the main thread).'''
+        global _handler_installed
+        if not _handler_installed:
+            try:
+                signal.signal(signal.SIGPROF, _sample)
+            except ValueError:
+                log.warning('Not profiling %s, not in the main thread.',
+                            self.name)
+                return False
+            _handler_installed = True
+        self.greenlet = getcurrent()
+        _active[self.greenlet] = self
+        _update_timer()
+        return True
+
+    def stop(self):
+        '''Stops sampling, returns whether it was running.'''
+        if _active.get(self.greenlet) is not self:
+            return False
+        del _active[self.greenlet]
+        _update_timer()
+        return True
+
+    def save(self, directory=None, max_files=None):
+        '''Writes the collapsed stacks, drops the oldest profiles past
+        max_files. Returns the path.'''
+        directory = directory or PROFILE_DIR
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, self.filename)
+        with open(path, 'w') as f:
+            for stack, count in self.samples.most_common():
+                f.write('{} {}\n'.format(stack, count))
+        prune(directory, max_files or PROFILE_MAX_FILES)
+        return path
+
+
+def list_profiles(directory=None):
+    '''The saved profiles, newest first: dicts of name, size, modified.'''
+    directory = directory or PROFILE_DIR
+    try:
+        names = os.listdir(directory)
+    except FileNotFoundError:
+        return []
+    profiles = []
+    for name in names:
+        if not name.endswith(SUFFIX):
+            continue
+        try:
+            st = os.stat(os.path.join(directory, name))
+        except OSError:  # pruned meanwhile
+            continue
+        profiles.append({'name': name, 'size': st.st_size,
+                         'modified': st.st_mtime})
+    profiles.sort(key=lambda p: (p['modified'], p['name']), reverse=True)
+    return profiles
+
+
+def profile_path(name, directory=None):
+    '''The path of the saved profile name, None if there is no such one.'''
+    directory = directory or PROFILE_DIR
+    if os.path.basename(name) != name or not name.endswith(SUFFIX):
+        return None
+    path = os.path.join(directory, name)
+    return path if os.path.isfile(path) else None
+
+
+def prune(directory, max_files):
+    for profile in list_profiles(directory)[max_files:]:
+        try:
+            os.remove(os.path.join(directory, profile['name']))
+        except OSError:
+            pass
+
+
+class ProfiledJob(FlaskJob):
+    '''The rq job class (RQ_JOB_CLASS): profiles PROFILE_JOB_FRACTION of the
+    jobs.'''
+
+    def perform(self):
+        if not should_profile(None, PROFILE_JOB_FRACTION):
+            return super().perform()
+        profile = Profile('job', self.func_name)
+        started = profile.start()
+        try:
+            return super().perform()
+        finally:
+            if started and profile.stop():
+                profile.save()
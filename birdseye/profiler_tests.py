@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+import time
+
+import nose.tools as nt
+
+import birdseye.profiler as profiler
+
+
+SECRET = 'profiling secret'
+
+
+def test_tokens():
+    token = profiler.sign(time.time() + 60, SECRET)
+    nt.assert_true(profiler.valid_token(token, SECRET))
+    nt.assert_false(profiler.valid_token(token, 'other secret'))
+    nt.assert_false(profiler.valid_token(token + '0', SECRET))
+    expired = profiler.sign(time.time() - 1, SECRET)
+    nt.assert_false(profiler.valid_token(expired, SECRET))
+    nt.assert_false(profiler.valid_token('garbage', SECRET))
+    nt.assert_false(profiler.valid_token(None, SECRET))
+
+
+def _busy(seconds):
+    deadline = time.process_time() + seconds
+    while time.process_time() < deadline:
+        sum(range(1000))
+
+
+class ProfileTest(object):
+
+    def setup(self):
+        self.dir = tempfile.mkdtemp()
+
+    def teardown(self):
+        shutil.rmtree(self.dir)
+
+    @nt.with_setup(setup, teardown)
+    def test_samples_saved_as_collapsed_stacks(self):
+        profile = profiler.Profile('request', 'GET /v1/species')
+        nt.assert_true(profile.start())
+        _busy(0.2)
+        nt.assert_true(profile.stop())
+        nt.assert_false(profile.stop())
+        nt.assert_greater(sum(profile.samples.values()), 0)
+        path = profile.save(self.dir, 10)
+        with open(path) as f:
+            stack, count = f.readline().rsplit(' ', 1)
+        nt.assert_in('profiler_tests.py:_busy', stack)
+        nt.assert_greater(int(count), 0)
+        nt.assert_equal(profiler.profile_path(profile.filename, self.dir),
+                        path)
+        nt.assert_is_none(profiler.profile_path('../x.collapsed', self.dir))
+
+    @nt.with_setup(setup, teardown)
+    def test_keeps_the_newest(self):
+        for i in range(4):
+            profile = profiler.Profile('job', 'job{}'.format(i))
+            path = profile.save(self.dir, 3)
+            os.utime(path, (i, i))
+        nt.assert_equal(
+            [p['name'].split('-')[2] for p in profiler.list_profiles(
+                self.dir)], ['job3', 'job2', 'job1'])
+        profiler.Profile('job', 'job4').save(self.dir, 3)
+        nt.assert_equal(len(profiler.list_profiles(self.dir)), 3)
@@ -27,7 +27,7 @@ import pubnub
 from pubnub.pnconfiguration import PNConfiguration
 from pubnub.pubnub import PubNub
 
-from birdseye.default_settings import SQLALCHEMY_DATABASE_URI
+from birdseye.default_settings import SQLALCHEMY_DATABASE_URI, PUBSUB_BACKEND
 import birdseye.models as bm
 
 
@@ -123,6 +123,14 @@ class PubSub(object, metaclass=Singleton):
                     ch, envelope.status.error))
 
 
+def get_pubsub():
+    '''The PubSub configured by the PUBSUB_BACKEND setting.'''
+    if PUBSUB_BACKEND == 'stub':
+        from birdseye.stubs import StubPubSub
+        return StubPubSub()
+    return PubSub()
+
+
 if __name__ == "__main__":
     pubnub.set_stream_logger('pubnub', logging.ERROR)
     pubsub = PubSub()
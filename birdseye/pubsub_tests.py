@@ -13,7 +13,8 @@ from pubnub.endpoints.pubsub.publish import Publish
 
 import nose.tools as nt
 
-from birdseye.pubsub import PubSub, PubSubError, Singleton
+from birdseye.pubsub import PubSub, PubSubError, Singleton, get_pubsub
+from birdseye.stubs import StubPubSub
 
 
 random.seed()
@@ -42,6 +43,19 @@ def teardown_singleton_pubsub():
         del instances[PubSub]
 
 
+class StubPubSubTest(object):
+
+    def teardown(self):
+        Singleton._instances.pop(StubPubSub, None)
+
+    @patch('birdseye.pubsub.PUBSUB_BACKEND', 'stub')
+    def test_counts_across_calls(self):
+        get_pubsub().publish('one')
+        get_pubsub().publish('two')
+        nt.assert_is(get_pubsub(), StubPubSub())
+        nt.assert_equal(get_pubsub().published, 2)
+
+
 mockpn = create_autospec(PubNub)
 mockenv = Mock()  # Envolpe is a stranger beast
 mockstatus = create_autospec(PNStatus)
@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+'''
+Rate limiting
+-------------
+
+Token buckets kept in Redis, shared by every process using the same key:
+``rate`` tokens per second refill a bucket of ``capacity`` tokens. The
+refill and take happen atomically in a Lua script. When Redis is
+unavailable buckets fail open (everything is allowed).
+
+Limiter keeps one bucket per client (API rate limits), TokenBucket alone
+paces a shared resource (the Vision API).
+'''
+import logging
+import time
+
+from redis.exceptions import RedisError
+
+from birdseye.cache import LRUCache
+
+
+log = logging.getLogger('ratelimit')
+
+# KEYS[1]: bucket, ARGV: rate, capacity, now (seconds), requested tokens
+# Returns {allowed (0/1), seconds to wait (string), tokens left (string)}
+TOKEN_BUCKET_LUA = '''
+local rate = tonumber(ARGV[1])
+local capacity = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local requested = tonumber(ARGV[4])
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(bucket[1]) or capacity
+local ts = tonumber(bucket[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate)
+local allowed = 0
+local wait = 0
+if tokens >= requested then
+    tokens = tokens - requested
+    allowed = 1
+else
+    wait = (requested - tokens) / rate
+end
+redis.call('HMSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now))
+redis.call('PEXPIRE', KEYS[1], math.ceil(capacity / rate * 1000) + 1000)
+return {allowed, tostring(wait), tostring(tokens)}
+'''
+
+
+class RateLimited(RuntimeError):
+
+    def __init__(self, key, retry_after):
+        super().__init__('Rate limit {} exceeded, retry after {:.2f}s'.format(
+            key, retry_after))
+        self.retry_after = retry_after
+
+
+class TokenBucket(object):
+
+    def __init__(self, connection, key, rate, capacity):
+        '''connection: a redis client or a callable returning one.'''
+        self._connection = connection
+        self.key = 'birdseye:bucket:{}'.format(key)
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self._script = None
+
+    @property
+    def connection(self):
+        conn = self._connection
+        return conn() if callable(conn) else conn
+
+    def take(self, tokens=1):
+        '''Takes tokens if available. Returns (allowed, seconds to wait until
+        they would be, tokens left).'''
+        try:
+            if self._script is None:
+                self._script = self.connection.register_script(
+                    TOKEN_BUCKET_LUA)
+            allowed, wait, left = self._script(
+                keys=[self.key],
+                args=[self.rate, self.capacity, time.time(), tokens],
+                client=self.connection)
+        except RedisError as e:
+            log.warning('Token bucket %s unavailable: %s', self.key, e)
+            return True, 0.0, self.capacity
+        return bool(allowed), float(wait), float(left)
+
+    def acquire(self, tokens=1, timeout=None):
+        '''Waits (sleeping, gevent friendly) until tokens are taken. Raises
+        RateLimited when that would take longer than timeout seconds.'''
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            allowed, wait, _ = self.take(tokens)
+            if allowed:
+                return
+            if deadline is not None and \
+                    time.monotonic() + wait > deadline:
+                raise RateLimited(self.key, wait)
+            time.sleep(wait)
+
+
+class _Lease(object):
+    __slots__ = ('bucket', 'tokens', 'denied_until')
+
+    def __init__(self, bucket):
+        self.bucket = bucket
+        self.tokens = 0
+        self.denied_until = 0.0
+
+
+class Limiter(object):
+    '''Per client token buckets shared through Redis, spent from process
+    local leases: a worker takes up to ``lease`` tokens at once and only
+    goes back to Redis once they are spent. A rejected client is rejected
+    locally until its retry time has passed. Clients can exceed the limit
+    by the tokens leased to other workers.'''
+
+    def __init__(self, name, connection, rate, capacity, lease=1,
+                 cache_size=10000):
+        self.name = name
+        self.rate = rate
+        self.capacity = capacity
+        self.lease = max(1, min(int(lease), int(capacity)))
+        self._connection = connection
+        self._leases = LRUCache(cache_size)
+
+    def check(self, client):
+        '''None when client may proceed, otherwise the seconds to wait.'''
+        now = time.monotonic()
+        lease = self._leases.get(client)
+        if lease is None:
+            lease = _Lease(TokenBucket(
+                self._connection, '{}:{}'.format(self.name, client),
+                self.rate, self.capacity))
+            self._leases.set(client, lease)
+        if lease.tokens < 1 and lease.denied_until <= now:
+            self._refill(lease, now)
+        if lease.tokens >= 1:
+            lease.tokens -= 1
+            return None
+        return lease.denied_until - now
+
+    def refund(self, client):
+        '''Gives back the token client was just allowed by check(), e.g.
+        when another limit rejected the request.'''
+        lease = self._leases.get(client)
+        if lease is not None:
+            lease.tokens += 1
+
+    def _refill(self, lease, now):
+        for tokens in sorted({self.lease, 1}, reverse=True):
+            allowed, wait, _ = lease.bucket.take(tokens)
+            if allowed:
+                lease.tokens += tokens
+                return
+        lease.denied_until = now + wait
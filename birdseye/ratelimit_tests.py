@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+import uuid
+from unittest.mock import Mock, patch
+
+import nose.tools as nt
+from nose.plugins.skip import SkipTest
+from redis import StrictRedis
+from redis.exceptions import ConnectionError, RedisError
+
+from birdseye.ratelimit import TokenBucket, RateLimited, Limiter
+
+
+def redis_or_skip():
+    conn = StrictRedis()
+    try:
+        conn.ping()
+    except ConnectionError:
+        raise SkipTest('needs a redis server')
+    return conn
+
+
+def test_bucket_takes_burst_then_limits():
+    conn = redis_or_skip()
+    bucket = TokenBucket(conn, uuid.uuid4().hex, rate=1, capacity=3)
+    taken = [bucket.take()[0] for _ in range(4)]
+    nt.assert_equal(taken, [True, True, True, False])
+    allowed, wait, left = bucket.take()
+    nt.assert_false(allowed)
+    nt.assert_true(0 < wait <= 1.0)
+    conn.delete(bucket.key)
+
+
+def test_bucket_fails_open():
+    conn = Mock()
+    conn.register_script.side_effect = RedisError('down')
+    bucket = TokenBucket(conn, 'down', rate=1, capacity=3)
+    nt.assert_equal(bucket.take(), (True, 0.0, 3.0))
+
+
+def test_acquire_times_out():
+    bucket = TokenBucket(None, 'slow', rate=1, capacity=1)
+    with patch.object(bucket, 'take', return_value=(False, 5.0, 0.0)):
+        with nt.assert_raises(RateLimited) as cm:
+            bucket.acquire(timeout=1)
+    nt.assert_equal(cm.exception.retry_after, 5.0)
+
+
+def test_acquire_waits():
+    bucket = TokenBucket(None, 'wait', rate=1, capacity=1)
+    takes = [(False, 0.5, 0.0), (True, 0.0, 0.0)]
+    with patch.object(bucket, 'take', side_effect=takes), \
+            patch('birdseye.ratelimit.time.sleep') as sleep:
+        bucket.acquire(timeout=1)
+    sleep.assert_called_once_with(0.5)
+
+
+def test_limiter_spends_leases_locally():
+    limiter = Limiter('test', None, rate=1, capacity=10, lease=3)
+    with patch.object(TokenBucket, 'take',
+                      return_value=(True, 0.0, 7.0)) as take:
+        nt.assert_equal([limiter.check('joe') for _ in range(3)],
+                        [None] * 3)
+        take.assert_called_once_with(3)
+        nt.assert_is_none(limiter.check('joe'))
+        nt.assert_equal(take.call_count, 2)
+
+
+def test_limiter_rejects_locally():
+    limiter = Limiter('test', None, rate=1, capacity=10, lease=3)
+    with patch.object(TokenBucket, 'take',
+                      return_value=(False, 2.0, 0.0)) as take:
+        wait = limiter.check('joe')
+        nt.assert_true(0 < wait <= 2.0)
+        # the lease, then a single token
+        nt.assert_equal([c[0] for c in take.call_args_list], [(3,), (1,)])
+        nt.assert_true(0 < limiter.check('joe') <= wait)
+        nt.assert_equal(take.call_count, 2)
+
+
+def test_limiter_refund():
+    limiter = Limiter('test', None, rate=1, capacity=10, lease=1)
+    with patch.object(TokenBucket, 'take',
+                      return_value=(True, 0.0, 9.0)) as take:
+        nt.assert_is_none(limiter.check('joe'))
+        limiter.refund('joe')
+        nt.assert_is_none(limiter.check('joe'))
+        nt.assert_equal(take.call_count, 1)
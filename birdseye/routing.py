@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+'''
+Read replica routing
+--------------------
+
+Sessions marked as reading (``session.info['read_replica']``, set for GET
+requests by birdseye.api) run their queries on a replica bind. Everything
+else stays on the primary: writes, flushes, and any query in a session
+after it has written (read-after-write, e.g. a refresh after insert).
+
+Replicas are the SQLALCHEMY_BINDS named in SQLALCHEMY_READ_BINDS. A replica
+lagging more than SQLALCHEMY_REPLICA_MAX_LAG seconds, or failing its lag
+check, is skipped until the next check; with no replica left reads fall
+back to the primary.
+'''
+import logging
+import random
+import re
+import threading
+import time
+
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+import sqlalchemy
+from sqlalchemy import orm
+from sqlalchemy.sql.dml import UpdateBase
+from sqlalchemy.sql.elements import TextClause
+
+
+log = logging.getLogger('routing')
+
+READ_REPLICA = 'read_replica'
+WROTE = 'wrote'
+
+LAG_SQL = sqlalchemy.text('''
+SELECT CASE
+    WHEN NOT pg_is_in_recovery() THEN 0
+    WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+    ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())
+END
+''')
+
+
+# statements of a text clause that write or lock: writable CTEs (WITH moved
+# AS (DELETE ...)), SELECT ... FOR UPDATE, SELECT INTO
+WRITES = re.compile(r'\b(INSERT|UPDATE|DELETE|MERGE|INTO|SHARE)\b')
+
+
+def is_read_clause(clause):
+    if clause is None or isinstance(clause, UpdateBase):
+        return False
+    if isinstance(clause, TextClause):
+        sql = clause.text.lstrip().upper()
+        return (sql.startswith(('SELECT', 'WITH')) and
+                not WRITES.search(sql))
+    return True
+
+
+def replica_lag(engine):
+    with engine.connect() as conn:
+        return float(conn.execute(LAG_SQL).scalar() or 0)
+
+
+class ReplicaSet(object):
+    '''Picks a healthy replica engine, health is re-checked at most every
+    check_interval seconds per replica.'''
+
+    def __init__(self, engines, max_lag, check_interval, lag=replica_lag):
+        '''engines: callables returning the replica engines.'''
+        self.engines = list(engines)
+        self.max_lag = max_lag
+        self.check_interval = check_interval
+        self.lag = lag
+        self._checked = {}
+        self._lock = threading.Lock()
+
+    def _healthy(self, index):
+        now = time.monotonic()
+        checked_at, healthy = self._checked.get(index, (None, False))
+        if checked_at is not None and now - checked_at < self.check_interval:
+            return healthy
+        with self._lock:
+            try:
+                lag = self.lag(self.engines[index]())
+                healthy = lag <= self.max_lag
+                if not healthy:
+                    log.warning('Replica %d lags %.1fs', index, lag)
+            except sqlalchemy.exc.SQLAlchemyError as e:
+                log.warning('Replica %d unavailable: %s', index, e)
+                healthy = False
+            self._checked[index] = (now, healthy)
+        return healthy
+
+    def pick(self):
+        '''A healthy replica engine or None.'''
+        candidates = list(range(len(self.engines)))
+        random.shuffle(candidates)
+        for index in candidates:
+            if self._healthy(index):
+                return self.engines[index]()
+        return None
+
+
+class RoutingSession(SignallingSession):
+
+    def __init__(self, db, *args, **kwargs):
+        # SignallingSession does not keep db, only its app
+        self.db = db
+        super().__init__(db, *args, **kwargs)
+
+    def get_bind(self, mapper=None, clause=None):
+        if self.info.get(READ_REPLICA) and not self.info.get(WROTE) \
+                and not self._flushing and is_read_clause(clause):
+            engine = self.db.get_replicas(self.app).pick()
+            if engine is not None:
+                return engine
+        return super().get_bind(mapper, clause)
+
+
+@sqlalchemy.event.listens_for(RoutingSession, 'after_flush')
+def _wrote(session, flush_context):
+    session.info[WROTE] = True
+
+
+@sqlalchemy.event.listens_for(RoutingSession, 'after_bulk_update')
+@sqlalchemy.event.listens_for(RoutingSession, 'after_bulk_delete')
+def _bulk_wrote(context):
+    context.session.info[WROTE] = True
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+
+    def __init__(self, *args, **kwargs):
+        self._replicas = {}
+        super().__init__(*args, **kwargs)
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+    def get_replicas(self, app=None):
+        app = self.get_app(app)
+        replicas = self._replicas.get(app)
+        if replicas is None:
+            replicas = self._replicas[app] = ReplicaSet(
+                [self._engine_getter(app, key)
+                 for key in app.config['SQLALCHEMY_READ_BINDS']],
+                app.config['SQLALCHEMY_REPLICA_MAX_LAG'],
+                app.config['SQLALCHEMY_REPLICA_CHECK_INTERVAL'])
+        return replicas
+
+    def _engine_getter(self, app, bind):
+        return lambda: self.get_engine(app, bind=bind)
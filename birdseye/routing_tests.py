@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+
+from sqlalchemy import text
+from sqlalchemy.exc import OperationalError
+import nose.tools as nt
+
+import birdseye.models as bm
+from birdseye import app, db
+from birdseye.routing import ReplicaSet, is_read_clause, READ_REPLICA
+
+
+class FakeClock(object):
+
+    def __init__(self, lags):
+        self.lags = lags
+        self.checks = 0
+
+    def lag(self, engine):
+        self.checks += 1
+        lag = self.lags[engine]
+        if isinstance(lag, Exception):
+            raise lag
+        return lag
+
+
+class ReplicaSetTest(object):
+
+    def _replicas(self, lags, check_interval=60):
+        self.clock = FakeClock(lags)
+        return ReplicaSet([lambda e=e: e for e in sorted(lags)], 5.0,
+                          check_interval, lag=self.clock.lag)
+
+    def test_pick_healthy(self):
+        replicas = self._replicas({'a': 0.1, 'b': 30.0})
+        for _ in range(10):
+            nt.assert_equal(replicas.pick(), 'a')
+        # health is cached between checks, at most one check per replica
+        nt.assert_less_equal(self.clock.checks, 2)
+
+    def test_fallback_to_primary(self):
+        error = OperationalError('SELECT 1', {}, Exception('down'))
+        replicas = self._replicas({'a': error, 'b': 6.0})
+        nt.assert_is_none(replicas.pick())
+
+    def test_recheck(self):
+        replicas = self._replicas({'a': 10.0}, check_interval=0)
+        nt.assert_is_none(replicas.pick())
+        self.clock.lags['a'] = 0.0
+        nt.assert_equal(replicas.pick(), 'a')
+
+
+class ReadClauseTest(object):
+
+    def test_is_read_clause(self):
+        table = bm.User.__table__
+        nt.assert_true(is_read_clause(table.select()))
+        nt.assert_true(is_read_clause(text('WITH a AS (SELECT 1) SELECT 2')))
+        nt.assert_false(is_read_clause(table.insert()))
+        nt.assert_false(is_read_clause(table.delete()))
+        nt.assert_false(is_read_clause(text('DELETE FROM users')))
+        nt.assert_false(is_read_clause(text(
+            'WITH moved AS (DELETE FROM a RETURNING *) '
+            'INSERT INTO b SELECT * FROM moved')))
+        nt.assert_false(is_read_clause(text(
+            'SELECT * FROM users FOR UPDATE SKIP LOCKED')))
+        nt.assert_true(is_read_clause(text('SELECT updated FROM users')))
+        nt.assert_false(is_read_clause(None))
+
+
+class RoutingSessionTest(object):
+    '''With SQLALCHEMY_REPLICA_URIS pointing at a second local Postgres the
+    reads go there, without replicas they fall back to the primary.'''
+
+    def test_read_after_write_on_primary(self):
+        with app.app_context():
+            session = db.session()
+            session.info[READ_REPLICA] = True
+            primary = db.get_engine(app)
+            replica = db.get_replicas(app).pick() or primary
+            query = bm.User.__table__.select()
+            nt.assert_equal(session.get_bind(clause=query), replica)
+            nt.assert_equal(session.get_bind(
+                clause=bm.User.__table__.insert()), primary)
+
+            user = bm.User({'email': 'replica@example.com'}, 'secret')
+            session.add(user)
+            session.flush()
+            nt.assert_equal(session.get_bind(clause=query), primary)
+            session.rollback()
+            db.session.remove()
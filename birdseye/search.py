@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+'''
+Species search
+--------------
+
+Type-ahead over species names and labels: prefix matches come from a sorted
+in-process index of the (small) species catalog, the remaining slots are
+filled by fuzzy pg_trgm matches from the database.
+
+Ranking of prefix matches: whole name or label before word within it, then
+shorter terms, then catalog order. The index is rebuilt on the first search
+after a species write, in any worker (see birdseye.cache.Generations).
+'''
+import bisect
+import itertools
+import threading
+import unicodedata
+
+import sqlalchemy
+
+from birdseye import rq
+from birdseye.cache import Generations
+import birdseye.models as bm
+
+
+def normalize(text):
+    '''Lower cased, accents stripped.'''
+    decomposed = unicodedata.normalize('NFKD', text or '')
+    return ''.join(
+        c for c in decomposed if not unicodedata.combining(c)).lower()
+
+
+def species_terms(names, labels):
+    '''(term, whole) pairs a species is found by: its names and labels as
+    whole terms and every later word within them.'''
+    phrases = [(names or {}).get(k) for k in ('common', 'scientific')]
+    phrases += list(labels or ())
+    for phrase in phrases:
+        phrase = normalize(phrase).strip()
+        if not phrase:
+            continue
+        yield phrase, True
+        for word in phrase.split()[1:]:
+            yield word, False
+
+
+class PrefixIndex(object):
+    '''Sorted (term, rank, position, key) entries, searched with bisect.'''
+
+    def __init__(self, items=()):
+        '''items: (key, names, labels, value) tuples in catalog order.'''
+        self.values = {}
+        entries = []
+        for position, (key, names, labels, value) in enumerate(items):
+            self.values[key] = value
+            for term, whole in species_terms(names, labels):
+                entries.append((term, 0 if whole else 1, position, key))
+        entries.sort()
+        self.terms = [e[0] for e in entries]
+        self.entries = entries
+
+    def search(self, prefix, limit):
+        '''The values of up to limit best keys having a term starting with
+        prefix.'''
+        prefix = normalize(prefix).strip()
+        if not prefix:
+            return []
+        start = bisect.bisect_left(self.terms, prefix)
+        matches = []
+        for i in range(start, len(self.terms)):
+            if not self.terms[i].startswith(prefix):
+                break
+            term, rank, position, key = self.entries[i]
+            matches.append((rank, len(term), position, key))
+        matches.sort()
+        found, seen = [], set()
+        for _, _, _, key in matches:
+            if key not in seen:
+                seen.add(key)
+                found.append(key)
+                if len(found) >= limit:
+                    break
+        return [(key, self.values[key]) for key in found]
+
+
+class SpeciesIndex(object):
+
+    def __init__(self, generations):
+        self.generations = generations
+        self._index = None
+        self._generation = None
+        self._lock = threading.Lock()
+
+    def invalidate(self):
+        self._index = None
+        self.generations.bump('catalog')
+
+    def current(self):
+        generation = self.generations.get('catalog')[0]
+        if self._index is not None and generation == self._generation:
+            return self._index
+        with self._lock:
+            if self._index is None or generation != self._generation:
+                species = bm.Species.find_all()
+                self._index = PrefixIndex(
+                    (s.species_id, s.names, s.labels, s.as_public_dict())
+                    for s in species)
+                self._generation = generation
+            return self._index
+
+
+species_index = SpeciesIndex(Generations('species', lambda: rq.connection))
+
+
+def search_species(q, limit):
+    '''Public dicts of up to limit species matching q, prefix matches
+    first.'''
+    found = species_index.current().search(q, limit)
+    if len(found) < limit:
+        exclude = [key for key, _ in found]
+        fuzzy = bm.Species.search_fuzzy(q, limit - len(found), exclude)
+        found += [(s.species_id, s.as_public_dict()) for s in fuzzy]
+    return [value for _, value in found]
+
+
+_CHANGED = 'birdseye.search.changed'
+
+
+@sqlalchemy.event.listens_for(sqlalchemy.orm.Session, 'before_flush')
+def _species_written(session, flush_context, instances):
+    written = itertools.chain(session.new, session.dirty, session.deleted)
+    if any(isinstance(o, bm.Species) for o in written):
+        session.info[_CHANGED] = True
+
+
+@sqlalchemy.event.listens_for(sqlalchemy.orm.Session, 'after_bulk_delete')
+@sqlalchemy.event.listens_for(sqlalchemy.orm.Session, 'after_bulk_update')
+def _species_bulk_written(context):
+    # updates: soft deletes
+    if context.mapper.class_ is bm.Species:
+        context.session.info[_CHANGED] = True
+
+
+@sqlalchemy.event.listens_for(sqlalchemy.orm.Session, 'after_commit')
+def _invalidate_committed(session):
+    if session.info.pop(_CHANGED, False):
+        species_index.invalidate()
+
+
+@sqlalchemy.event.listens_for(sqlalchemy.orm.Session, 'after_rollback')
+def _forget_rolled_back(session):
+    session.info.pop(_CHANGED, None)
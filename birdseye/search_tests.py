@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+
+import nose.tools as nt
+
+from birdseye.search import PrefixIndex, normalize
+
+
+CATALOG = [
+    ('heron', {'common': 'Grey Heron', 'scientific': 'Ardea cinerea'},
+     ['bird', 'heron'], 'grey heron'),
+    ('egret', {'common': 'Great Egret', 'scientific': 'Ardea alba'},
+     ['bird', 'egret'], 'great egret'),
+    ('fir', {'common': 'Grecian Fir', 'scientific': 'Abies cephalonica'},
+     ['conifer', 'plant'], 'grecian fir'),
+    ('bee', {'common': 'Bumblebee', 'scientific': 'Bombus'},
+     ['bee', 'insect'], 'bumblebee'),
+]
+
+
+class PrefixIndexTest(object):
+
+    def setup(self):
+        self.index = PrefixIndex(CATALOG)
+
+    def _keys(self, prefix, limit=10):
+        return [key for key, _ in self.index.search(prefix, limit)]
+
+    @nt.with_setup(setup)
+    def test_whole_terms_rank_first(self):
+        # 'grey heron' starts with 'gre' as a whole name, the heron label
+        # is shorter but only a word; fir and egret come by catalog order
+        nt.assert_equal(self._keys('gre'), ['heron', 'egret', 'fir'])
+        nt.assert_equal(self._keys('her'), ['heron'])
+        nt.assert_equal(self._keys('ardea'), ['egret', 'heron'])
+
+    @nt.with_setup(setup)
+    def test_word_within_name(self):
+        nt.assert_equal(self._keys('cine'), ['heron'])
+        nt.assert_equal(self._keys('alb'), ['egret'])
+
+    @nt.with_setup(setup)
+    def test_limit_and_values(self):
+        nt.assert_equal(self.index.search('b', 1), [('bee', 'bumblebee')])
+        # all whole terms: the label 'bee' is the shortest, then the 'bird'
+        # labels of heron and egret (same length) in catalog order
+        nt.assert_equal(self._keys('B'), ['bee', 'heron', 'egret'])
+
+    @nt.with_setup(setup)
+    def test_no_match(self):
+        nt.assert_equal(self._keys('zebra'), [])
+        nt.assert_equal(self._keys('  '), [])
+
+    def test_normalize(self):
+        nt.assert_equal(normalize('Ardéa Cinérea'), 'ardea cinerea')
+        nt.assert_equal(normalize(None), '')
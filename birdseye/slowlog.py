@@ -0,0 +1,239 @@
+# -*- coding: utf-8 -*-
+'''
+Slow query log
+--------------
+
+Statements running longer than SLOW_QUERY_MS are recorded with their
+parameters (redacted: numbers, booleans, dates and None are kept, other
+values are replaced by their type and length), the endpoint or job that ran
+them, and their plan. The plan is an ``EXPLAIN`` (not ANALYZE: the
+statement is not run again) on a separate connection, its string literals
+(the parameters, e.g. credentials) replaced by ``'?'``. In requests, a
+background thread explains and records, so the request that was slow does
+not wait for it. Jobs and commands record inline: the work horse of a
+forking rq worker exits as soon as its job is done, its threads with it. A
+statement already explained within SLOW_QUERY_EXPLAIN_INTERVAL reuses its
+plan.
+
+Records go to a Redis list shared by all the workers and jobs, trimmed to
+the SLOW_QUERY_BUFFER newest (``GET /v1/admin/slow_queries``).
+'''
+from datetime import date, datetime
+import hashlib
+import json
+import logging
+import queue
+import re
+import threading
+import time
+
+from flask import has_request_context, request
+from redis.exceptions import RedisError
+from rq import get_current_job
+import sqlalchemy
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import NullPool
+
+from birdseye.cache import LRUCache
+
+
+log = logging.getLogger('slowlog')
+
+KEY = 'birdseye:slow_queries'
+EXPLAINABLE = ('SELECT', 'WITH', 'INSERT', 'UPDATE', 'DELETE')
+# attribute of the execution context: dropped with it, also when the
+# statement fails (after_cursor_execute is not called then)
+_STARTED = '_slowlog_started'
+# a string literal, '' escapes a quote: e.g. '{"email": ...}'::jsonb
+LITERAL = re.compile(r"'(?:[^']|'')*'")
+
+
+def redact(value):
+    if isinstance(value, date):
+        return value.isoformat()
+    if value is None or isinstance(value, (bool, int, float)):
+        return value
+    if isinstance(value, (str, bytes)):
+        return '<{} {}>'.format(type(value).__name__, len(value))
+    return '<{}>'.format(type(value).__name__)
+
+
+def redact_parameters(parameters, executemany):
+    if executemany:
+        return [redact_parameters(p, False) for p in parameters[:3]]
+    if isinstance(parameters, dict):
+        return {key: redact(value) for key, value in parameters.items()}
+    return [redact(value) for value in parameters or ()]
+
+
+def scrub_plan(plan):
+    '''plan without its string literals, the parameters EXPLAIN inlined.
+    Numbers are kept, like redact() does.'''
+    return LITERAL.sub("'?'", plan)
+
+
+def caller():
+    '''The endpoint of the current request or the function of the current
+    job.'''
+    if has_request_context():
+        return '{} {}'.format(request.method, request.endpoint)
+    job = get_current_job()
+    if job is not None:
+        return 'job {}'.format(job.func_name)
+    return None
+
+
+class SlowQueryLog(object):
+
+    def __init__(self, connection, threshold, size=100,
+                 explain_interval=60.0, explain_timeout=5000):
+        '''connection: a redis client or a callable returning one;
+        threshold: seconds; explain_timeout: ms.'''
+        self._connection = connection
+        self.threshold = threshold
+        self.size = size
+        self.explain_interval = explain_interval
+        self.explain_timeout = explain_timeout
+        self._plans = LRUCache(256)
+        self._engines = {}
+        self._queue = queue.Queue(maxsize=100)
+        self._thread = None
+        self._lock = threading.Lock()
+
+    @property
+    def connection(self):
+        conn = self._connection
+        return conn() if callable(conn) else conn
+
+    def install(self):
+        sqlalchemy.event.listen(
+            Engine, 'before_cursor_execute', self.before_cursor_execute)
+        sqlalchemy.event.listen(
+            Engine, 'after_cursor_execute', self.after_cursor_execute)
+
+    def uninstall(self):
+        sqlalchemy.event.remove(
+            Engine, 'before_cursor_execute', self.before_cursor_execute)
+        sqlalchemy.event.remove(
+            Engine, 'after_cursor_execute', self.after_cursor_execute)
+
+    def before_cursor_execute(self, conn, cursor, statement, parameters,
+                              context, executemany):
+        if context is not None:  # None for a few internal statements
+            setattr(context, _STARTED, time.perf_counter())
+
+    def after_cursor_execute(self, conn, cursor, statement, parameters,
+                             context, executemany):
+        started = getattr(context, _STARTED, None)
+        if started is None:  # installed while the statement ran
+            return
+        duration = time.perf_counter() - started
+        if duration < self.threshold:
+            return
+        record = {
+            'time': datetime.utcnow().isoformat(),
+            'duration_ms': round(duration * 1000, 1),
+            'statement': statement,
+            'parameters': redact_parameters(parameters, executemany),
+            'caller': caller(),
+            'database': '{}/{}'.format(conn.engine.url.host or '',
+                                       conn.engine.url.database),
+            'plan': None,
+        }
+        explain = None
+        if not executemany and \
+                statement.lstrip().upper().startswith(EXPLAINABLE):
+            explain = (conn.engine.url, statement, parameters)
+        if not has_request_context():
+            self.write(record, explain)
+            return
+        try:
+            self._queue.put_nowait((record, explain))
+        except queue.Full:
+            log.warning('Slow query not logged, queue full: %s', statement)
+            return
+        self._ensure_thread()
+
+    def _ensure_thread(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(
+                    target=self._run, name='slowlog', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            self.write(*self._queue.get())
+
+    def write(self, record, explain):
+        if explain is not None:
+            record['plan'] = self.plan(*explain)
+        self.push(record)
+
+    def _engine(self, url):
+        engine = self._engines.get(url)
+        if engine is None:
+            engine = self._engines[url] = sqlalchemy.create_engine(
+                url, poolclass=NullPool)
+        return engine
+
+    def plan(self, url, statement, parameters):
+        '''The EXPLAIN of statement, reused for explain_interval.'''
+        key = hashlib.sha1(statement.encode('utf8')).hexdigest()
+        cached = self._plans.get(key)
+        if cached is not None and \
+                time.monotonic() - cached[0] < self.explain_interval:
+            return cached[1]
+        try:
+            plan = scrub_plan(self._explain(url, statement, parameters))
+        except Exception as e:
+            # the error may quote the statement, parameters inlined
+            plan = scrub_plan('EXPLAIN failed: {}'.format(e))
+        self._plans.set(key, (time.monotonic(), plan))
+        return plan
+
+    def _explain(self, url, statement, parameters):
+        # a raw DBAPI connection: not seen by the engine events above
+        raw = self._engine(url).raw_connection()
+        try:
+            cursor = raw.cursor()
+            cursor.execute('SET statement_timeout = {:d}'.format(
+                self.explain_timeout))
+            cursor.execute('EXPLAIN ' + statement, parameters)
+            return '\n'.join(row[0] for row in cursor.fetchall())
+        finally:
+            raw.rollback()
+            raw.close()
+
+    def push(self, record):
+        try:
+            pipe = self.connection.pipeline(transaction=False)
+            pipe.lpush(KEY, json.dumps(record, default=str))
+            pipe.ltrim(KEY, 0, self.size - 1)
+            pipe.execute()
+        except RedisError as e:
+            log.warning('Slow query not logged: %s', e)
+
+    def records(self, limit=None):
+        '''The logged slow queries of all workers, newest first.'''
+        end = (limit or self.size) - 1
+        try:
+            values = self.connection.lrange(KEY, 0, end)
+        except RedisError as e:
+            log.warning('Slow query log unavailable: %s', e)
+            return []
+        return [json.loads(v.decode('utf8') if isinstance(v, bytes) else v)
+                for v in values]
+
+
+# the log of this process, when SLOW_QUERY_MS is set (see install)
+slow_queries = None
+
+
+def install(connection, threshold, **kwargs):
+    '''Logs the statements of all the engines running longer than
+    threshold seconds.'''
+    global slow_queries
+    slow_queries = SlowQueryLog(connection, threshold, **kwargs)
+    slow_queries.install()
+    return slow_queries
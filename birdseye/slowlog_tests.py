@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+from datetime import datetime
+from unittest.mock import patch
+
+import flask
+import nose.tools as nt
+import sqlalchemy
+
+from birdseye.slowlog import SlowQueryLog, redact_parameters, scrub_plan
+
+
+def test_redact_parameters():
+    nt.assert_equal(redact_parameters({
+        'credentials': '{"email": "joe@example.com"}',
+        'limit': 10,
+        'since': datetime(2017, 4, 1),
+        'labels': ['bird'],
+        'species_id': None,
+    }, False), {
+        'credentials': '<str 28>',
+        'limit': 10,
+        'since': '2017-04-01T00:00:00',
+        'labels': '<list>',
+        'species_id': None,
+    })
+    nt.assert_equal(redact_parameters([('a', 1)] * 5, True),
+                    [['<str 1>', 1]] * 3)
+
+
+def test_scrub_plan():
+    plan = (
+        "Index Scan using ix_users_credentials on users  "
+        "(cost=0.14..8.16 rows=1 width=160)\n"
+        "  Filter: ((credentials = '{\"email\": \"joe@example.com\"}'"
+        "::jsonb) AND (social <> 'o''neil'::jsonb) AND (settings IS NULL))")
+    nt.assert_equal(scrub_plan(plan), (
+        "Index Scan using ix_users_credentials on users  "
+        "(cost=0.14..8.16 rows=1 width=160)\n"
+        "  Filter: ((credentials = '?'::jsonb) AND (social <> '?'::jsonb) "
+        "AND (settings IS NULL))"))
+
+
+class SlowQueryLogTest(object):
+
+    def setup(self):
+        self.engine = sqlalchemy.create_engine('sqlite://')
+        self.log = SlowQueryLog(None, threshold=60)
+        self.log.install()
+
+    def teardown(self):
+        self.log.uninstall()
+
+    def logged(self):
+        records = []
+        while not self.log._queue.empty():
+            records.append(self.log._queue.get_nowait())
+        return records
+
+    @nt.with_setup(setup, teardown)
+    @patch('birdseye.slowlog.SlowQueryLog._ensure_thread')
+    def test_records_slow_statements_only(self, ensure_thread):
+        select = sqlalchemy.text('SELECT :x')
+        with flask.Flask(__name__).test_request_context(), \
+                self.engine.connect() as conn:
+            conn.execute(select, {'x': 'fast'})
+            nt.assert_equal(self.logged(), [])
+            self.log.threshold = 0  # every statement is slow
+            conn.execute(select, {'x': 'secret'})
+        [(record, explain)] = self.logged()
+        nt.assert_greater_equal(record['duration_ms'], 0)
+        nt.assert_equal(record['parameters'], ['<str 6>'])
+        nt.assert_equal(record['caller'], 'GET None')
+        # the plan is captured out of band with the real parameters
+        nt.assert_equal(explain[1:], ('SELECT ?', ('secret',)))
+        nt.assert_true(ensure_thread.called)
+
+    @nt.with_setup(setup, teardown)
+    @patch('birdseye.slowlog.SlowQueryLog.push')
+    @patch('birdseye.slowlog.SlowQueryLog._explain')
+    def test_records_inline_out_of_requests(self, explain, push):
+        # a forked work horse exits right after its job: no thread
+        explain.return_value = "Result  (cost=0.00..0.01 rows=1)\n 'x'"
+        self.log.threshold = 0
+        with self.engine.connect() as conn:
+            conn.execute(sqlalchemy.text('SELECT :x'), {'x': 'secret'})
+        nt.assert_is_none(self.log._thread)
+        nt.assert_equal(self.logged(), [])
+        [((record,), _)] = push.call_args_list
+        nt.assert_equal(record['plan'],
+                        "Result  (cost=0.00..0.01 rows=1)\n '?'")
+
+    @nt.with_setup(setup, teardown)
+    def test_failed_statements_leave_nothing(self):
+        with self.engine.connect() as conn:
+            with nt.assert_raises(sqlalchemy.exc.OperationalError):
+                conn.execute('SELECT * FROM missing')
+            nt.assert_equal(conn.info, {})
+
+    @patch('birdseye.slowlog.SlowQueryLog._explain')
+    def test_failed_explain_scrubbed(self, explain):
+        explain.side_effect = RuntimeError(
+            'syntax error\nLINE 1: ... = \'{"email": "joe@example.com"}\'')
+        log = SlowQueryLog(None, threshold=0)
+        nt.assert_equal(
+            log.plan(None, 'SELECT 1', ()),
+            "EXPLAIN failed: syntax error\nLINE 1: ... = '?'")
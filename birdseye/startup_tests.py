@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+import subprocess
+import sys
+
+import nose.tools as nt
+from nose.plugins.skip import SkipTest
+
+
+# cumulative `import birdseye` budget, override with BIRDSEYE_STARTUP_BUDGET
+STARTUP_BUDGET_MS = float(os.getenv('BIRDSEYE_STARTUP_BUDGET', '1500'))
+
+# only needed by the jobs that use them, never by web workers
+LAZY_MODULES = ['google.cloud.vision', 'piexif', 'pubnub', 'pyarrow',
+                'setuptools_scm']
+
+
+def _python(*args):
+    return subprocess.run(
+        [sys.executable] + list(args), stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE, universal_newlines=True, check=True)
+
+
+def import_profile(module='birdseye'):
+    '''Runs `python -X importtime -c "import <module>"` in a fresh process.
+    Returns {imported module: (self us, cumulative us)}.'''
+    proc = _python('-X', 'importtime', '-c', 'import {}'.format(module))
+    profile = {}
+    for line in proc.stderr.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        fields = line[len('import time:'):].split('|')
+        try:
+            own, cumulative = int(fields[0]), int(fields[1])
+        except ValueError:  # the header line
+            continue
+        profile[fields[2].strip()] = (own, cumulative)
+    return profile
+
+
+class StartupTest(object):
+
+    def test_lazy_modules_not_imported(self):
+        proc = _python('-c', 'import json, sys, birdseye; '
+                             'print(json.dumps(sorted(sys.modules)))')
+        modules = json.loads(proc.stdout.splitlines()[-1])
+        for lazy in LAZY_MODULES:
+            nt.assert_not_in(lazy, modules)
+
+    def test_import_time_budget(self):
+        if sys.version_info < (3, 7):
+            raise SkipTest('-X importtime needs python 3.7')
+        profile = import_profile()
+        cumulative_ms = profile['birdseye'][1] / 1000.0
+        slowest = sorted(
+            profile.items(), key=lambda item: item[1][0], reverse=True)[:10]
+        nt.assert_less(
+            cumulative_ms, STARTUP_BUDGET_MS,
+            'import birdseye took {:.0f}ms, slowest modules (self ms): '
+            '{}'.format(cumulative_ms, ', '.join(
+                '{} {:.1f}'.format(name, own / 1000.0)
+                for name, (own, _) in slowest)))
@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+'''
+Stand-ins for the external services (Google Cloud Vision, PubNub), used for
+load testing and local development. Enable them with:
+
+.. code:: bash
+
+    export BIRDSEYE_VISION=stub BIRDSEYE_PUBSUB=stub
+    export BIRDSEYE_VISION_LATENCY=0.5  # seconds per label detection
+    export BIRDSEYE_VISION_QUOTA_ERRORS=0.1  # fraction of 429 errors
+
+'''
+import logging
+import random
+import time
+
+from birdseye.default_settings import (
+    STUB_VISION_LATENCY, STUB_VISION_QUOTA_ERRORS)
+from birdseye.pubsub import Singleton
+
+
+log = logging.getLogger('stubs')
+
+LABELS = [(0.97, 'bird'), (0.91, 'wildlife'), (0.88, 'beak'),
+          (0.81, 'feather'), (0.74, 'fauna'), (0.52, 'sky')]
+
+
+class TooManyRequests(Exception):
+    '''The error of the Vision client over quota (HTTP 429, as
+    google.cloud.exceptions.TooManyRequests).'''
+
+    code = 429
+
+
+def detect_labels(filename_or_url, latency=None, quota_errors=None):
+    '''The labels of the Vision client, after a delay that simulates its
+    round-trip. Fails with TooManyRequests for a quota_errors fraction of
+    the calls (1: all of them).'''
+    time.sleep(STUB_VISION_LATENCY if latency is None else latency)
+    if quota_errors is None:
+        quota_errors = STUB_VISION_QUOTA_ERRORS
+    if random.random() < quota_errors:
+        raise TooManyRequests('Quota exceeded (stub).')
+    return list(LABELS)
+
+
+class StubPubSub(object, metaclass=Singleton):
+    '''Drop-in for birdseye.pubsub.PubSub that only counts messages, one
+    per process like PubSub.'''
+
+    def __init__(self, conffile=None):
+        self.published = 0
+
+    def publish(self, data, meta=None, channels=None):
+        self.published += 1
+        log.debug('stub publish #%d', self.published)
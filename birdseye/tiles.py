@@ -0,0 +1,225 @@
+# -*- coding: utf-8 -*-
+'''
+Mapbox Vector Tiles of observations
+-----------------------------------
+
+Tiles are rendered by PostGIS (``ST_AsMVT``) in the web mercator XYZ scheme
+and kept in a per worker LRU cache. Every cached tile remembers the
+generation it was rendered at, storing an observation bumps the generations
+of the tiles that contain it, at every zoom level, so that all workers
+re-render exactly those tiles. Bulk updates and deletes (e.g. the delete
+job's batches) do not load the rows: they bump the generation of all the
+tiles.
+
+'''
+import math
+import re
+
+import sqlalchemy
+from sqlalchemy import text
+from sqlalchemy.inspection import inspect
+from sqlalchemy.orm import object_session
+
+from birdseye import app, db, rq
+from birdseye.cache import LRUCache, Generations
+import birdseye.models as bm
+
+
+MAX_ZOOM = 22
+# web mercator stops short of the poles
+MAX_LATITUDE = 85.0511287798066
+# degrees, orders of magnitude below the size of a zoom 22 tile
+EPSILON = 1e-7
+
+TILE_SQL = text('''
+WITH bounds AS (
+    SELECT ST_TileEnvelope(:z, :x, :y) AS mercator,
+           ST_SetSRID(ST_Transform(ST_TileEnvelope(:z, :x, :y), 4326), 0)
+               AS lonlat
+), features AS (
+    SELECT ST_AsMVTGeom(
+               ST_Transform(ST_SetSRID(o.location, 4326), 3857),
+               bounds.mercator, :extent, :buffer) AS geom,
+           o.observation_id AS id,
+           o.species_id AS species_id,
+           s.names->>'common' AS species,
+           o.properties->'vision_labels'->0->>1 AS label
+    FROM observations o
+    JOIN bounds ON o.location && bounds.lonlat AND o.deleted IS NULL
+    LEFT JOIN species s ON s.species_id = o.species_id
+)
+SELECT ST_AsMVT(features.*, 'observations', :extent, 'geom') FROM features
+''')
+
+_NUMBER = re.compile(r'-?\d+(?:\.\d+)?(?:[eE][-+]?\d+)?')
+
+
+def tile_xy(lon, lat, z):
+    '''The (x, y) of the zoom ``z`` tile containing lon, lat.'''
+    lat = max(-MAX_LATITUDE, min(MAX_LATITUDE, lat))
+    n = 2 ** z
+    x = int((lon + 180.0) / 360.0 * n)
+    lat_rad = math.radians(lat)
+    y = int((1.0 - math.asinh(math.tan(lat_rad)) / math.pi) / 2.0 * n)
+    return min(max(x, 0), n - 1), min(max(y, 0), n - 1)
+
+
+def tiles_for_bbox(min_lon, min_lat, max_lon, max_lat, max_zoom=MAX_ZOOM):
+    '''All the (z, x, y) tiles, up to max_zoom, intersecting the bbox.'''
+    for z in range(max_zoom + 1):
+        x0, y0 = tile_xy(min_lon, max_lat, z)
+        x1, y1 = tile_xy(max_lon, min_lat, z)
+        for x in range(x0, x1 + 1):
+            for y in range(y0, y1 + 1):
+                yield z, x, y
+
+
+def wkt_centroid(wkt):
+    '''(lon, lat) centroid of the outer ring of a WKT/EWKT point or polygon,
+    the same point ST_Centroid computes for these.'''
+    if wkt.upper().startswith('SRID='):
+        wkt = wkt.split(';', 1)[1]
+    ring = wkt.split(')')[0]
+    numbers = [float(n) for n in _NUMBER.findall(ring)]
+    xs, ys = numbers[0::2], numbers[1::2]
+    if not xs or len(xs) != len(ys):
+        return None
+    area = cx = cy = 0.0
+    for i in range(len(xs) - 1):
+        cross = xs[i] * ys[i + 1] - xs[i + 1] * ys[i]
+        area += cross
+        cx += (xs[i] + xs[i + 1]) * cross
+        cy += (ys[i] + ys[i + 1]) * cross
+    if abs(area) < 1e-18:
+        return sum(xs) / len(xs), sum(ys) / len(ys)
+    return cx / (3.0 * area), cy / (3.0 * area)
+
+
+def center_location(center):
+    '''(lon, lat) of a geometry_center GeoJSON point, else None.'''
+    if isinstance(center, dict) and center.get('type') == 'Point':
+        return tuple(center['coordinates'])
+    return None
+
+
+def observation_location(obs):
+    '''(lon, lat) of the point rendered in the tiles for obs.'''
+    location = center_location(obs.geometry_center)
+    if location is not None:
+        return location
+    if isinstance(obs.geometry, str):
+        return wkt_centroid(obs.geometry)
+    return None
+
+
+def location_tiles(lon, lat, max_zoom=MAX_ZOOM):
+    '''The tiles containing lon, lat. A point within rounding distance of
+    a tile border invalidates the neighbour tiles too.'''
+    return tiles_for_bbox(lon - EPSILON, lat - EPSILON,
+                          lon + EPSILON, lat + EPSILON, max_zoom)
+
+
+def valid_tile(z, x, y):
+    return 0 <= z <= MAX_ZOOM and 0 <= x < 2 ** z and 0 <= y < 2 ** z
+
+
+def _tile_name(z, x, y):
+    return '{}/{}/{}'.format(z, x, y)
+
+
+# the generation of every tile
+ALL = 'all'
+
+
+class TileCache(object):
+
+    def __init__(self, maxsize, generations, render):
+        self.lru = LRUCache(maxsize)
+        self.generations = generations
+        self.render = render
+
+    def get(self, z, x, y):
+        generation = tuple(self.generations.get(ALL, _tile_name(z, x, y)))
+        cached = self.lru.get((z, x, y))
+        if cached is not None and cached[0] == generation:
+            return cached[1]
+        tile = self.render(z, x, y)
+        self.lru.set((z, x, y), (generation, tile))
+        return tile
+
+    def invalidate(self, tiles):
+        tiles = list(tiles)
+        for tile in tiles:
+            self.lru.pop(tile)
+        self.generations.bump(*[_tile_name(*t) for t in tiles])
+
+    def invalidate_location(self, lon, lat):
+        self.invalidate(location_tiles(lon, lat))
+
+    def invalidate_all(self):
+        self.lru.clear()
+        self.generations.bump(ALL)
+
+
+def render_tile(z, x, y):
+    data = db.session.execute(TILE_SQL, {
+        'z': z, 'x': x, 'y': y,
+        'extent': app.config['TILE_EXTENT'],
+        'buffer': app.config['TILE_BUFFER'],
+    }).scalar()
+    return bytes(data or b'')
+
+
+cache = TileCache(
+    app.config['TILE_CACHE_SIZE'],
+    Generations('tiles', lambda: rq.connection),
+    render_tile)
+
+
+_PENDING = 'birdseye.tiles.pending'
+_ALL = 'birdseye.tiles.all'
+
+
+@sqlalchemy.event.listens_for(bm.Observation, 'after_insert')
+@sqlalchemy.event.listens_for(bm.Observation, 'after_update')
+def _observation_stored(mapper, connection, target):
+    location = observation_location(target)
+    session = object_session(target)
+    if location is not None and session is not None:
+        session.info.setdefault(_PENDING, []).append(location)
+
+
+@sqlalchemy.event.listens_for(bm.Observation, 'before_update')
+def _observation_moving(mapper, connection, target):
+    # the tiles of the location it leaves no longer show it
+    session = object_session(target)
+    if session is None:
+        return
+    for center in inspect(target).attrs.geometry_center.history.deleted:
+        location = center_location(center)
+        if location is not None:
+            session.info.setdefault(_PENDING, []).append(location)
+
+
+@sqlalchemy.event.listens_for(sqlalchemy.orm.Session, 'after_bulk_delete')
+@sqlalchemy.event.listens_for(sqlalchemy.orm.Session, 'after_bulk_update')
+def _observations_bulk_written(context):
+    # the species names are rendered too
+    if context.mapper.class_ in (bm.Observation, bm.Species):
+        context.session.info[_ALL] = True
+
+
+@sqlalchemy.event.listens_for(sqlalchemy.orm.Session, 'after_commit')
+def _invalidate_committed(session):
+    locations = session.info.pop(_PENDING, ())
+    if session.info.pop(_ALL, False):
+        cache.invalidate_all()
+        return
+    for lon, lat in locations:
+        cache.invalidate_location(lon, lat)
+
+
+@sqlalchemy.event.listens_for(sqlalchemy.orm.Session, 'after_rollback')
+def _forget_rolled_back(session):
+    session.info.pop(_PENDING, None)
+    session.info.pop(_ALL, None)
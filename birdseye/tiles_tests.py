@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+from datetime import datetime
+
+import nose.tools as nt
+from sqlalchemy.orm import Session, make_transient_to_detached
+
+import birdseye.models as bm
+import birdseye.tiles as tiles
+
+
+class FakeGenerations(object):
+
+    def __init__(self):
+        self.counters = {}
+
+    def get(self, *names):
+        return [self.counters.get(n, 0) for n in names]
+
+    def bump(self, *names):
+        for n in names:
+            self.counters[n] = self.counters.get(n, 0) + 1
+
+
+class TileMathTest(object):
+
+    def test_tile_xy(self):
+        nt.assert_equal(tiles.tile_xy(0.0, 0.0, 0), (0, 0))
+        nt.assert_equal(tiles.tile_xy(-0.1, 0.1, 1), (0, 0))
+        nt.assert_equal(tiles.tile_xy(0.1, -0.1, 1), (1, 1))
+        # Bucharest at zoom 10
+        nt.assert_equal(tiles.tile_xy(26.1025, 44.4268, 10), (586, 370))
+        # clamped at the antimeridian and the poles
+        nt.assert_equal(tiles.tile_xy(180.0, 90.0, 2), (3, 0))
+
+    def test_location_tiles(self):
+        found = list(tiles.location_tiles(26.1025, 44.4268, max_zoom=3))
+        nt.assert_equal(found, [(0, 0, 0), (1, 1, 0), (2, 2, 1), (3, 4, 2)])
+
+    def test_wkt_centroid(self):
+        diamond = 'POLYGON((9 0, 10 1, 11 0, 10 -1, 9 0))'
+        nt.assert_equal(tiles.wkt_centroid(diamond), (10.0, 0.0))
+        nt.assert_equal(tiles.wkt_centroid('SRID=4326;POINT(1.5 2)'),
+                        (1.5, 2.0))
+        cx, cy = tiles.wkt_centroid(
+            'POLYGON((-81.3 37.2, -80.63 38.04, -80.02 37.49, -81.3 37.2))')
+        nt.assert_almost_equal(cx, -80.65, places=2)
+        nt.assert_almost_equal(cy, 37.58, places=2)
+
+    def test_valid_tile(self):
+        nt.assert_true(tiles.valid_tile(0, 0, 0))
+        nt.assert_false(tiles.valid_tile(1, 2, 0))
+        nt.assert_false(tiles.valid_tile(23, 0, 0))
+
+
+class TileCacheTest(object):
+
+    def setup(self):
+        self.rendered = []
+
+        def render(z, x, y):
+            self.rendered.append((z, x, y))
+            return b'tile'
+
+        self.cache = tiles.TileCache(4, FakeGenerations(), render)
+
+    @nt.with_setup(setup)
+    def test_cached_until_invalidated(self):
+        nt.assert_equal(self.cache.get(1, 0, 0), b'tile')
+        self.cache.get(1, 0, 0)
+        nt.assert_equal(self.rendered, [(1, 0, 0)])
+
+        self.cache.invalidate_location(-0.1, 0.1)
+        self.cache.get(1, 0, 0)
+        nt.assert_equal(self.rendered, [(1, 0, 0), (1, 0, 0)])
+
+    @nt.with_setup(setup)
+    def test_other_worker_invalidation(self):
+        self.cache.get(1, 0, 0)
+        # another worker bumped the generation, the local copy is stale
+        self.cache.generations.bump('1/0/0')
+        self.cache.get(1, 0, 0)
+        nt.assert_equal(len(self.rendered), 2)
+
+    @nt.with_setup(setup)
+    def test_invalidate_all(self):
+        self.cache.get(1, 0, 0)
+        self.cache.get(2, 1, 1)
+        # e.g. a bulk delete in another worker
+        self.cache.generations.bump(tiles.ALL)
+        self.cache.get(1, 0, 0)
+        self.cache.invalidate_all()
+        self.cache.get(2, 1, 1)
+        nt.assert_equal(self.rendered,
+                        [(1, 0, 0), (2, 1, 1), (1, 0, 0), (2, 1, 1)])
+
+
+def test_moved_observation_invalidates_old_location():
+    obs = bm.Observation(None, 'POLYGON((1 2, 1 2.1, 1.1 2, 1 2))', {},
+                         location=(1, 2))
+    obs.observation_id = bm.new_uuid()
+    obs.created = datetime(2017, 4, 1)
+    make_transient_to_detached(obs)  # as if loaded
+    session = Session()
+    session.add(obs)
+    obs.geometry = 'POLYGON((5 6, 5 6.3, 5.3 6, 5 6))'
+    # the before_update listeners, in their order
+    bm._locate_observation(None, None, obs)
+    tiles._observation_moving(None, None, obs)
+    tiles._observation_stored(None, None, obs)
+    old, new = session.info[tiles._PENDING]
+    nt.assert_equal(old, (1, 2))
+    nt.assert_almost_equal(new[0], 5.1)
+    nt.assert_almost_equal(new[1], 6.1)
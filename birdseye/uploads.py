@@ -0,0 +1,234 @@
+# -*- coding: utf-8 -*-
+'''
+Media uploads
+-------------
+
+Request bodies are streamed to disk in UPLOAD_CHUNK_SIZE chunks, never held
+in memory. The declared type and size are checked before reading the body,
+the first bytes are checked against the type as soon as they are read (a
+file shorter than its magic bytes is rejected once complete), and the size
+limit is enforced while streaming (for bodies without Content-Length).
+
+Resumable uploads keep a partial file and its metadata in UPLOAD_ROOT: the
+size of the partial file is the offset a client resumes from. One request
+at a time may append to an upload (an exclusive lock on the partial file).
+
+Finished files are written to MEDIA_ROOT with MEDIA_FILE_MODE permissions,
+readable by the web server without the chmod job nginx uploads need.
+'''
+import errno
+import fcntl
+import json
+import os
+import shutil
+import time
+import uuid
+
+from birdseye.default_settings import (
+    MEDIA_ROOT, MEDIA_FILE_MODE, UPLOAD_ROOT, UPLOAD_MAX_BYTES,
+    UPLOAD_CHUNK_SIZE, UPLOAD_TYPES)
+
+
+# leading bytes of the accepted media types
+MAGIC = {
+    'image/jpeg': (b'\xff\xd8\xff',),
+}
+HEAD_BYTES = max(len(magic) for magics in MAGIC.values() for magic in magics)
+
+
+class UploadError(ValueError):
+
+    def __init__(self, message, status_code):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+def _content_type(content_type):
+    return (content_type or '').split(';')[0].strip().lower()
+
+
+def check_declared(content_type, length):
+    '''The file extension for an upload of content_type and length (None
+    when not declared). Raises UploadError (415, 413) for what is not
+    accepted, before any of the body is read.'''
+    ext = UPLOAD_TYPES.get(_content_type(content_type))
+    if ext is None:
+        raise UploadError('Unsupported media type.', 415)
+    if length is not None and length <= 0:
+        raise UploadError('Empty upload.', 400)
+    if length is not None and length > UPLOAD_MAX_BYTES:
+        raise UploadError('Upload too large.', 413)
+    return ext
+
+
+def check_head(content_type, head):
+    if not any(head.startswith(magic)
+               for magic in MAGIC.get(_content_type(content_type), ())):
+        raise UploadError('Content does not match its type.', 415)
+
+
+def check_file(path, content_type):
+    '''check_head on the first bytes of the file at path.'''
+    with open(path, 'rb') as f:
+        check_head(content_type, f.read(HEAD_BYTES))
+
+
+def copy_stream(stream, fileobj, limit, content_type=None, head=b''):
+    '''Copies stream to fileobj chunk by chunk. Unless content_type is None,
+    the first HEAD_BYTES (following head, the bytes of the file already
+    written) are checked against it once read, whatever the chunks; a
+    stream ending before is left to check_file. Raises UploadError past
+    limit bytes. Returns the number of bytes copied.'''
+    copied = 0
+    while True:
+        chunk = stream.read(UPLOAD_CHUNK_SIZE)
+        if not chunk:
+            return copied
+        if content_type is not None and len(head) < HEAD_BYTES:
+            head += chunk[:HEAD_BYTES - len(head)]
+            if len(head) == HEAD_BYTES:
+                check_head(content_type, head)
+        copied += len(chunk)
+        if copied > limit:
+            raise UploadError('Upload too large.', 413)
+        fileobj.write(chunk)
+
+
+def _open_new(path, mode=0o600):
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, mode)
+    os.fchmod(fd, mode)  # regardless of the umask
+    return os.fdopen(fd, 'wb')
+
+
+def _move_to_media(path, ext):
+    '''Moves path into MEDIA_ROOT under a new name, returns the name.'''
+    basename = '{}.{}'.format(uuid.uuid4(), ext)
+    new_path = os.path.join(MEDIA_ROOT, basename)
+    os.chmod(path, MEDIA_FILE_MODE)
+    try:
+        os.rename(path, new_path)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        shutil.move(path, new_path)
+    return basename
+
+
+def store_stream(stream, content_type, length):
+    '''Stores a whole upload body, returns its basename in MEDIA_ROOT.'''
+    ext = check_declared(content_type, length)
+    os.makedirs(UPLOAD_ROOT, exist_ok=True)
+    path = os.path.join(UPLOAD_ROOT, '{}.part'.format(uuid.uuid4()))
+    try:
+        with _open_new(path) as f:
+            copy_stream(stream, f, UPLOAD_MAX_BYTES, content_type)
+        check_file(path, content_type)  # e.g. an empty body
+        return _move_to_media(path, ext)
+    finally:
+        if os.path.exists(path):
+            os.remove(path)
+
+
+class Upload(object):
+    '''A resumable upload of a known length.'''
+
+    def __init__(self, upload_id, content_type, length):
+        self.upload_id = str(upload_id)
+        self.content_type = content_type
+        self.length = length
+
+    @property
+    def path(self):
+        return os.path.join(UPLOAD_ROOT, '{}.part'.format(self.upload_id))
+
+    @property
+    def meta_path(self):
+        return os.path.join(UPLOAD_ROOT, '{}.json'.format(self.upload_id))
+
+    @property
+    def offset(self):
+        return os.path.getsize(self.path)
+
+    @classmethod
+    def create(cls, content_type, length):
+        if length is None:
+            raise UploadError('Upload-Length is required.', 400)
+        check_declared(content_type, length)
+        upload = cls(uuid.uuid4(), _content_type(content_type), length)
+        os.makedirs(UPLOAD_ROOT, exist_ok=True)
+        with open(upload.meta_path, 'w') as f:
+            json.dump({'content_type': upload.content_type,
+                       'length': length}, f)
+        _open_new(upload.path).close()
+        return upload
+
+    @classmethod
+    def load(cls, upload_id):
+        '''The upload with upload_id, None when unknown or expired.'''
+        upload = cls(upload_id, None, None)
+        try:
+            with open(upload.meta_path) as f:
+                meta = json.load(f)
+        except (IOError, ValueError):
+            return None
+        upload.content_type = meta['content_type']
+        upload.length = meta['length']
+        return upload
+
+    def append(self, stream, offset):
+        '''Appends stream at offset, which must be the current offset.
+        Returns the new offset. A failed or interrupted request keeps what
+        was written so far.'''
+        with open(self.path, 'a+b') as f:  # writes go to the end
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                raise UploadError('Upload in progress.', 409)
+            current = f.seek(0, os.SEEK_END)
+            if offset != current:
+                raise UploadError('Upload-Offset is {}.'.format(current), 409)
+            content_type, head = None, b''
+            if current < HEAD_BYTES:  # the head may span several requests
+                content_type = self.content_type
+                f.seek(0)
+                head = f.read(current)
+            try:
+                copy_stream(stream, f, self.length - current, content_type,
+                            head)
+            finally:
+                f.flush()
+            return f.tell()
+
+    def finish(self):
+        '''Moves the complete upload to MEDIA_ROOT, returns its basename.
+        Raises UploadError when it does not match its type.'''
+        check_file(self.path, self.content_type)
+        basename = _move_to_media(self.path, UPLOAD_TYPES[self.content_type])
+        os.remove(self.meta_path)
+        return basename
+
+    def cancel(self):
+        for path in (self.path, self.meta_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+
+def remove_expired(max_age):
+    '''Removes the uploads not appended to for max_age seconds.'''
+    if not os.path.isdir(UPLOAD_ROOT):
+        return 0
+    removed = 0
+    oldest = time.time() - max_age
+    for name in os.listdir(UPLOAD_ROOT):
+        if not name.endswith('.part'):
+            continue
+        path = os.path.join(UPLOAD_ROOT, name)
+        try:
+            if os.path.getmtime(path) >= oldest:
+                continue
+            os.remove(path)
+            os.remove(path[:-len('.part')] + '.json')
+        except OSError:
+            pass
+        removed += 1
+    return removed
@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+import io
+import os
+import shutil
+import stat
+import tempfile
+from unittest.mock import patch
+
+import nose.tools as nt
+
+import birdseye.uploads as uploads
+
+
+JPEG = b'\xff\xd8\xff\xe0' + os.urandom(200 * 1024)
+
+
+class UploadsTest(object):
+
+    def setup(self):
+        self.root = tempfile.mkdtemp()
+        self.media_root = os.path.join(self.root, 'media')
+        os.mkdir(self.media_root)
+        self.patches = [
+            patch('birdseye.uploads.MEDIA_ROOT', self.media_root),
+            patch('birdseye.uploads.UPLOAD_ROOT',
+                  os.path.join(self.root, 'partial')),
+            patch('birdseye.uploads.UPLOAD_MAX_BYTES', 256 * 1024),
+        ]
+        for p in self.patches:
+            p.start()
+
+    def teardown(self):
+        for p in self.patches:
+            p.stop()
+        shutil.rmtree(self.root)
+
+    def media(self, basename):
+        path = os.path.join(self.media_root, basename)
+        with open(path, 'rb') as f:
+            return f.read(), stat.S_IMODE(os.stat(path).st_mode)
+
+    @nt.with_setup(setup, teardown)
+    def test_store_stream(self):
+        basename = uploads.store_stream(
+            io.BytesIO(JPEG), 'image/jpeg', len(JPEG))
+        nt.assert_true(basename.endswith('.jpeg'))
+        nt.assert_equal(self.media(basename), (JPEG, 0o644))
+
+    @nt.with_setup(setup, teardown)
+    def test_store_stream_rejects(self):
+        def status(body, content_type='image/jpeg', length=None):
+            with nt.assert_raises(uploads.UploadError) as cm:
+                uploads.store_stream(io.BytesIO(body), content_type, length)
+            return cm.exception.status_code
+
+        nt.assert_equal(status(JPEG, 'image/gif'), 415)
+        nt.assert_equal(status(b'GIF89a' + JPEG[6:]), 415)
+        nt.assert_equal(status(JPEG, length=1024 * 1024), 413)
+        # no Content-Length, the limit is enforced while streaming
+        nt.assert_equal(status(JPEG + JPEG), 413)
+        nt.assert_equal(status(b'', length=0), 400)
+        # empty or shorter than the magic bytes, without Content-Length
+        nt.assert_equal(status(b''), 415)
+        nt.assert_equal(status(JPEG[:2]), 415)
+        nt.assert_equal(os.listdir(self.media_root), [])
+
+    @nt.with_setup(setup, teardown)
+    def test_resumable(self):
+        upload = uploads.Upload.create('image/jpeg', len(JPEG))
+        nt.assert_equal(upload.offset, 0)
+        half = len(JPEG) // 2
+        nt.assert_equal(upload.append(io.BytesIO(JPEG[:half]), 0), half)
+        # a resumed client asks where to continue from
+        upload = uploads.Upload.load(upload.upload_id)
+        nt.assert_equal(upload.offset, half)
+        with nt.assert_raises(uploads.UploadError) as cm:
+            upload.append(io.BytesIO(JPEG[half:]), 0)
+        nt.assert_equal(cm.exception.status_code, 409)
+        nt.assert_equal(
+            upload.append(io.BytesIO(JPEG[half:]), half), len(JPEG))
+        nt.assert_equal(self.media(upload.finish()), (JPEG, 0o644))
+        nt.assert_is_none(uploads.Upload.load(upload.upload_id))
+
+    @nt.with_setup(setup, teardown)
+    def test_resumable_head_across_requests(self):
+        upload = uploads.Upload.create('image/jpeg', len(JPEG))
+        nt.assert_equal(upload.append(io.BytesIO(JPEG[:1]), 0), 1)
+        nt.assert_equal(upload.append(io.BytesIO(JPEG[1:]), 1), len(JPEG))
+        nt.assert_equal(self.media(upload.finish()), (JPEG, 0o644))
+
+        upload = uploads.Upload.create('image/jpeg', 100)
+        upload.append(io.BytesIO(b'\xff'), 0)
+        with nt.assert_raises(uploads.UploadError) as cm:
+            upload.append(io.BytesIO(b'GIF89a'), 1)
+        nt.assert_equal(cm.exception.status_code, 415)
+
+        upload = uploads.Upload.create('image/jpeg', 2)
+        upload.append(io.BytesIO(JPEG[:2]), 0)
+        with nt.assert_raises(uploads.UploadError):
+            upload.finish()
+        with nt.assert_raises(uploads.UploadError) as cm:
+            uploads.Upload.create('image/jpeg', 0)
+        nt.assert_equal(cm.exception.status_code, 400)
+
+    @nt.with_setup(setup, teardown)
+    def test_remove_expired(self):
+        upload = uploads.Upload.create('image/jpeg', len(JPEG))
+        nt.assert_equal(uploads.remove_expired(3600), 0)
+        os.utime(upload.path, (0, 0))
+        nt.assert_equal(uploads.remove_expired(3600), 1)
+        nt.assert_is_none(uploads.Upload.load(upload.upload_id))
@@ -0,0 +1,311 @@
+# -*- coding: utf-8 -*-
+'''
+Persistent rq workers
+---------------------
+
+rq's default worker forks a work horse per job: each job imports again
+what its worker had not imported, creates its own database engine and
+Vision client and reads the PubNub configuration, all dropped when the
+horse exits. A PersistentWorker runs the jobs in its own process instead,
+after preload() imported the job stack once; the engines and clients the
+jobs cache (birdseye.jobs, birdseye.pubsub) stay warm from job to job.
+
+Leaks are contained by recycling: a worker stops after max_jobs jobs or
+once its resident memory passes max_memory, exiting with RECYCLED.
+run_pool() keeps a number of such workers running, forked from a parent
+that preloaded the job stack, and replaces those that were recycled or
+crashed; a job running in a crashed process is left to rq's abandoned job
+handling (it ends in the failed job registry). Without a pool, the
+process supervisor restarts the worker.
+
+The jobs of a GeventWorker run concurrently in greenlets, for the jobs that
+mostly wait on the network: a process keeps up to its concurrency of them
+in flight instead of one. Its database and Vision API (grpc) clients are
+made cooperative first, see birdseye.green.
+'''
+import importlib
+import logging
+import os
+import resource
+import signal
+import sys
+import time
+
+import gevent
+import gevent.pool
+from gevent.monkey import get_original
+from rq.timeouts import BaseDeathPenalty
+from rq.worker import SimpleWorker, WorkerStatus
+
+from birdseye.default_settings import (
+    VISION_BACKEND, PUBSUB_BACKEND, RQ_WORKER_MAX_JOBS, RQ_WORKER_MAX_MEMORY,
+    RQ_WORKER_CONCURRENCY, SQLALCHEMY_COOPERATIVE)
+
+
+log = logging.getLogger('workers')
+
+# exit status of a recycled worker (EX_TEMPFAIL): start a new one
+RECYCLED = 75
+# seconds between the heartbeats of a gevent worker running all it can
+HEARTBEAT_INTERVAL = 60
+
+# run_pool waits for its children itself, the child watchers of gevent's
+# fork would reap them from its loop
+_fork, _waitpid = get_original('os', ['fork', 'waitpid'])
+_sleep = get_original('time', 'sleep')
+
+
+def preload():
+    '''Imports the jobs and the modules they import when they first run.'''
+    import birdseye.jobs  # noqa: F401
+    modules = ['piexif', 'birdseye.pubsub', 'birdseye.search']
+    modules.append('birdseye.stubs' if VISION_BACKEND == 'stub'
+                   else 'google.cloud.vision')
+    for name in modules:
+        try:
+            importlib.import_module(name)
+        except ImportError as e:
+            log.warning('Not preloading %s: %s', name, e)
+
+
+def warm():
+    '''Creates the clients the jobs use, once per process.'''
+    import birdseye.jobs as jobs
+    import birdseye.pubsub as ps
+    try:
+        jobs.db_session().close()
+        if VISION_BACKEND != 'stub':
+            with jobs.vision_client():
+                pass
+        if PUBSUB_BACKEND != 'stub':
+            ps.get_pubsub()
+    except Exception as e:  # the first job will fail with it
+        log.warning('Could not warm up the job clients: %s', e)
+
+
+def resident_memory():
+    '''Bytes of resident memory of this process, the peak where /proc is
+    not available.'''
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except (IOError, OSError, ValueError, IndexError):
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # bytes on macOS, kilobytes elsewhere
+        return peak if sys.platform == 'darwin' else peak * 1024
+
+
+class PersistentWorker(SimpleWorker):
+    '''An rq worker running the jobs in its own process, recycled after
+    max_jobs jobs or past max_memory bytes resident (0: no limit).'''
+
+    def __init__(self, *args, max_jobs=None, max_memory=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.max_jobs = RQ_WORKER_MAX_JOBS if max_jobs is None else max_jobs
+        self.max_memory = (RQ_WORKER_MAX_MEMORY * 1024 * 1024
+                           if max_memory is None else max_memory)
+        self.jobs_done = 0
+        self.job_time = 0.0
+        self.recycled = False
+
+    def execute_job(self, *args, **kwargs):
+        self.run_job(super().execute_job, *args, **kwargs)
+
+    def run_job(self, execute, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            execute(*args, **kwargs)
+        finally:
+            self.jobs_done += 1
+            self.job_time += time.perf_counter() - started
+        reason = self.recycle_reason()
+        if reason:
+            log.info('Recycling worker %s after %d jobs: %s', self.name,
+                     self.jobs_done, reason)
+            self.recycled = True
+            self._stop_requested = True
+
+    def recycle_reason(self):
+        if self.max_jobs and self.jobs_done >= self.max_jobs:
+            return 'max jobs'
+        if self.max_memory:
+            memory = resident_memory()
+            if memory > self.max_memory:
+                return '{} MB resident'.format(memory // (1024 * 1024))
+        return None
+
+
+class GreenletDeathPenalty(BaseDeathPenalty):
+    '''Job timeouts raised in the greenlet of the job, at its next switch
+    (SIGALRM can only time one job per process).'''
+
+    def setup_death_penalty(self):
+        seconds = self._timeout if self._timeout > 0 else None
+        self._gevent_timeout = gevent.Timeout(seconds, self._exception(
+            'Task exceeded maximum timeout value ({} seconds)'.format(
+                self._timeout)))
+        self._gevent_timeout.start()
+
+    def cancel_death_penalty(self):
+        self._gevent_timeout.cancel()
+
+
+class GeventWorker(PersistentWorker):
+    '''A PersistentWorker running up to concurrency jobs at once, each in
+    its own greenlet: jobs waiting on the network (Vision API, PubNub, the
+    database with SQLALCHEMY_COOPERATIVE) overlap. A job over its timeout
+    gets a JobTimeoutException at its next switch, CPU bound code is not
+    interrupted.
+
+    Dequeuing is fair: a job is only taken once a greenlet is free to run
+    it (waiting jobs stay queued for the other workers) and the queues are
+    polled round robin, not in priority order. Jobs share the worker's
+    bookkeeping: rq shows the one started last as its current job.'''
+
+    death_penalty_class = GreenletDeathPenalty
+
+    def __init__(self, *args, concurrency=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.concurrency = concurrency or RQ_WORKER_CONCURRENCY
+        self.pool = gevent.pool.Pool(self.concurrency)
+
+    def dequeue_job_and_maintain_ttl(self, *args, **kwargs):
+        while self.pool.full():
+            self.pool.wait_available(timeout=HEARTBEAT_INTERVAL)
+            self.heartbeat()
+        return super().dequeue_job_and_maintain_ttl(*args, **kwargs)
+
+    def execute_job(self, job, queue):
+        self.rotate_queues(queue)
+        self.set_state(WorkerStatus.BUSY)
+        self.pool.spawn(self.run_job, self._perform, job, queue)
+
+    def _perform(self, job, queue):
+        try:
+            self.perform_job(job, queue)
+        finally:
+            if len(self.pool) <= 1:  # the last running job
+                self.set_state(WorkerStatus.IDLE)
+
+    def rotate_queues(self, queue):
+        '''Polls queue, which a job was just taken from, last.'''
+        queues = ([q for q in self.queues if q.name != queue.name] +
+                  [q for q in self.queues if q.name == queue.name])
+        self.queues = queues
+        if hasattr(self, '_ordered_queues'):  # rq 1.11 and later
+            self._ordered_queues = list(queues)
+
+    def work(self, *args, **kwargs):
+        try:
+            result = super().work(*args, **kwargs)
+        except BaseException:
+            self.pool.kill()  # cold shutdown: the running jobs are lost
+            raise
+        self.pool.join()  # burst or warm shutdown: they finish
+        return result
+
+
+def _exit_status(status):
+    if os.WIFEXITED(status):
+        return os.WEXITSTATUS(status)
+    return -os.WTERMSIG(status)
+
+
+def run_pool(work, processes, restart_delay=1.0):
+    '''Keeps processes children running work() (forked from this process,
+    sharing what it preloaded) until SIGTERM or SIGINT, which are passed on
+    to them. A child exiting with RECYCLED, or crashing, is replaced; one
+    exiting with 0 (a finished burst) is not. Returns once all exited.'''
+    children = set()
+    stopping = []
+
+    def spawn():
+        pid = _fork()
+        if pid == 0:  # the child
+            status = 1
+            try:
+                gevent.reinit()
+                # signals from the terminal go to the parent only
+                os.setpgid(0, 0)
+                signal.signal(signal.SIGINT, signal.SIG_DFL)
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                status = work()
+            except BaseException:
+                log.exception('Worker process %d failed.', os.getpid())
+            finally:
+                os._exit(status or 0)
+        children.add(pid)
+        log.info('Started worker process %d.', pid)
+
+    def stop(signum, frame):
+        stopping.append(signum)
+        for pid in list(children):
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
+
+    handlers = [(signum, signal.signal(signum, stop))
+                for signum in (signal.SIGINT, signal.SIGTERM)]
+    try:
+        for _ in range(processes):
+            spawn()
+        while children:
+            try:
+                pid, status = _waitpid(-1, 0)
+            except ChildProcessError:
+                break
+            if pid not in children:
+                continue
+            children.remove(pid)
+            status = _exit_status(status)
+            if stopping or status == 0:
+                continue
+            if status != RECYCLED:
+                log.warning('Worker process %d exited with %d, restarting '
+                            'it.', pid, status)
+                _sleep(restart_delay)  # not too fast when all jobs crash
+            spawn()
+    finally:
+        for signum, handler in handlers:
+            signal.signal(signum, handler)
+
+
+def run(queues, processes=0, burst=False, max_jobs=None, max_memory=None,
+        concurrency=1):
+    '''Runs a PersistentWorker on queues after preloading the job stack (a
+    GeventWorker when concurrency is over 1): in this process, or in a pool
+    of processes. Returns the exit status.'''
+    from birdseye import rq
+    import birdseye.jobs as jobs
+
+    preload()
+
+    def work():
+        if concurrency > 1:
+            import birdseye.green as green
+            green.patch_grpc()  # before warm() creates the Vision client
+            if SQLALCHEMY_COOPERATIVE:
+                green.patch_psycopg()  # before warm() connects
+        jobs.dispose_engines()  # not shared with the parent
+        warm()
+        kwargs = dict(
+            connection=rq.connection, job_class=rq.job_class,
+            queue_class=rq.queue_class, max_jobs=max_jobs,
+            max_memory=max_memory)
+        if concurrency > 1:
+            worker = GeventWorker(
+                list(queues), concurrency=concurrency, **kwargs)
+        else:
+            worker = PersistentWorker(list(queues), **kwargs)
+        worker.work(burst=burst)
+        if worker.jobs_done:
+            log.info('Worker %s ran %d jobs, %.1fms each.', worker.name,
+                     worker.jobs_done,
+                     worker.job_time / worker.jobs_done * 1000)
+        return RECYCLED if worker.recycled else 0
+
+    if not processes:
+        return work()
+    run_pool(work, processes)
+    return 0
@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+import os
+import signal
+import tempfile
+import time
+from unittest.mock import MagicMock, patch
+
+import gevent
+import nose.tools as nt
+from rq.timeouts import JobTimeoutException
+from rq.worker import SimpleWorker
+
+from birdseye import rq, workers
+
+
+MB = 1024 * 1024
+
+
+def test_resident_memory():
+    memory = workers.resident_memory()
+    nt.assert_greater(memory, MB)
+    nt.assert_less(memory, 64 * 1024 * MB)
+
+
+class PersistentWorkerTest(object):
+
+    def worker(self, **kwargs):
+        return workers.PersistentWorker(
+            ['default'], connection=rq.connection, **kwargs)
+
+    @patch.object(SimpleWorker, 'execute_job', autospec=True)
+    def test_recycled_after_max_jobs(self, execute_job):
+        worker = self.worker(max_jobs=2, max_memory=0)
+        worker.execute_job(None, None)
+        nt.assert_false(worker.recycled)
+        worker.execute_job(None, None)
+        nt.assert_true(worker.recycled)
+        nt.assert_equal(worker.jobs_done, 2)
+        nt.assert_equal(execute_job.call_count, 2)
+
+    @patch('birdseye.workers.resident_memory', return_value=600 * MB)
+    @patch.object(SimpleWorker, 'execute_job', autospec=True)
+    def test_recycled_past_max_memory(self, execute_job, resident_memory):
+        worker = self.worker(max_jobs=0, max_memory=512 * MB)
+        worker.execute_job(None, None)
+        nt.assert_true(worker.recycled)
+        nt.assert_equal(worker.recycle_reason(), '600 MB resident')
+
+    @patch.object(SimpleWorker, 'execute_job', autospec=True,
+                  side_effect=RuntimeError('crashed'))
+    def test_failed_job_counted(self, execute_job):
+        worker = self.worker(max_jobs=1, max_memory=0)
+        with nt.assert_raises(RuntimeError):
+            worker.execute_job(None, None)
+        nt.assert_equal(worker.jobs_done, 1)
+
+
+def test_greenlet_death_penalty():
+    with nt.assert_raises(JobTimeoutException):
+        with workers.GreenletDeathPenalty(0.01, JobTimeoutException):
+            gevent.sleep(1)
+    # only the greenlet over its timeout
+    with workers.GreenletDeathPenalty(1, JobTimeoutException):
+        gevent.sleep(0.01)
+    with workers.GreenletDeathPenalty(-1, JobTimeoutException):
+        gevent.sleep(0.01)
+
+
+class GeventWorkerTest(object):
+
+    def worker(self, queues=('default',), **kwargs):
+        kwargs.setdefault('max_jobs', 0)
+        kwargs.setdefault('max_memory', 0)
+        worker = workers.GeventWorker(
+            list(queues), connection=rq.connection, **kwargs)
+        worker.set_state = MagicMock()
+        return worker
+
+    def test_jobs_run_concurrently(self):
+        worker = self.worker(concurrency=10)
+        worker.perform_job = lambda job, queue: gevent.sleep(0.1)
+        queue = worker.queues[0]
+        started = time.perf_counter()
+        for _ in range(10):
+            worker.execute_job(None, queue)
+        nt.assert_equal(len(worker.pool), 10)
+        worker.pool.join()
+        nt.assert_less(time.perf_counter() - started, 0.5)
+        nt.assert_equal(worker.jobs_done, 10)
+
+    @patch.object(SimpleWorker, 'dequeue_job_and_maintain_ttl',
+                  autospec=True)
+    def test_dequeue_waits_for_a_free_greenlet(self, dequeue):
+        worker = self.worker(concurrency=1)
+        worker.perform_job = lambda job, queue: gevent.sleep(0.05)
+        worker.execute_job(None, worker.queues[0])
+        worker.dequeue_job_and_maintain_ttl(1)
+        # the running job had ended
+        nt.assert_equal(len(worker.pool), 0)
+        nt.assert_equal(dequeue.call_count, 1)
+
+    def test_queues_round_robin(self):
+        worker = self.worker(queues=['local', 'default', 'vision'])
+        worker.perform_job = lambda job, queue: None
+        local, default, vision = worker.queues
+        worker.execute_job(None, local)
+        nt.assert_equal([q.name for q in worker.queues],
+                        ['default', 'vision', 'local'])
+        worker.execute_job(None, vision)
+        nt.assert_equal([q.name for q in worker.queues],
+                        ['default', 'local', 'vision'])
+        worker.pool.join()
+
+
+def _pool_log(statuses):
+    '''A work() for run_pool: appends its pid to a file and exits with the
+    next of statuses.'''
+    fd, path = tempfile.mkstemp()
+    os.close(fd)
+
+    def work():
+        with open(path, 'a') as f:
+            f.write('{}\n'.format(os.getpid()))
+        with open(path) as f:
+            runs = len(f.read().split())
+        status = statuses[min(runs, len(statuses)) - 1]
+        if status == 'crash':
+            os.kill(os.getpid(), signal.SIGKILL)
+        return status
+
+    return work, path
+
+
+def test_run_pool_replaces_recycled_and_crashed():
+    work, path = _pool_log([workers.RECYCLED, 'crash', 0])
+    try:
+        workers.run_pool(work, 1, restart_delay=0)
+        with open(path) as f:
+            pids = f.read().split()
+    finally:
+        os.remove(path)
+    nt.assert_equal(len(pids), 3)
+    nt.assert_equal(len(set(pids)), 3)
+    nt.assert_not_in(str(os.getpid()), pids)
+
+
+def test_run_pool_finished_not_replaced():
+    work, path = _pool_log([0])
+    try:
+        workers.run_pool(work, 2)
+        with open(path) as f:
+            nt.assert_equal(len(f.read().split()), 2)
+    finally:
+        os.remove(path)
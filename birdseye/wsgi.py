@@ -0,0 +1,13 @@
+# -*- coding: utf-8 -*-
+'''
+The application served by the gunicorn gevent workers (see
+birdseye.production), with cooperative database I/O (see birdseye.green)
+unless SQLALCHEMY_COOPERATIVE=0.
+'''
+from birdseye import app  # noqa: F401
+from birdseye.default_settings import SQLALCHEMY_COOPERATIVE
+import birdseye.green as green
+
+
+if SQLALCHEMY_COOPERATIVE:
+    green.patch_psycopg()
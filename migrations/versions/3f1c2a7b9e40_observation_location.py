@@ -0,0 +1,40 @@
+"""stored location, accuracy and GeoJSON center for observations
+
+Revision ID: 3f1c2a7b9e40
+Revises: d99956102317
+Create Date: 2026-10-19 09:12:05.118263
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+import geoalchemy2
+
+
+# revision identifiers, used by Alembic.
+revision = '3f1c2a7b9e40'
+down_revision = 'd99956102317'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('observations', sa.Column(
+        'location', geoalchemy2.Geometry('POINT'), nullable=True))
+    op.add_column('observations', sa.Column(
+        'accuracy', sa.Float(), nullable=True))
+    op.add_column('observations', sa.Column(
+        'geometry_center', postgresql.JSONB(), nullable=True))
+    op.execute('''
+        UPDATE observations SET
+            location = ST_Centroid(geometry),
+            accuracy = ST_MaxDistance(ST_Centroid(geometry), geometry),
+            geometry_center = ST_AsGeoJSON(ST_Centroid(geometry))::jsonb
+        WHERE location IS NULL
+    ''')
+
+
+def downgrade():
+    op.drop_column('observations', 'geometry_center')
+    op.drop_column('observations', 'accuracy')
+    op.drop_column('observations', 'location')
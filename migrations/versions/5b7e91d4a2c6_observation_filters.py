@@ -0,0 +1,43 @@
+"""observation labels array and filtering indexes
+
+Revision ID: 5b7e91d4a2c6
+Revises: 8a4d6e0c2f13
+Create Date: 2026-10-19 11:20:17.930411
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = '5b7e91d4a2c6'
+down_revision = '8a4d6e0c2f13'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('observations', sa.Column(
+        'labels', postgresql.ARRAY(sa.Text()), nullable=False,
+        server_default='{}'))
+    op.execute('''
+        UPDATE observations SET labels = ARRAY(
+            SELECT lower(label->>1)
+            FROM jsonb_array_elements(properties->'vision_labels') label)
+        WHERE jsonb_typeof(properties->'vision_labels') = 'array'
+    ''')
+    op.create_index('ix_observations_labels', 'observations', ['labels'],
+                    postgresql_using='gin')
+    op.create_index('ix_observations_user_id', 'observations', ['user_id'])
+    op.create_index(
+        'ix_observations_species_id', 'observations', ['species_id'])
+    op.create_index('ix_observations_created', 'observations', ['created'])
+
+
+def downgrade():
+    op.drop_index('ix_observations_created', 'observations')
+    op.drop_index('ix_observations_species_id', 'observations')
+    op.drop_index('ix_observations_user_id', 'observations')
+    op.drop_index('ix_observations_labels', 'observations')
+    op.drop_column('observations', 'labels')
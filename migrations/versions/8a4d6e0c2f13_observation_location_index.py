@@ -0,0 +1,25 @@
+"""spatial index on observations.location for vector tiles
+
+Revision ID: 8a4d6e0c2f13
+Revises: 3f1c2a7b9e40
+Create Date: 2026-10-19 10:03:41.502771
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8a4d6e0c2f13'
+down_revision = '3f1c2a7b9e40'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.execute('CREATE INDEX IF NOT EXISTS idx_observations_location '
+               'ON observations USING gist (location)')
+
+
+def downgrade():
+    op.execute('DROP INDEX IF EXISTS idx_observations_location')
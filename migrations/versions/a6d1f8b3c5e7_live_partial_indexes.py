@@ -0,0 +1,58 @@
+"""partial indexes on the rows not soft deleted
+
+Revision ID: a6d1f8b3c5e7
+Revises: e4a9c3d7f1b2
+Create Date: 2026-10-19 16:27:09.730512
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a6d1f8b3c5e7'
+down_revision = 'e4a9c3d7f1b2'
+branch_labels = None
+depends_on = None
+
+
+LIVE = sa.text('deleted IS NULL')
+
+
+def _observation_indexes(**kw):
+    op.create_index('ix_observations_labels', 'observations', ['labels'],
+                    postgresql_using='gin', **kw)
+    op.create_index('ix_observations_user_id', 'observations', ['user_id'],
+                    **kw)
+    op.create_index(
+        'ix_observations_species_id', 'observations', ['species_id'], **kw)
+    op.create_index('ix_observations_created', 'observations', ['created'],
+                    **kw)
+
+
+def _drop_indexes():
+    op.drop_index('ix_species_search_trgm', 'species')
+    op.drop_index('ix_observations_created', 'observations')
+    op.drop_index('ix_observations_species_id', 'observations')
+    op.drop_index('ix_observations_user_id', 'observations')
+    op.drop_index('ix_observations_labels', 'observations')
+
+
+def upgrade():
+    _drop_indexes()
+    _observation_indexes(postgresql_where=LIVE)
+    op.create_index('ix_species_search_trgm', 'species', ['search_text'],
+                    postgresql_using='gin',
+                    postgresql_ops={'search_text': 'gin_trgm_ops'},
+                    postgresql_where=LIVE)
+    op.create_index('ix_users_credentials', 'users', ['credentials'],
+                    postgresql_where=LIVE)
+
+
+def downgrade():
+    op.drop_index('ix_users_credentials', 'users')
+    _drop_indexes()
+    _observation_indexes()
+    op.create_index('ix_species_search_trgm', 'species', ['search_text'],
+                    postgresql_using='gin',
+                    postgresql_ops={'search_text': 'gin_trgm_ops'})
@@ -0,0 +1,39 @@
+"""hash the user secrets stored in plain text
+
+Revision ID: b8c4e2f6a9d1
+Revises: a6d1f8b3c5e7
+Create Date: 2026-10-19 18:02:41.318207
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+import birdseye.passwords as passwords
+
+
+# revision identifiers, used by Alembic.
+revision = 'b8c4e2f6a9d1'
+down_revision = 'a6d1f8b3c5e7'
+branch_labels = None
+depends_on = None
+
+
+LEGACY = sa.text(
+    'SELECT user_id, secrets FROM users '
+    'WHERE secrets IS NOT NULL AND secrets NOT LIKE :hashed').bindparams(
+        hashed=passwords.ALGORITHM + '$%')
+UPDATE = sa.text(
+    'UPDATE users SET secrets = :hashed '
+    'WHERE user_id = :user_id AND secrets = :secret')
+
+
+def upgrade():
+    connection = op.get_bind()
+    for user_id, secret in connection.execute(LEGACY).fetchall():
+        connection.execute(UPDATE, hashed=passwords.hash_secret(secret),
+                           user_id=user_id, secret=secret)
+
+
+def downgrade():
+    # hashes cannot be turned back into plain text
+    pass
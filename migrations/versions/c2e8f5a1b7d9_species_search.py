@@ -0,0 +1,37 @@
+"""species search text with trigram index
+
+Revision ID: c2e8f5a1b7d9
+Revises: 5b7e91d4a2c6
+Create Date: 2026-10-19 12:41:55.204118
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c2e8f5a1b7d9'
+down_revision = '5b7e91d4a2c6'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    op.add_column('species', sa.Column(
+        'search_text', sa.Text(), nullable=False, server_default=''))
+    op.execute('''
+        UPDATE species SET search_text = lower(concat_ws(' ',
+            coalesce(names->>'common', ''),
+            coalesce(names->>'scientific', ''),
+            (SELECT string_agg(label, ' ')
+             FROM jsonb_array_elements_text(labels) label)))
+    ''')
+    op.create_index('ix_species_search_trgm', 'species', ['search_text'],
+                    postgresql_using='gin',
+                    postgresql_ops={'search_text': 'gin_trgm_ops'})
+
+
+def downgrade():
+    op.drop_index('ix_species_search_trgm', 'species')
+    op.drop_column('species', 'search_text')
@@ -0,0 +1,110 @@
+"""observations partitioned by month on created
+
+Revision ID: e4a9c3d7f1b2
+Revises: c2e8f5a1b7d9
+Create Date: 2026-10-19 15:02:37.418256
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e4a9c3d7f1b2'
+down_revision = 'c2e8f5a1b7d9'
+branch_labels = None
+depends_on = None
+
+
+INDEXES = '''
+    CREATE INDEX ix_observations_labels ON observations USING gin (labels);
+    CREATE INDEX ix_observations_user_id ON observations (user_id);
+    CREATE INDEX ix_observations_species_id ON observations (species_id);
+    CREATE INDEX ix_observations_created ON observations (created);
+    CREATE INDEX idx_observations_geometry ON observations
+        USING gist (geometry);
+    CREATE INDEX idx_observations_location ON observations
+        USING gist (location);
+'''
+
+DROP_INDEXES = '''
+    DROP INDEX IF EXISTS ix_observations_labels, ix_observations_user_id,
+        ix_observations_species_id, ix_observations_created,
+        idx_observations_geometry, idx_observations_location;
+'''
+
+FOREIGN_KEYS = '''
+    ALTER TABLE observations
+        ADD FOREIGN KEY (user_id) REFERENCES users (user_id),
+        ADD FOREIGN KEY (species_id) REFERENCES species (species_id);
+'''
+
+# the months of the existing rows up to 3 months ahead, as in
+# birdseye.partitions
+MONTHLY_PARTITIONS = '''
+    DO $$
+    DECLARE
+        month timestamp;
+    BEGIN
+        FOR month IN SELECT generate_series(
+            date_trunc('month', coalesce(
+                (SELECT min(created) FROM observations_unpartitioned),
+                now() at time zone 'utc')),
+            date_trunc('month', now() at time zone 'utc')
+                + interval '3 months',
+            interval '1 month')
+        LOOP
+            EXECUTE format(
+                'CREATE TABLE %I PARTITION OF observations '
+                'FOR VALUES FROM (%L) TO (%L)',
+                'observations_y' || to_char(month, 'YYYY')
+                    || 'm' || to_char(month, 'MM'),
+                month, month + interval '1 month');
+        END LOOP;
+    END $$;
+'''
+
+
+def upgrade():
+    # observation_id alone is not unique in a partitioned table
+    op.execute('ALTER TABLE observation_summary DROP CONSTRAINT IF EXISTS '
+               'observation_summary_observation_id_fkey')
+    op.execute(DROP_INDEXES)
+    op.rename_table('observations', 'observations_unpartitioned')
+    op.execute('ALTER TABLE observations_unpartitioned RENAME CONSTRAINT '
+               'observations_pkey TO observations_unpartitioned_pkey')
+    op.execute('''
+        CREATE TABLE observations
+            (LIKE observations_unpartitioned INCLUDING DEFAULTS)
+            PARTITION BY RANGE (created);
+        ALTER TABLE observations ADD PRIMARY KEY (observation_id, created);
+    ''')
+    op.execute(FOREIGN_KEYS)
+    op.execute(INDEXES)
+    op.execute('CREATE TABLE observations_default PARTITION OF observations '
+               'DEFAULT')
+    op.execute(MONTHLY_PARTITIONS)
+    op.execute('INSERT INTO observations '
+               'SELECT * FROM observations_unpartitioned')
+    op.drop_table('observations_unpartitioned')
+
+
+def downgrade():
+    op.execute(DROP_INDEXES)
+    op.rename_table('observations', 'observations_partitioned')
+    op.execute('ALTER TABLE observations_partitioned RENAME CONSTRAINT '
+               'observations_pkey TO observations_partitioned_pkey')
+    op.execute('''
+        CREATE TABLE observations
+            (LIKE observations_partitioned INCLUDING DEFAULTS);
+        ALTER TABLE observations ADD PRIMARY KEY (observation_id);
+    ''')
+    op.execute(FOREIGN_KEYS)
+    op.execute(INDEXES)
+    op.execute('INSERT INTO observations '
+               'SELECT * FROM observations_partitioned')
+    # drops the partitions as well
+    op.drop_table('observations_partitioned')
+    op.create_foreign_key(
+        'observation_summary_observation_id_fkey', 'observation_summary',
+        'observations', ['observation_id'], ['observation_id'])
@@ -0,0 +1,31 @@
+"""index observations on (created, observation_id) for keyset pages
+
+Revision ID: f3b7d1e9c4a2
+Revises: b8c4e2f6a9d1
+Create Date: 2026-10-19 20:14:52.604118
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f3b7d1e9c4a2'
+down_revision = 'b8c4e2f6a9d1'
+branch_labels = None
+depends_on = None
+
+
+LIVE = sa.text('deleted IS NULL')
+
+
+def upgrade():
+    op.drop_index('ix_observations_created', 'observations')
+    op.create_index('ix_observations_created', 'observations',
+                    ['created', 'observation_id'], postgresql_where=LIVE)
+
+
+def downgrade():
+    op.drop_index('ix_observations_created', 'observations')
+    op.create_index('ix_observations_created', 'observations', ['created'],
+                    postgresql_where=LIVE)
@@ -79,7 +79,10 @@ def find_packages_by_root_package(packages):
 # -----------------------------------------------------------------------------
 setup(
     name="birdseye",
-    use_scm_version=True,
+    use_scm_version={
+        'write_to': 'birdseye/version.py',
+        'write_to_template': "ver = '{version}'\n",
+    },
     setup_requires=['setuptools_scm'],
     description="birdseye - the server for species migration observation.",
     long_description=description,
@@ -101,7 +104,10 @@ setup(
         "nose>=1.3", "mock>=1.0", "PyHamcrest>=1.8", "nose-timer>=0.7.0"],
     cmdclass={
     },
-    extras_require={},
+    extras_require={
+        'bulk': ['numpy'],
+        'export': ['pyarrow'],
+    },
     use_2to3=False,
     license="BSD",
     classifiers=[